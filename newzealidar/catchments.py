@@ -5,16 +5,17 @@ split large catchments to small catchments, and save to local database.
 """
 import gc
 import logging
-import multiprocessing
+import os
 import pathlib
 from itertools import repeat
-from multiprocessing.pool import ThreadPool as Pool
 from typing import Type, Union
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import shapely
 from geoapis.vector import WfsQueryBase
+from sqlalchemy import text
 from sqlalchemy.engine import Engine
 
 from newzealidar import tables
@@ -33,6 +34,21 @@ LOWER_AREA = (
     CATCHMENT_RESOLUTION * CATCHMENT_RESOLUTION - EPS
 )  # if area is smaller than this, it will be filtered out.
 GRID_SIZE = 10_000  # grid size of split land to calculate raw dem, unit is meter.
+# names of the stages of catchments pipeline in order, see `get_stages`
+STAGE_NAMES = [
+    "fetch",
+    "deduplicate_source",
+    "extend_sdcp",
+    "deduplicate_sdcp",
+    "refine_sdcp",
+    "refine_sub",
+    "split",
+    "extend_catchtemp",
+    "deduplicate_catchtemp",
+    "refine_catchment",
+    "coast",
+    "grid",
+]
 
 """ Catch_id range of different datasets to avoid overlap in the same dataframe or table
 
@@ -104,13 +120,64 @@ def fetch_data_from_mfe(
     return vector_fetcher.run(layer)
 
 
-def gen_source_catchment_table(engine: Engine, gpkg: bool = False) -> None:
+def get_mfe_layer(
+    layer: int, refresh: bool = False, index_column: str = None
+) -> gpd.GeoDataFrame:
+    """
+    get layer of data.mfe.govt.nz from local cache, fetch and cache it if not cached or refresh.
+    the cache is GeoParquet files in MFE_DIR (default is 'mfe' under DATA_DIR), named by layer id and fetch date,
+    the latest cached version of the layer is used, so the cache directory can be a copy of fixture for offline run.
+
+    :param layer: layer id of data.mfe.govt.nz
+    :param refresh: fetch the layer from data.mfe.govt.nz even if it is cached, default is False
+    :param index_column: index column of the layer, to log the changes of refreshed layer from the cached one
+    :return: layer data
+    """
+    data_dir = pathlib.Path(utils.get_env_variable("DATA_DIR"))
+    cache_dir = data_dir / (os.getenv("MFE_DIR") or "mfe")
+    list_cache = sorted(cache_dir.glob(f"{layer}_*.parquet"))
+    if list_cache and not refresh:
+        logger.info(f"Read layer {layer} from cache {list_cache[-1]}.")
+        return gpd.read_parquet(list_cache[-1])
+    gdf = fetch_data_from_mfe(layer)
+    if list_cache and index_column is not None:
+        gdf_old = gpd.read_parquet(list_cache[-1])
+        df_change = diff_geometry_hash(
+            pd.DataFrame(
+                {
+                    index_column: gdf_old[index_column],
+                    "hash": utils.get_geometry_hash(gdf_old["geometry"]),
+                }
+            ),
+            pd.DataFrame(
+                {
+                    index_column: gdf[index_column],
+                    "hash": utils.get_geometry_hash(gdf["geometry"]),
+                }
+            ),
+            index_column=index_column,
+        )
+        logger.info(
+            f"Layer {layer} changes from cache {list_cache[-1].name}: "
+            f"{df_change['change'].value_counts().to_dict()}."
+        )
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_file = cache_dir / f"{layer}_{pd.Timestamp.now():%Y%m%d}.parquet"
+    gdf.to_parquet(cache_file)
+    logger.info(f"Save layer {layer} to cache {cache_file}.")
+    return gdf
+
+
+def gen_source_catchment_table(
+    engine: Engine, gpkg: bool = False, refresh: bool = False
+) -> None:
     """
     fetching catchment data from data.mfe.govt.nz and save to local database
     current version fetches sea draining catchments, order 5 catchments, order 4 catchments.
 
     :param engine: database engine
     :param gpkg: save catchments to geopackage or not, default is True
+    :param refresh: fetch data from data.mfe.govt.nz rather than local cache, default is False
     """
     logger.info("Fetch catchments data from data.mfe.govt.nz ...")
 
@@ -125,7 +192,7 @@ def gen_source_catchment_table(engine: Engine, gpkg: bool = False) -> None:
     column_order4 = ["NZreach", "Sum_AREA", "geometry"]
     list_columns = [column_sea, column_order5, column_order4]
     for layer, table, column in zip(list_layers, list_tables, list_columns):
-        gdf = fetch_data_from_mfe(layer)
+        gdf = get_mfe_layer(layer, refresh=refresh, index_column=column[0])
         gdf = gdf[column].copy()
         tables.create_catchment_table(engine, table, gdf, column)
         logger.info(
@@ -151,16 +218,17 @@ def gen_source_catchment_table(engine: Engine, gpkg: bool = False) -> None:
     #         utils.save_gpkg(gdf, table)
 
 
-def initiate_tables(gpkg: bool = False) -> None:
+def initiate_tables(gpkg: bool = False, refresh: bool = False) -> None:
     """
     fetching catchment data from data.mfe.govt.nz and save to local database
     current version fetches sea draining catchments, order 5 catchments, order 4 catchments.
 
     :param gpkg: save catchments to geopackage or not, default is True
+    :param refresh: fetch data from data.mfe.govt.nz rather than local cache, default is False
     """
     engine = utils.get_database()
     # get data from data.mfe.govt.nz
-    gen_source_catchment_table(engine, gpkg)
+    gen_source_catchment_table(engine, gpkg, refresh=refresh)
     # add other table initialization here:
     # ...
     engine.dispose()
@@ -195,6 +263,39 @@ def check_duplicate_catchments(
     return list_result
 
 
+def find_duplicate_catchments(
+    gdf: gpd.GeoDataFrame,
+    buffer: Union[int, float] = -10,
+) -> list:
+    """
+    find duplicate catchments in memory, same as `check_duplicate_catchments` for every row of the table.
+    all geometries are buffered once and checked by one STRtree query.
+
+    :param gdf: input catchments dataframe, contains 'catch_id', 'area' and 'geometry' columns
+    :param buffer: buffer distance, default is -10
+    :return: list of duplicate catch_id lists, each list is sorted by area in descending order
+    """
+    geoms = gdf["geometry"].to_numpy()
+    buffered = shapely.buffer(geoms, buffer, join_style="mitre") if buffer != 0 else geoms
+    tree = shapely.STRtree(buffered)
+    # the pairs of (catchment, buffered catchment within it)
+    container, contained = tree.query(geoms, predicate="contains")
+    df = pd.DataFrame(
+        {
+            "row": contained,
+            "catch_id": gdf["catch_id"].to_numpy()[container],
+            "area": gdf["area"].to_numpy()[container],
+        }
+    )
+    df = df.sort_values(by=["row", "area"], ascending=[True, False], kind="stable")
+    list_result = [
+        list_i for list_i in df.groupby("row")["catch_id"].apply(list) if len(list_i) > 1
+    ]
+    for list_i in list_result:
+        logger.debug(f"find duplicate catchments {list_i}")
+    return list_result
+
+
 # @utils.timeit
 def deduplicate_single_table(
     source_table: Type[tables.Ttable],
@@ -202,6 +303,7 @@ def deduplicate_single_table(
     buffer: Union[int, float] = -10,
     parallel: bool = True,
     gpkg: bool = False,
+    in_memory: bool = True,
 ) -> None:
     """
     deduplicate catchments by area and geometry.
@@ -209,8 +311,10 @@ def deduplicate_single_table(
     :param source_table: table to deduplicate
     :param processed_table: table to save deduplicated catchments
     :param buffer: buffer distance, default is -10
-    :param parallel: parallel running or not, default is True
+    :param parallel: parallel running or not, default is True, only for database checking
     :param gpkg: save catchments to geopackage or not, default is False
+    :param in_memory: check duplicate catchments in memory by STRtree, default is True,
+        if False, check each catchment by a database query
     """
     logger.info(f"Start deduplicating table {source_table.__tablename__} ...")
     engine = utils.get_database()
@@ -220,15 +324,15 @@ def deduplicate_single_table(
 
     gdf = gdf.sort_values(by=["catch_id"]).reset_index(drop=True)
 
-    if parallel:  # SDC 0:08:49.020825, ORDER4 0:00:03.879000, ORDER5 0:00:38.870021
+    if in_memory:
+        list_result = find_duplicate_catchments(gdf, buffer=buffer)
+    elif parallel:  # SDC 0:08:49.020825, ORDER4 0:00:03.879000, ORDER5 0:00:38.870021
         list_gds = [gds for _, gds in gdf.iterrows()]
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            list_result = pool.starmap(
-                check_duplicate_catchments,
-                zip(list_gds, repeat(source_table), repeat(buffer)),
-            )
-            pool.close()
-            pool.join()
+        list_result = utils.parallel_map(
+            check_duplicate_catchments,
+            zip(list_gds, repeat(source_table), repeat(buffer)),
+            star=True,
+        )
     else:
         list_result = []
         for _, gds_row in gdf.iterrows():
@@ -281,6 +385,7 @@ def deduplicate_table(
     buffer: Union[int, float] = -10,
     parallel: bool = True,
     gpkg: bool = False,
+    in_memory: bool = True,
 ) -> None:
     """
     deduplicate catchments in all tables.
@@ -290,24 +395,167 @@ def deduplicate_table(
     if not isinstance(processed_table, list):
         processed_table = [processed_table]
     for s, p in zip(source_table, processed_table):
-        deduplicate_single_table(s, p, buffer=buffer, parallel=parallel, gpkg=gpkg)
+        deduplicate_single_table(
+            s, p, buffer=buffer, parallel=parallel, gpkg=gpkg, in_memory=in_memory
+        )
 
 
-def extend_boundary(
-    index: int, list_id: list, table: Type[tables.Ttable]
+def diff_geometry_hash(
+    df_old: pd.DataFrame, df_new: pd.DataFrame, index_column: str = "catch_id"
+) -> pd.DataFrame:
+    """
+    compare two versions of catchments by index and geometry hash, e.g. from `tables.get_geometry_hash`.
+
+    :param df_old: old version, columns [index_column, 'hash']
+    :param df_new: new version, columns [index_column, 'hash']
+    :param index_column: index column
+    :return: changed catchments, columns [index_column, 'change'], change is 'added', 'modified' or 'removed'
+    """
+    df = pd.merge(
+        df_old, df_new, on=index_column, how="outer", suffixes=("_old", "_new")
+    )
+    df["change"] = None
+    df.loc[df["hash_old"].isna(), "change"] = "added"
+    df.loc[df["hash_new"].isna(), "change"] = "removed"
+    df.loc[
+        df["hash_old"].notna()
+        & df["hash_new"].notna()
+        & (df["hash_old"] != df["hash_new"]),
+        "change",
+    ] = "modified"
+    df = df[df["change"].notna()].sort_values(by=index_column)
+    return df[[index_column, "change"]].reset_index(drop=True)
+
+
+def _read_cache(engine: Engine, name: str) -> dict:
+    """
+    read the cached results of `map_with_cache` as {key: result}.
+    the keys of cached results are listed in '{name}_key' table, so the empty results are cached as well,
+    the cache table without key table, e.g. written by former version, is dropped.
+    """
+    columns = ["catch_id", "area", "geometry"]
+    key_name = f"{name}_key"
+    if not tables.is_table_exist(engine, key_name):
+        if tables.is_table_exist(engine, name):
+            tables.delete_table(engine, name, keep_schema=False)
+        return {}
+    list_key = pd.read_sql(f"SELECT key FROM {key_name} ;", engine)["key"]
+    gdf_empty = gpd.GeoDataFrame(
+        columns=columns, geometry="geometry", crs="epsg:2193"
+    )
+    cache = {key: gdf_empty for key in list_key}
+    if tables.is_table_exist(engine, name):
+        gdf_cache = tables.read_postgis_table(engine, name)
+        cache.update(
+            {
+                key: gdf[columns]
+                for key, gdf in gdf_cache.groupby("key")
+                if key in cache
+            }
+        )
+    return cache
+
+
+def _update_cache(engine: Engine, name: str, new: dict, stale: list) -> None:
+    """
+    update the cache of `map_with_cache` in one transaction,
+    delete the results of stale keys and append the new results {key: result}, the others are kept as they are.
+    """
+    columns = ["catch_id", "area", "geometry"]
+    key_name = f"{name}_key"
+    exist = [tables.is_table_exist(engine, n) for n in [name, key_name]]
+    list_new = [
+        result[columns].assign(key=key) for key, result in new.items() if len(result)
+    ]
+    with engine.begin() as conn:
+        for table_name, table_exist in zip([name, key_name], exist):
+            if stale and table_exist:
+                conn.execute(
+                    text(f"DELETE FROM {table_name} WHERE key = ANY(:keys) ;"),
+                    keys=list(stale),
+                )
+        if list_new:
+            gdf_new = gpd.GeoDataFrame(
+                pd.concat(list_new, ignore_index=True),
+                geometry="geometry",
+                crs="epsg:2193",
+            )
+            gdf_new.to_postgis(
+                name, conn, index=False, if_exists="append", chunksize=4096
+            )
+        if new:
+            pd.DataFrame({"key": list(new)}).to_sql(
+                key_name, conn, index=False, if_exists="append"
+            )
+
+
+def map_with_cache(
+    engine: Engine,
+    name: str,
+    func,
+    list_args: list,
+    list_key: list,
+    parallel: bool = True,
+) -> list:
+    """
+    map func over the arguments as `utils.parallel_map`, but reuse the results of unchanged inputs from cache table,
+    so only the changed catchments are processed when the source catchments change.
+    the inputs are identified by keys, e.g. the hash of the input geometries,
+    only the results of new keys are written to the cache and the results of the keys not in this run are deleted.
+
+    :param engine: database engine
+    :param name: cache table name, the cached keys are in '{name}_key' table
+    :param func: function returning a dataframe with 'catch_id', 'area' and 'geometry' columns
+    :param list_args: arguments of func, unpacked as `starmap`
+    :param list_key: key of each arguments
+    :param parallel: parallel running or not, default is True
+    :return: results in the order of arguments
+    """
+    cache = _read_cache(engine, name)
+    todo = [i for i, key in enumerate(list_key) if key not in cache]
+    logger.info(
+        f"Reuse {len(list_key) - len(todo)} cached results in {name}, process {len(todo)}."
+    )
+    list_todo = [list_args[i] for i in todo]
+    error = None
+    if parallel:
+        try:
+            list_computed = utils.parallel_map(func, list_todo, star=True)
+        except utils.BrokenWorkerError as e:
+            # cache the finished results before raising, they are reused when the run is resumed
+            list_computed, error = e.results, e
+    else:
+        list_computed = [func(*args) for args in list_todo]
+    list_result = [cache.get(key) for key in list_key]
+    new = {}
+    for i, result in zip(todo, list_computed):
+        list_result[i] = result
+        if result is not None:
+            new[list_key[i]] = result
+
+    stale = set(cache) - set(list_key)
+    _update_cache(engine, name, new, sorted(stale))
+    if error is not None:
+        raise error
+    return list_result
+
+
+def extend_geometry(
+    index: int,
+    list_adj_id: list,
+    gdf: gpd.GeoDataFrame,
+    i: int = 0,
+    table_name: str = "",
 ) -> gpd.GeoDataFrame:
     """
-    extend boundary of a catchment to adjacent catchments, to remove holes, silvers, and spikes between polygons.
+    extend boundary of a catchment to adjacent catchments by the geometry in hand, no database access.
+
+    :param index: catch_id of the catchment
+    :param list_adj_id: adjacent catch_id list including the catchment itself, excluding the processed catchments
+    :param gdf: catchments dataframe, contains the catchment and its adjacent catchments at least
+    :param i: the order of the catchment, for logging
+    :param table_name: table name, for logging
     """
-    engine = utils.get_database(null_pool=True)
-    # find adjacent catchments
-    list_adj_id = tables.get_adjacent_catchment_by_id(engine, table, index)
-    assert (
-        index in list_id and index in list_adj_id
-    ), f"Unexpected index: {index} not in {list_id} or {list_adj_id}"
-    i = list_id.index(index)
-    ignore = list_id[:i]
-    list_adj_id = [i for i in list_adj_id if i not in ignore]
     if len(list_adj_id) < 2:
         if len(list_adj_id) == 0:
             logger.warning(
@@ -318,20 +566,15 @@ def extend_boundary(
                 list_adj_id[0] == index
             ), f"unexpected adjacent_id: {list_adj_id} of catch_id: {index}."
             logger.debug(
-                f"{table.__tablename__}, "
+                f"{table_name}, "
                 f"Ignoring {i + 1:>5}th catchment, catch_id: {index:>8}, adjacent catch_id: {list_adj_id}"
             )
-        gdf = tables.get_data_by_id(engine, table, index)
-        engine.dispose()
-        gc.collect()
-        return gdf
+        return gdf[gdf["catch_id"] == index]
     logger.debug(
-        f"{table.__tablename__}, "
+        f"{table_name}, "
         f"Refining {i + 1:>5}th catchment, catch_id: {index:>8}, adjacent catch_id: {list_adj_id}"
     )
-    gdf = tables.get_data_by_id(engine, table, list_adj_id)
-    engine.dispose()
-    gc.collect()
+    gdf = gdf[gdf["catch_id"].isin(list_adj_id)]
     # rest catchments - exclude the current index catchment
     gdf_r = gdf[gdf["catch_id"] != index]
     assert (
@@ -360,12 +603,141 @@ def extend_boundary(
     return gdf_result
 
 
+def extend_boundary(
+    index: int, list_id: list, table: Type[tables.Ttable]
+) -> gpd.GeoDataFrame:
+    """
+    extend boundary of a catchment to adjacent catchments, to remove holes, silvers, and spikes between polygons.
+    """
+    engine = utils.get_database(null_pool=True)
+    # find adjacent catchments
+    list_adj_id = tables.get_adjacent_catchment_by_id(engine, table, index)
+    assert (
+        index in list_id and index in list_adj_id
+    ), f"Unexpected index: {index} not in {list_id} or {list_adj_id}"
+    i = list_id.index(index)
+    ignore = list_id[:i]
+    list_adj_id = [i for i in list_adj_id if i not in ignore]
+    gdf = tables.get_data_by_id(
+        engine, table, list_adj_id if len(list_adj_id) >= 2 else index
+    )
+    engine.dispose()
+    gc.collect()
+    return extend_geometry(index, list_adj_id, gdf, i=i, table_name=table.__tablename__)
+
+
+def gen_adjacency_graph(
+    gdf: gpd.GeoDataFrame, buffer: Union[int, float] = CATCHMENT_RESOLUTION + EPS
+) -> dict:
+    """
+    generate adjacency graph of catchments by one in memory spatial join,
+    same as `tables.get_adjacent_catchment_by_id` for every catchment.
+
+    :param gdf: catchments dataframe, contains 'catch_id', 'area' and 'geometry' columns
+    :param buffer: buffer distance of catchments to find adjacent catchments
+    :return: {catch_id: adjacent catch_id list including itself, sorted by area in descending order}
+    """
+    geoms = gdf["geometry"].to_numpy()
+    buffered = shapely.buffer(geoms, buffer, join_style="mitre") if buffer > 0 else geoms
+    tree = shapely.STRtree(geoms)
+    source, adjacent = tree.query(buffered, predicate="intersects")
+    df = pd.DataFrame(
+        {
+            "catch_id": gdf["catch_id"].to_numpy()[source],
+            "adjacent_id": gdf["catch_id"].to_numpy()[adjacent],
+            "area": gdf["area"].to_numpy()[adjacent],
+        }
+    )
+    df = df.sort_values(by=["catch_id", "area"], ascending=[True, False], kind="stable")
+    return df.groupby("catch_id")["adjacent_id"].apply(list).to_dict()
+
+
+def get_adjacency_graph(
+    engine: Engine, table: Type[tables.Ttable], gdf: gpd.GeoDataFrame
+) -> dict:
+    """
+    get adjacency graph of catchments in table, the graph is cached as edges in table `{table}_adjacency`
+    with the fingerprint of the catchments table, and regenerated if the catchments table changes.
+
+    :param engine: database engine
+    :param table: catchments table
+    :param gdf: catchments dataframe read from the table
+    """
+    adjacency_table = f"{table.__tablename__}_adjacency"
+    fingerprint = tables.get_table_fingerprint(engine, table)
+    if tables.is_table_exist(engine, adjacency_table):
+        query = f"""SELECT catch_id, adjacent_id, area FROM {adjacency_table}
+                    WHERE fingerprint = '{fingerprint}' ;"""
+        df = pd.read_sql(query, engine)
+        if not df.empty:
+            logger.info(f"Load adjacency graph from table {adjacency_table}.")
+            df = df.sort_values(
+                by=["catch_id", "area"], ascending=[True, False], kind="stable"
+            )
+            return df.groupby("catch_id")["adjacent_id"].apply(list).to_dict()
+    graph = gen_adjacency_graph(gdf)
+    area = gdf.set_index("catch_id")["area"]
+    df = pd.DataFrame(
+        [(k, v) for k, list_v in graph.items() for v in list_v],
+        columns=["catch_id", "adjacent_id"],
+    )
+    df["area"] = df["adjacent_id"].map(area)
+    df["fingerprint"] = fingerprint
+    df.to_sql(
+        adjacency_table, engine, index=False, if_exists="replace", chunksize=4096
+    )
+    logger.info(f"Save adjacency graph to table {adjacency_table}.")
+    return graph
+
+
+def get_extend_items(
+    gdf: gpd.GeoDataFrame, graph: dict, table_name: str = ""
+) -> tuple:
+    """
+    get the arguments of `extend_geometry` for each catchment and their cache keys,
+    the key is the hash of the catchment and its adjacent catchments not processed before it.
+
+    :param gdf: catchments dataframe sorted by area in descending order, the processing order
+    :param graph: adjacency graph of catchments, see `gen_adjacency_graph`
+    :param table_name: table name, for logging
+    :return: (list of arguments, list of keys)
+    """
+    list_id = gdf["catch_id"].to_list()
+    order = {catch_id: i for i, catch_id in enumerate(list_id)}
+    gdf = gdf.set_index("catch_id", drop=False)
+    geom_hash = dict(zip(list_id, utils.get_geometry_hash(gdf["geometry"])))
+    list_args = []
+    list_key = []
+    for i, catch_id in enumerate(list_id):
+        # ignore the adjacent catchments that already processed
+        list_adj_id = [j for j in graph.get(catch_id, []) if order[j] >= i]
+        gdf_adj = gdf.loc[list_adj_id or [catch_id]]
+        list_args.append((catch_id, list_adj_id, gdf_adj, i, table_name))
+        list_key.append(
+            f"{catch_id}:{geom_hash[catch_id]}|"
+            + ",".join(f"{j}:{geom_hash[j]}" for j in list_adj_id)
+        )
+    return list_args, list_key
+
+
 # @utils.timeit  # 0:21:48.086703 for SDCP; 0:39:41.483969 for CATCHTEMP
 def extend_catchments(
-    table: Type[tables.Ttable], parallel: bool = True, gpkg: bool = False
+    table: Type[tables.Ttable],
+    parallel: bool = True,
+    gpkg: bool = False,
+    adjacency: bool = True,
+    cache: bool = True,
 ) -> None:
     """
     extend boundary of catchments to adjacent catchments, to remove holes, silvers, and spikes between polygons.
+
+    :param table: catchments table
+    :param parallel: parallel running or not, default is True
+    :param gpkg: save catchments to geopackage or not, default is False
+    :param adjacency: use the precomputed adjacency graph and the catchments in memory, default is True,
+        if False, query adjacent catchments of each catchment from database
+    :param cache: reuse the result of a catchment from `{table}_extend_cache` table if the catchment
+        and its adjacent catchments are unchanged, only work with adjacency, default is True
     """
     logger.info(f"Extending catchment geometry in table {table.__tablename__}...")
     engine = utils.get_database()
@@ -384,13 +756,30 @@ def extend_catchments(
 
     list_id = gdf["catch_id"].to_list()
 
-    if parallel:  # runtime: 0:24:10.686879.
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            list_result = pool.starmap(
-                extend_boundary, zip(list_id, repeat(list_id), repeat(table))
+    if adjacency:
+        graph = get_adjacency_graph(engine, table, gdf)
+        engine.dispose()
+        list_args, list_key = get_extend_items(gdf, graph, table.__tablename__)
+        if cache:
+            engine = utils.get_database()
+            list_result = map_with_cache(
+                engine,
+                f"{table.__tablename__}_extend_cache",
+                extend_geometry,
+                list_args,
+                list_key,
+                parallel=parallel,
             )
-            pool.close()
-            pool.join()
+            engine.dispose()
+        elif parallel:
+            list_result = utils.parallel_map(extend_geometry, list_args, star=True)
+        else:
+            list_result = [extend_geometry(*args) for args in list_args]
+        gdf_result = pd.concat(list_result, ignore_index=True)
+    elif parallel:  # runtime: 0:24:10.686879.
+        list_result = utils.parallel_map(
+            extend_boundary, zip(list_id, repeat(list_id), repeat(table)), star=True
+        )
         gdf_result = pd.concat(list_result, ignore_index=True)
     else:  # runtime: 1:45:46.976877.
         gdf_result = gpd.GeoDataFrame(geometry=gpd.GeoSeries())
@@ -412,6 +801,135 @@ def extend_catchments(
     logger.info(f"Finish extend catchments, save to table {table.__tablename__}.")
 
 
+def find_tile_gaps(item: tuple) -> tuple:
+    """
+    find gaps between catchments in a tile, the catchments within the halo of the tile are included,
+    so the gaps along the tile boundary are the same as those found over all catchments.
+    the uncovered areas open to the tile boundary are returned to be stitched with adjacent tiles,
+    since it is unknown in the tile whether they are holes or not.
+
+    :param item: (bounds, list_wkb, halo, polygon_threshold, hole_threshold), bounds of the tile,
+        WKB of catchments within the halo, halo distance and thresholds as `find_gaps`
+    :return: (gaps, open areas), WKB of gaps within the tile,
+        and (WKB of uncovered area, WKB of the gap in it) of the uncovered areas open to the tile boundary
+    """
+    bounds, list_wkb, halo, polygon_threshold, hole_threshold = item
+    box_core = shapely.box(*bounds)
+    box_halo = shapely.box(
+        bounds[0] - halo, bounds[1] - halo, bounds[2] + halo, bounds[3] + halo
+    )
+    # original geometry, polygons only
+    geoms = shapely.get_parts(
+        shapely.intersection(shapely.from_wkb(list_wkb), box_halo)
+    )
+    geom_o = shapely.union_all(geoms[shapely.get_type_id(geoms) == 3])
+    # filtered geometry, the polygons cut by the halo boundary are kept since their area is unknown
+    parts = shapely.get_parts(geom_o)
+    keep = (shapely.area(parts) > polygon_threshold) | shapely.intersects(
+        parts, box_halo.exterior
+    )
+    geom_f = utils.smooth_geometry(
+        shapely.multipolygons(parts[keep]), resolution=CATCHMENT_RESOLUTION
+    )
+    # gaps along catchments boundary
+    list_gap = [geom_f.difference(geom_o).intersection(box_core)]
+    # gaps of holes, the uncovered areas closed in the tile are decided here
+    list_open = []
+    for part in shapely.get_parts(box_core.difference(geom_f)):
+        if part.geom_type != "Polygon":
+            continue
+        part_d = part.difference(geom_o)
+        if part.intersects(box_core.exterior):
+            list_open.append((shapely.to_wkb(part), shapely.to_wkb(part_d)))
+        elif part.area <= hole_threshold:
+            list_gap.append(part_d)
+    return shapely.to_wkb(list_gap).tolist(), list_open
+
+
+def find_gaps_tiled(
+    gdf: gpd.GeoDataFrame,
+    polygon_threshold: Union[int, float] = LOWER_AREA,
+    hole_threshold: Union[int, float] = 10_000 * 10_000,
+    tile_size: Union[int, float] = GRID_SIZE,
+    halo: Union[int, float] = CATCHMENT_RESOLUTION * 4,
+) -> shapely.Geometry:
+    """
+    find gaps between catchments tile by tile in parallel, rather than over the union of all catchments.
+    the gaps are the same as `find_gaps` within tolerance, the tiles are aligned with the fishnet of grid table.
+    the uncovered areas across tile boundaries are stitched, they are holes (gaps)
+    if their area is not larger than hole_threshold and they do not reach the boundary of all tiles.
+
+    :param gdf: input dataframe of catchments
+    :param polygon_threshold: remove the polygon if it is smaller than the threshold
+    :param hole_threshold: take holes as gaps if a hole area is smaller than the threshold
+    :param tile_size: size of tiles
+    :param halo: distance to extend tiles to include the adjacent catchments, larger than the resolution
+    :return: geometry of gaps
+    """
+    geoms = gdf["geometry"].to_numpy()
+    list_wkb = shapely.to_wkb(geoms)
+    xmin, ymin, xmax, ymax = shapely.total_bounds(geoms)
+    # the tiles cover the catchments with a margin, so the sea reaches the boundary of all tiles
+    xs = np.arange(xmin // tile_size - 1, xmax // tile_size + 2) * tile_size
+    ys = np.arange(ymin // tile_size - 1, ymax // tile_size + 2) * tile_size
+    envelope = shapely.box(xs[0], ys[0], xs[-1] + tile_size, ys[-1] + tile_size)
+    x, y = [a.ravel() for a in np.meshgrid(xs, ys)]
+    tiles = shapely.box(x, y, x + tile_size, y + tile_size)
+    tree = shapely.STRtree(geoms)
+    tile_index, geom_index = tree.query(
+        shapely.buffer(tiles, halo, join_style="mitre")
+    )
+    hits = pd.Series(geom_index).groupby(tile_index).apply(list).to_dict()
+    logger.info(
+        f"Searching gaps in {len(hits)} of {len(tiles)} tiles of size {tile_size}..."
+    )
+
+    list_gap = []
+    # the tiles without catchments are uncovered areas open to the tile boundary
+    list_open = [(tile, tile) for i, tile in enumerate(tiles) if i not in hits]
+    items = (
+        (tiles[i].bounds, list_wkb[j].tolist(), halo, polygon_threshold, hole_threshold)
+        for i, j in hits.items()
+    )
+    for gaps, opens in utils.parallel_imap(
+        find_tile_gaps, items, workers=utils.get_number_of_workers()
+    ):
+        list_gap.extend(shapely.from_wkb(gaps))
+        list_open.extend(
+            (shapely.from_wkb(a), shapely.from_wkb(b)) for a, b in opens
+        )
+
+    # stitch the open uncovered areas of adjacent tiles by union-find
+    opens = np.array([a for a, _ in list_open], dtype=object)
+    parent = list(range(len(opens)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(*shapely.STRtree(opens).query(opens, predicate="intersects")):
+        parent[find(i)] = find(j)
+    df_open = pd.DataFrame(
+        {
+            "root": [find(i) for i in range(len(opens))],
+            "area": shapely.area(opens),
+            "boundary": shapely.intersects(opens, envelope.exterior),
+        }
+    )
+    df_root = df_open.groupby("root").agg({"area": "sum", "boundary": "any"})
+    df_root = df_root[(df_root["area"] <= hole_threshold) & ~df_root["boundary"]]
+    holes = set(df_root.index)
+    list_gap.extend(
+        b for (_, b), root in zip(list_open, df_open["root"]) if root in holes
+    )
+
+    logger.info(f"Stitching gaps of tiles...")
+    geom_d = shapely.union_all([g for g in list_gap if not g.is_empty])
+    return geom_d
+
+
 # @utils.timeit  # 0:07:07.559980 for SDCP; 0:11:38.107690 for CATCHTEMP
 def find_gaps(
     gdf_in: gpd.GeoDataFrame,
@@ -419,6 +937,7 @@ def find_gaps(
     hole_threshold: Union[int, float] = 10_000 * 10_000,
     table: Type[tables.Ttable] = None,
     gpkg: bool = False,
+    tiled: bool = True,
 ) -> gpd.GeoDataFrame:
     """
     find gaps between catchments.
@@ -428,20 +947,27 @@ def find_gaps(
     :param polygon_threshold: remove the polygon if it is smaller than the threshold, default LOWER_AREA
     :param hole_threshold: take holes as gaps if a hole area is smaller than the threshold, default 100 KM2
     :param gpkg: whether to save gap to gpkg, default False
+    :param tiled: find gaps tile by tile in parallel, see `find_gaps_tiled`, default True,
+        if False, find gaps over the union of all catchments, which is kept as the reference of tiled gaps
     """
     logger.info(f"Searching gaps between catchments...")
     gdf = gdf_in.copy()
-    # original geometry
-    geom_o = gdf["geometry"].unary_union
-    # filtered geometry
-    geom_f = utils.filter_geometry(
-        gdf["geometry"],
-        resolution=CATCHMENT_RESOLUTION,
-        polygon_threshold=polygon_threshold,
-        hole_threshold=hole_threshold,
-    )
-    # difference geometry
-    geom_d = geom_f.difference(geom_o)
+    if tiled:
+        geom_d = find_gaps_tiled(
+            gdf, polygon_threshold=polygon_threshold, hole_threshold=hole_threshold
+        )
+    else:
+        # original geometry
+        geom_o = gdf["geometry"].unary_union
+        # filtered geometry
+        geom_f = utils.filter_geometry(
+            gdf["geometry"],
+            resolution=CATCHMENT_RESOLUTION,
+            polygon_threshold=polygon_threshold,
+            hole_threshold=hole_threshold,
+        )
+        # difference geometry
+        geom_d = geom_f.difference(geom_o)
     if geom_d.is_empty:
         logger.info(f"No gap found between catchments, nothing to do.")
         return gdf_in
@@ -507,40 +1033,56 @@ def merge_catchments(
     gdf_keep = gdf_keep.reset_index(drop=True)
     gdf_merge = gdf_merge.reset_index(drop=True)
 
-    # abandon `iterrows` approach and use `at` approach for better performance and convenience.
+    # the keep catchments are held in lists indexed by their row position in gdf_keep, with a spatial index
+    # over them. merged catchments only grow, so the candidates of a gap are the spatial index hits plus
+    # the catchments updated since the index was built (dirty), the index is rebuilt when dirty gets large.
+    list_geom = gdf_keep["geometry"].to_list()
+    list_area = gdf_keep["area"].to_list()
+    list_catch_id = gdf_keep["catch_id"].to_list()
+    position = {catch_id: j for j, catch_id in enumerate(list_catch_id)}
+    buffered = shapely.buffer(
+        gdf_merge["geometry"].to_numpy(), CATCHMENT_RESOLUTION / 2 - EPS, join_style="mitre"
+    )
+    tree = None
+    tree_size = 0
+    candidate = {}
+    dirty = set()
+
     for i in range(len(gdf_merge)):
         if (
             lower_area < gdf_merge.at[i, "area"] < upper_area
         ):  # to update existing catchments
-            # find adjacent catchments
-            gdf_adj = gdf_keep[
-                gdf_keep["geometry"].intersects(
-                    gdf_merge.at[i, "geometry"].buffer(
-                        CATCHMENT_RESOLUTION / 2 - EPS, join_style="mitre"
-                    )
-                )
-            ].copy()
-            if gdf_adj.empty:
+            # find adjacent catchments, with positions in ascending order as the row order of gdf_keep
+            if tree is None:
+                # query the candidates of all remaining gaps in one batch
+                tree = shapely.STRtree(list_geom)
+                tree_size = len(list_geom)
+                dirty = set()
+                candidate = {}
+                gap, hit = tree.query(buffered[i:], predicate="intersects")
+                for g, h in zip(gap.tolist(), hit.tolist()):
+                    candidate.setdefault(g + i, set()).add(h)
+            list_position = candidate.pop(i, set()) | dirty
+            list_position = sorted(
+                j for j in list_position if list_geom[j].intersects(buffered[i])
+            )
+            if not list_position:
                 logger.warning(
                     f"Cannot find adjacent catchments for standalone catchment: "
                     f"{gdf_merge.at[i, 'catch_id']}, add it in catchment table."
                 )
-                gdf_row = gpd.GeoDataFrame(
-                    index=[0], crs="epsg:2193", geometry=[gdf_merge.at[i, "geometry"]]
-                )
-                gdf_row["area"] = gdf_merge.at[i, "area"]
-                gdf_row["catch_id"] = gdf_merge.at[i, "catch_id"]
-                gdf_keep = pd.concat([gdf_keep, gdf_row], ignore_index=True)
+                list_geom.append(gdf_merge.at[i, "geometry"])
+                list_area.append(gdf_merge.at[i, "area"])
+                list_catch_id.append(gdf_merge.at[i, "catch_id"])
+                position[gdf_merge.at[i, "catch_id"]] = len(list_geom) - 1
+                dirty.add(len(list_geom) - 1)
                 count_standalone += 1
                 continue
-            # merge into the largest adjacent catchment
-            gdf_largest = gdf_adj[gdf_adj["area"] == gdf_adj["area"].max()]
-            catch_id = gdf_largest["catch_id"].values[0]
-            geometry = gdf_largest["geometry"].values[0]
-            # area = gdf_largest['area'].values[0]  # not used because it may not correct after merge
-            area = (
-                gdf_largest["geometry"].values[0].area
-            )  # use the calculated area instead
+            # merge into the largest adjacent catchment, the first one if tie
+            index = max(list_position, key=lambda j: (list_area[j], -j))
+            catch_id = list_catch_id[index]
+            geometry = list_geom[index]
+            area = geometry.area  # use the calculated area instead
             # skip overlapped catchments
             if geometry.buffer(EPS, join_style="mitre").contains(
                 gdf_merge.at[i, "geometry"]
@@ -551,12 +1093,10 @@ def merge_catchments(
                 )
                 count_skip += 1
                 continue
-            index = gdf_keep[gdf_keep["catch_id"] == catch_id].index.values[
-                0
-            ]  # index in gdf_keep
+            assert position[catch_id] == index, f"Unexpected position of catch_id: {catch_id}"
             logger.debug(
                 f"Merge catchment catch_id: {gdf_merge.at[i, 'catch_id']:>8}, "
-                f"into catch_id {catch_id:>8}, adjacent catchments {gdf_adj['catch_id'].to_list()}"
+                f"into catch_id {catch_id:>8}, adjacent catchments {[list_catch_id[j] for j in list_position]}"
             )
             geom_update_t = shapely.unary_union([geometry, gdf_merge.at[i, "geometry"]])
             # to remove internal linestring and tiny gaps,
@@ -569,16 +1109,12 @@ def merge_catchments(
                 f"{area} | {gdf_merge.at[i, 'area']} | {geom_update.area}"
             )
             # update catchment immediately for next iteration
-            gdf_keep.at[index, "geometry"] = geom_update
-            gdf_keep.at[index, "area"] = geom_update.area
-            assert (
-                gdf_keep[gdf_keep["catch_id"] == catch_id]["geometry"].values[0]
-                == geom_update
-            ), f"Did not assign geometry value successfully. index: {index} catch_id: {catch_id}"
-            assert (
-                gdf_keep[gdf_keep["catch_id"] == catch_id]["area"].values[0]
-                == geom_update.area
-            ), f"Did not assign area value successfully. index: {index} catch_id: {catch_id}"
+            list_geom[index] = geom_update
+            list_area[index] = geom_update.area
+            dirty.add(index)
+            if len(dirty) > max(1024, tree_size // 10):
+                # re-insert the updated catchments by rebuilding the spatial index at the next gap
+                tree = None
             count_merge += 1
         elif gdf_merge.at[i, "area"] <= lower_area:  # to abandon
             logger.debug(
@@ -588,6 +1124,19 @@ def merge_catchments(
         else:  # should not happen
             raise ValueError(f"Unexpected data: {gdf_merge.iloc[i].to_string()}.")
 
+    gdf_keep["geometry"] = gpd.GeoSeries(
+        list_geom[: len(gdf_keep)], index=gdf_keep.index, crs=gdf_keep.crs
+    )
+    gdf_keep["area"] = list_area[: len(gdf_keep)]
+    if count_standalone > 0:
+        # the standalone catchments are appended to the lists, with the later gaps merged into them
+        gdf_standalone = gpd.GeoDataFrame(
+            crs="epsg:2193", geometry=list_geom[len(gdf_keep) :]
+        )
+        gdf_standalone["area"] = list_area[len(gdf_keep) :]
+        gdf_standalone["catch_id"] = list_catch_id[len(gdf_keep) :]
+        gdf_keep = pd.concat([gdf_keep, gdf_standalone], ignore_index=True)
+
     logger.info(f"Merged {count_merge} gaps into its largest adjacent catchments.")
     if count_skip > 0:
         logger.info(f"Skip {count_skip} gaps.")
@@ -639,11 +1188,20 @@ def merge_catchments(
     return gdf_result
 
 
-def trim_single_catchment(gds: Union[gpd.GeoSeries, pd.Series]) -> tuple:
+def trim_single_catchment(
+    catch_id: int, geometry: Union[bytes, shapely.Geometry], area: float
+) -> tuple:
     """
     align input geometry with corresponding superior sea draining catchments.
+
+    :param catch_id: catchment index
+    :param geometry: catchment geometry, or its WKB
+    :param area: catchment area
+    :return: (catch_id, geometry, area, update), update is 1 if the catchment is trimmed, otherwise 0
     """
-    geom = gds["geometry"]
+    if isinstance(geometry, bytes):
+        geometry = shapely.from_wkb(geometry)
+    geom = geometry
 
     # filter out sticks and spikes, only work for catchments with one large stick which is over 4 pixels.
     geom_fil = geom.buffer(
@@ -656,23 +1214,13 @@ def trim_single_catchment(gds: Union[gpd.GeoSeries, pd.Series]) -> tuple:
     if isinstance(geom_mask, shapely.geometry.MultiPolygon):
         geom_mask = max(geom_mask.geoms, key=lambda x: x.area)
     if geom_mask.area > CATCHMENT_RESOLUTION * CATCHMENT_RESOLUTION * 8:
-        logger.debug(f"Find and cut down a stick, catch_id: {gds['catch_id']}")
+        logger.debug(f"Find and cut down a stick, catch_id: {catch_id}")
         geom = geom.difference(geom_mask)
         geom = utils.filter_geometry(
             geom, resolution=CATCHMENT_RESOLUTION, polygon_threshold=LOWER_AREA
         )
-        gdf_result = gpd.GeoDataFrame(index=[0], crs="epsg:2193", geometry=[geom])
-        gdf_result["area"] = gdf_result["geometry"].area
-        gdf_result["catch_id"] = gds["catch_id"]
-        update = 1
-    else:
-        gdf_result = gpd.GeoDataFrame(
-            index=[0], crs="epsg:2193", geometry=[gds["geometry"]]
-        )
-        gdf_result["area"] = gds["area"]
-        gdf_result["catch_id"] = gds["catch_id"]
-        update = 0
-    return gdf_result, update
+        return catch_id, geom, geom.area, 1
+    return catch_id, geometry, area, 0
 
 
 def align_single_catchment(index: int, table: Type[tables.Ttable]) -> gpd.GeoDataFrame:
@@ -735,24 +1283,28 @@ def trim_catchments(gdf: gpd.GeoDataFrame, parallel: bool = True) -> tuple:
     """
     trim catchments in a GeoDataFrame.
     """
-    gdf_concat = gpd.GeoDataFrame(geometry=gpd.GeoSeries())
-    update_sum = 0
+    # pass plain (catch_id, WKB, area) tuples rather than rows of the dataframe
+    list_args = list(
+        zip(
+            gdf["catch_id"].to_list(),
+            shapely.to_wkb(gdf["geometry"].to_numpy()).tolist(),
+            gdf["area"].to_list(),
+        )
+    )
     if parallel:
-        list_gds = [gds for _, gds in gdf.iterrows()]
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            list_result = pool.map(trim_single_catchment, list_gds)
-            pool.close()
-            pool.join()
-        for gdf_trim, update in list_result:
-            gdf_concat = pd.concat([gdf_concat, gdf_trim], ignore_index=True)
-            update_sum += update
+        list_result = utils.parallel_map(trim_single_catchment, list_args, star=True)
     else:
-        for _, gds in gdf.iterrows():
-            gdf_trim, update = trim_single_catchment(gds)
-            gdf_concat = pd.concat([gdf_concat, gdf_trim], ignore_index=True)
-            update_sum += update
+        list_result = [trim_single_catchment(*args) for args in list_args]
 
-    return gdf_concat, update_sum
+    list_catch_id, list_geom, list_area, list_update = (
+        zip(*list_result) if list_result else ([], [], [], [])
+    )
+    gdf_concat = gpd.GeoDataFrame(
+        {"area": list(list_area), "catch_id": list(list_catch_id)},
+        geometry=list(list_geom),
+        crs="epsg:2193",
+    )
+    return gdf_concat, sum(list_update)
 
 
 def align_catchments(
@@ -762,18 +1314,15 @@ def align_catchments(
     align catchments of catchment index list in a table.
     """
     if parallel:
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            gdf_result = pool.starmap(
-                align_single_catchment, zip(list_id, repeat(table))
-            )
-            pool.close()
-            pool.join()
+        gdf_result = utils.parallel_map(
+            align_single_catchment, zip(list_id, repeat(table)), star=True
+        )
         gdf_concat = pd.concat(gdf_result, ignore_index=True)
     else:
-        gdf_concat = gpd.GeoDataFrame(geometry=gpd.GeoSeries())
-        for catch_id in list_id:
-            gdf_result = align_single_catchment(catch_id, table)
-            gdf_concat = pd.concat([gdf_concat, gdf_result], ignore_index=True)
+        gdf_result = [align_single_catchment(catch_id, table) for catch_id in list_id]
+        gdf_concat = pd.concat(
+            [gpd.GeoDataFrame(geometry=gpd.GeoSeries())] + gdf_result, ignore_index=True
+        )
     return gdf_concat
 
 
@@ -783,9 +1332,11 @@ def refine_catchments(
     trim: bool = False,
     parallel: bool = True,
     gpkg: bool = False,
+    tiled: bool = True,
 ) -> None:
     """
     refine sea draining catchments data, remove holes, silvers, and spikes between polygons, and save to local database.
+    the gaps are found tile by tile unless tiled is False, see `find_gaps`.
     """
     assert (
         table.__tablename__ in GAP_TABLE_MAPPING.keys()
@@ -809,7 +1360,9 @@ def refine_catchments(
             utils.save_gpkg(gdf, table.__tablename__ + "_trimmed")
 
     # find gaps between catchments and merge them into its largest adjacent catchments
-    gdf_gaps = find_gaps(gdf, table=GAP_TABLE_MAPPING[table.__tablename__], gpkg=gpkg)
+    gdf_gaps = find_gaps(
+        gdf, table=GAP_TABLE_MAPPING[table.__tablename__], gpkg=gpkg, tiled=tiled
+    )
     gdf = pd.concat([gdf, gdf_gaps], ignore_index=True)
     gdf = gdf.sort_values(by="area", ascending=False).reset_index(drop=True)
     gdf = merge_catchments(gdf, upper_area=merge_threshold)
@@ -915,11 +1468,11 @@ def gen_coast_catchments(
         hole_threshold=100 * 100,
     )
     # cut into grid catchments
-    list_fishnet = utils.fishnet(geom_coast, threshold=COAST_GRID)
+    gs_fishnet = utils.fishnet(geom_coast, threshold=COAST_GRID, crs=2193)
     gdf_grid = gpd.GeoDataFrame(
-        index=range(COAST_OFFSET, COAST_OFFSET + len(list_fishnet)),
+        index=range(COAST_OFFSET, COAST_OFFSET + len(gs_fishnet)),
         crs="epsg:2193",
-        geometry=list_fishnet,
+        geometry=gs_fishnet.values,
     )
     gdf_grid = gdf_grid.reset_index().rename(columns={"index": "catch_id"})
     gdf_grid["area"] = gdf_grid["geometry"].area
@@ -1070,13 +1623,10 @@ def split_catchment(gds: Union[pd.Series, gpd.GeoSeries]) -> tuple:
 
         step += 1
         if rest_area > UPPER_AREA:
-            list_katana = []
-            for geom in geom_dif.geoms:
-                list_result = utils.katana(geom, threshold=UPPER_AREA)
-                list_katana.extend(list_result)
-            gdf_rest = gpd.GeoDataFrame(
-                index=range(len(list_katana)), crs="epsg:2193", geometry=list_katana
+            gs_katana = utils.katana(
+                shapely.get_parts(geom_dif), threshold=UPPER_AREA, crs=2193
             )
+            gdf_rest = gpd.GeoDataFrame(geometry=gs_katana)
             gdf_rest["area"] = gdf_rest["geometry"].area
             gdf_rest = gdf_rest[
                 gdf_rest["area"] > LOWER_AREA * 20
@@ -1119,13 +1669,53 @@ def split_catchment(gds: Union[pd.Series, gpd.GeoSeries]) -> tuple:
     return gdf_concat, gdf_split
 
 
+def split_catchment_rows(gds: Union[pd.Series, gpd.GeoSeries]) -> gpd.GeoDataFrame:
+    """Split catchment into smaller catchments, return the split catchments only, see `split_catchment`."""
+    return split_catchment(gds)[0]
+
+
+def get_split_keys(gdf: gpd.GeoDataFrame) -> list:
+    """
+    Get the key of each catchment to split, as the hash of the catchment and its subordinate catchments,
+    the subordinate catchments are searched as `split_catchment` does.
+    """
+    buffer = CATCHMENT_RESOLUTION * 20  # same as split_catchment
+    engine = utils.get_database()
+    list_sub = [
+        tables.read_postgis_table(engine, t) for t in [tables.ORDER5P, tables.ORDER4P]
+    ]
+    engine.dispose()
+    buffered = shapely.buffer(gdf["geometry"].to_numpy(), buffer, join_style="mitre")
+    list_key = [
+        f"{catch_id}:{geom_hash}"
+        for catch_id, geom_hash in zip(
+            gdf["catch_id"], utils.get_geometry_hash(gdf["geometry"])
+        )
+    ]
+    for gdf_sub in list_sub:
+        sub_hash = utils.get_geometry_hash(gdf_sub["geometry"])
+        source, sub = shapely.STRtree(gdf_sub["geometry"].to_numpy()).query(
+            buffered, predicate="contains"
+        )
+        df = pd.DataFrame(
+            {"source": source, "hash": [sub_hash[j] for j in sub]}
+        ).sort_values(by=["source", "hash"])
+        dict_hash = df.groupby("source")["hash"].apply(",".join).to_dict()
+        list_key = [f"{key}|{dict_hash.get(i, '')}" for i, key in enumerate(list_key)]
+    return list_key
+
+
 # @utils.timeit  # 0:04:32.662574
-def gen_catchment_table(parallel: bool = True, gpkg: bool = False) -> None:
+def gen_catchment_table(
+    parallel: bool = True, gpkg: bool = False, cache: bool = True
+) -> None:
     """
     Generate catchment table from SDC table and its subordinate tables.
 
     :param parallel: whether to use parallel computing
     :param gpkg: whether to save the result to GPKG
+    :param cache: reuse the split result of a catchment from `catchment_temporary_split_cache` table
+        if the catchment and its subordinate catchments are unchanged
     :return: None
     """
     logger.info("Generating catchment table content...")
@@ -1152,18 +1742,34 @@ def gen_catchment_table(parallel: bool = True, gpkg: bool = False) -> None:
     logger.debug(
         f"Splitting catchments catch_id:\n{gdf_to_split['catch_id'].to_list()}"
     )
-    if parallel:
-        list_gds = [gds for _, gds in gdf_to_split.iterrows()]
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            list_result = pool.map(split_catchment, list_gds)
-        for gdf_to_db_row, gdf_split_row in list_result:
-            gdf_to_db = pd.concat([gdf_to_db, gdf_to_db_row], ignore_index=True)
-            gdf_split = pd.concat([gdf_split, gdf_split_row], ignore_index=True)
+    list_gds = [gds for _, gds in gdf_to_split.iterrows()]
+    if cache:
+        list_key = get_split_keys(gdf_to_split)
+        engine = utils.get_database()
+        list_result = map_with_cache(
+            engine,
+            f"{tables.CATCHTEMP.__tablename__}_split_cache",
+            split_catchment_rows,
+            [(gds,) for gds in list_gds],
+            list_key,
+            parallel=parallel,
+        )
+        engine.dispose()
+        list_result = [
+            (result, result.assign(super_id=gds["catch_id"]))
+            for result, gds in zip(list_result, list_gds)
+        ]
+    elif parallel:
+        list_result = utils.parallel_map(split_catchment, list_gds)
     else:
-        for _, gds_row in gdf_to_split.iterrows():
-            gdf_to_db_row, gdf_split_row = split_catchment(gds_row)
-            gdf_to_db = pd.concat([gdf_to_db, gdf_to_db_row], ignore_index=True)
-            gdf_split = pd.concat([gdf_split, gdf_split_row], ignore_index=True)
+        list_result = [split_catchment(gds) for gds in list_gds]
+    # collect the results and concatenate once
+    gdf_to_db = pd.concat(
+        [gdf_to_db] + [result[0] for result in list_result], ignore_index=True
+    )
+    gdf_split = pd.concat(
+        [gdf_split] + [result[1] for result in list_result], ignore_index=True
+    )
 
     if gpkg:  # for debug
         utils.save_gpkg(gdf_to_db, tables.CATCHTEMP.__tablename__ + "_split")
@@ -1211,11 +1817,11 @@ def gen_grid_table(
     gdf_land = gdf_land.to_crs(epsg=2193)
     geom_land_ex = gdf_land["geometry"].buffer(coast_distance).unary_union
     # cut into grid
-    list_fishnet = utils.fishnet(geom_land_ex, threshold=GRID_SIZE, lrbu=True)
+    gs_fishnet = utils.fishnet(geom_land_ex, threshold=GRID_SIZE, lrbu=True, crs=2193)
     gdf_grid = gpd.GeoDataFrame(
-        index=range(len(list_fishnet)),
+        index=range(len(gs_fishnet)),
         crs="epsg:2193",
-        geometry=list_fishnet,
+        geometry=gs_fishnet.values,
     )
     gdf_grid = gdf_grid.reset_index().rename(columns={"index": "catch_id"})
     gdf_grid["area"] = gdf_grid["geometry"].area
@@ -1285,7 +1891,297 @@ def drop_temp_table(table: Union[list, str, Type[tables.Ttable]]) -> None:
 #     logger.info(f"\n-------------- Catchment Process Finished! ----------------")
 
 
-def run(gpkg: bool = False) -> None:
+def get_stages(
+    gpkg: bool = False,
+    refresh: bool = False,
+    incremental: bool = True,
+    tiled: bool = True,
+) -> list:
+    """
+    Get the stages of catchments pipeline in order, as (name, function, sources, targets), named as STAGE_NAMES.
+    sources and targets are the tables (or files) a stage reads and writes.
+
+    :param gpkg: whether to save the result to GPKG
+    :param refresh: whether to fetch data from data.mfe.govt.nz rather than local cache
+    :param incremental: whether to reuse the cached results of unchanged catchments in extend and split stages
+    :param tiled: whether to find gaps tile by tile in refine stages, see `find_gaps`
+    """
+    data_dir = pathlib.Path(utils.get_env_variable("DATA_DIR"))
+    land_path = data_dir / pathlib.Path(utils.get_env_variable("LAND_FILE"))
+    return [
+        (
+            "fetch",
+            lambda: initiate_tables(gpkg=gpkg, refresh=refresh),
+            [],
+            [tables.SDC, tables.ORDER5, tables.ORDER4],
+        ),
+        (
+            "deduplicate_source",
+            lambda: deduplicate_table(
+                [tables.SDC, tables.ORDER5, tables.ORDER4],
+                [tables.SDCP, tables.ORDER5P, tables.ORDER4P],
+            ),
+            [tables.SDC, tables.ORDER5, tables.ORDER4],
+            [tables.SDCP, tables.ORDER5P, tables.ORDER4P],
+        ),
+        (
+            "extend_sdcp",
+            lambda: extend_catchments(tables.SDCP, gpkg=gpkg, cache=incremental),
+            [tables.SDCP],
+            [tables.SDCP],
+        ),
+        (
+            "deduplicate_sdcp",
+            lambda: deduplicate_table(tables.SDCP, tables.SDCP, buffer=-EPS, gpkg=gpkg),
+            [tables.SDCP],
+            [tables.SDCP],
+        ),
+        (
+            "refine_sdcp",
+            lambda: refine_catchments(
+                tables.SDCP, trim=True, gpkg=gpkg, tiled=tiled
+            ),
+            [tables.SDCP, tables.SDC],
+            [tables.SDCP, tables.SDCG],
+        ),
+        (
+            "refine_sub",
+            lambda: refine_sub_catchments(gpkg=gpkg),
+            [tables.SDCP, tables.ORDER5P, tables.ORDER4P],
+            [tables.ORDER5P, tables.ORDER4P],
+        ),
+        (
+            "split",
+            lambda: gen_catchment_table(gpkg=gpkg, cache=incremental),
+            [tables.SDCP, tables.ORDER5P, tables.ORDER4P],
+            [tables.CATCHTEMP, tables.SDCS],
+        ),
+        (
+            "extend_catchtemp",
+            lambda: extend_catchments(tables.CATCHTEMP, gpkg=gpkg, cache=incremental),
+            [tables.CATCHTEMP],
+            [tables.CATCHTEMP],
+        ),
+        (
+            "deduplicate_catchtemp",
+            lambda: deduplicate_table(
+                tables.CATCHTEMP, tables.CATCHMENT, buffer=-EPS, gpkg=gpkg
+            ),
+            [tables.CATCHTEMP],
+            [tables.CATCHMENT],
+        ),
+        (
+            "refine_catchment",
+            lambda: refine_catchments(tables.CATCHMENT, gpkg=gpkg, tiled=tiled),
+            [tables.CATCHMENT, tables.SDC],
+            [tables.CATCHMENT, tables.CATCHMENTG],
+        ),
+        (
+            "coast",
+            lambda: gen_coast_catchments(gpkg=gpkg),
+            [tables.CATCHMENT],
+            [tables.CATCHMENT, tables.COAST],
+        ),
+        ("grid", lambda: gen_grid_table(gpkg=gpkg), [land_path], [tables.GRID]),
+    ]
+
+
+def get_stage_fingerprint(engine: Engine, items: list) -> str:
+    """
+    Get the fingerprint of the sources or targets of a stage,
+    as the row count plus geometry hash of each table, and the size plus modified time of each file.
+    """
+    list_fingerprint = []
+    for item in items:
+        if isinstance(item, pathlib.Path):
+            if item.is_file():
+                stat = item.stat()
+                fingerprint = f"{stat.st_size}_{stat.st_mtime_ns}"
+            else:
+                fingerprint = "missing"
+            list_fingerprint.append(f"{item.name}:{fingerprint}")
+        else:
+            if tables.is_table_exist(engine, item):
+                fingerprint = tables.get_table_fingerprint(engine, item, column="geometry")
+            else:
+                fingerprint = "missing"
+            list_fingerprint.append(f"{item.__tablename__}:{fingerprint}")
+    return ";".join(list_fingerprint)
+
+
+def save_catchment_change(engine: Engine, df_change: pd.DataFrame) -> None:
+    """
+    Save the changed catchments of a run to catchment_change table, replacing those of the previous run.
+    the DEMs of the added and modified catchments can be rebuilt by the runners of process module, e.g.
+    `process.run_hydro(catch_id=get_changed_catchments(engine), table=tables.CATCHMENT, update=True)`.
+    """
+    logger.info(
+        f"Catchments changed in this run: {df_change['change'].value_counts().to_dict()}."
+    )
+    df_change = df_change.assign(created_at=pd.Timestamp.now())
+    tables.create_table(engine, tables.CHANGE)
+    tables.delete_table(engine, tables.CHANGE)
+    df_change.to_sql(tables.CHANGE.__tablename__, engine, index=False, if_exists="append")
+
+
+def get_changed_catchments(engine: Engine, removed: bool = False) -> list:
+    """
+    Get catch_id of the added and modified catchments of the latest run from catchment_change table.
+
+    :param engine: database engine
+    :param removed: get the removed catchments instead
+    """
+    if not tables.is_table_exist(engine, tables.CHANGE):
+        return []
+    condition = "= 'removed'" if removed else "<> 'removed'"
+    query = f"""SELECT catch_id FROM {tables.CHANGE.__tablename__}
+                WHERE change {condition} ORDER BY catch_id ;"""
+    return pd.read_sql(query, engine)["catch_id"].to_list()
+
+
+def _get_item_name(item: Union[pathlib.Path, Type[tables.Ttable]]) -> str:
+    """Get the name of a source or target of a stage, as in the stage fingerprint."""
+    return item.name if isinstance(item, pathlib.Path) else item.__tablename__
+
+
+def _split_fingerprint(fingerprint: str) -> dict:
+    """Split the fingerprint of a stage into the fingerprint of each item, keyed by item name."""
+    return {f.split(":", 1)[0]: f for f in fingerprint.split(";") if f} if fingerprint else {}
+
+
+def run_stages(
+    stages: list, from_stage: str = None, to_stage: str = None, force: bool = False
+) -> list:
+    """
+    Run stages of a pipeline in order, the stages to run are planned before running any of them.
+    The input fingerprint of a stage is the fingerprint of each source recorded by the last stage writing it
+    before, or the current fingerprint if no stage writes it before, so it does not depend on the later stages
+    rewriting the tables in place. A stage is run if it is forced, it is the from_stage,
+    it has no record of completion, or its input fingerprint changed. It is also run if:
+    - it reads a table written by a stage to run before it,
+    - it is the last stage writing a table, and the table is changed since, e.g. by a failed stage,
+    - a stage to run after it reads its output, and the table is rewritten since, so the output is regenerated.
+    So a rerun with nothing changed skips all stages, and a rerun after a failed stage resumes from it.
+    The completion, fingerprints and runtime of each stage are recorded in stage table.
+
+    :param stages: list of (name, function, sources, targets), see `get_stages`
+    :param from_stage: name of the first stage to run, it is run even if unchanged, default is the first stage
+    :param to_stage: name of the last stage to run, default is the last stage
+    :param force: run all stages regardless of the fingerprints
+    :return: names of the stages run
+    """
+    list_name = [stage[0] for stage in stages]
+    start = list_name.index(from_stage) if from_stage else 0
+    end = list_name.index(to_stage) + 1 if to_stage else len(stages)
+    assert start < end, f"from stage {from_stage} is after to stage {to_stage}."
+    engine = utils.get_database()
+    records = {name: tables.get_stage(engine, f"catchments.{name}") for name in list_name}
+    current = {}
+
+    def get_current(item) -> str:
+        """current fingerprint of an item, cached until a stage writes it."""
+        if _get_item_name(item) not in current:
+            current[_get_item_name(item)] = get_stage_fingerprint(engine, [item])
+        return current[_get_item_name(item)]
+
+    def get_writer(i: int, item) -> Union[int, None]:
+        """the last stage writing the item before stage i."""
+        return next((j for j in range(i - 1, -1, -1) if item in stages[j][3]), None)
+
+    def get_output(j: int, item) -> str:
+        """the fingerprint of the item recorded by stage j."""
+        record = records[list_name[j]]
+        output = _split_fingerprint(record["output_fingerprint"] if record else None)
+        return output.get(_get_item_name(item), f"{_get_item_name(item)}:unknown")
+
+    def get_input_fingerprint(i: int) -> str:
+        """the input fingerprint of stage i."""
+        list_fingerprint = []
+        for item in stages[i][2]:
+            j = get_writer(i, item)
+            list_fingerprint.append(get_current(item) if j is None else get_output(j, item))
+        return ";".join(list_fingerprint)
+
+    def get_reason(i: int, to_run: set) -> Union[str, None]:
+        """the reason to run stage i, None if it can be skipped."""
+        name, _, sources, targets = stages[i]
+        if records[name] is None:
+            return "it has no record of completion"
+        if records[name]["input_fingerprint"] != get_input_fingerprint(i):
+            return "its inputs changed"
+        for item in sources:
+            if get_writer(i, item) in to_run:
+                return f"{_get_item_name(item)} is written by stage {list_name[get_writer(i, item)]} before it"
+        for item in targets:
+            last = get_writer(len(stages), item) == i
+            if last and get_current(item) != get_output(i, item):
+                return f"{_get_item_name(item)} is changed since it finished"
+        for k in sorted(to_run):
+            for item in stages[k][2]:
+                if k > i and get_writer(k, item) == i and get_current(item) != get_output(i, item):
+                    return f"stage {list_name[k]} reads {_get_item_name(item)} which is rewritten since"
+        return None
+
+    if force:
+        to_run = set(range(start, end))
+    else:
+        to_run = {start} if from_stage else set()
+    changed = True
+    while changed:
+        changed = False
+        for i in range(start, end):
+            if i in to_run:
+                continue
+            reason = get_reason(i, to_run)
+            if reason is not None:
+                logger.info(f"Plan to run stage catchments.{list_name[i]}, as {reason}.")
+                to_run.add(i)
+                changed = True
+    for k in sorted(to_run):
+        for item in stages[k][2]:
+            j = get_writer(k, item)
+            if j is not None and j < start and get_current(item) != get_output(j, item):
+                logger.warning(
+                    f"Stage catchments.{list_name[k]} reads {_get_item_name(item)} which is rewritten "
+                    f"since stage catchments.{list_name[j]}, run from that stage to regenerate it."
+                )
+
+    list_run = []
+    for i in range(start, end):
+        name, func, sources, targets = stages[i]
+        stage = f"catchments.{name}"
+        if i not in to_run:
+            logger.info(
+                f"Skip stage {stage}, it is unchanged since {records[name]['finished_at']}."
+            )
+            continue
+        logger.info(f"Start stage {stage} ...")
+        input_fingerprint = get_input_fingerprint(i)
+        started_at = pd.Timestamp.now()
+        func()
+        list_run.append(name)
+        for item in targets:
+            current.pop(_get_item_name(item), None)
+        output_fingerprint = get_stage_fingerprint(engine, targets)
+        tables.finish_stage(
+            engine, stage, input_fingerprint, output_fingerprint, started_at
+        )
+        records[name] = tables.get_stage(engine, stage)
+        logger.info(f"Finish stage {stage} in {pd.Timestamp.now() - started_at}.")
+    engine.dispose()
+    gc.collect()
+    return list_run
+
+
+def run(
+    gpkg: bool = False,
+    from_stage: str = None,
+    to_stage: str = None,
+    force: bool = False,
+    refresh: bool = False,
+    incremental: bool = True,
+    tiled: bool = True,
+) -> None:
     """
     fetch sea draining catchment, order 5 catchment and order 4 catchment data from data.mfe.govt.nz.
     process the data to generate catchment table by following steps:
@@ -1300,26 +2196,73 @@ def run(gpkg: bool = False) -> None:
     9. refine catchment table to eliminate gaps among catchments
     10. generate coastal catchments and save to catchment table
     the catchments in catchment table are aligned and gap free, ready to be used for further processing.
+    the stages with unchanged inputs and outputs since their last run are skipped, see `run_stages`.
 
     :param gpkg: whether to save the result to GPKG
+    :param from_stage: name of the first stage to run, see `get_stages`, default is the first stage
+    :param to_stage: name of the last stage to run, default is the last stage
+    :param force: run all stages regardless of the fingerprints
+    :param refresh: fetch data from data.mfe.govt.nz rather than local cache, and run from the fetch stage
+    :param incremental: reuse the cached results of unchanged catchments in extend and split stages,
+        so only the changed catchments and their adjacent catchments are processed.
+        the deduplicate, refine and coast stages are not incremental, they still process the whole table
+        whenever they run, and they are only skipped if their inputs are unchanged, see `run_stages`
+    :param tiled: find gaps tile by tile in refine stages, or over the union of all catchments if False
     """
-    initiate_tables(gpkg=gpkg)
-    deduplicate_table(
-        [tables.SDC, tables.ORDER5, tables.ORDER4],
-        [tables.SDCP, tables.ORDER5P, tables.ORDER4P],
-    )
-    extend_catchments(tables.SDCP, gpkg=gpkg)
-    deduplicate_table(tables.SDCP, tables.SDCP, buffer=-EPS, gpkg=gpkg)
-    refine_catchments(tables.SDCP, trim=True, gpkg=gpkg)
-    refine_sub_catchments(gpkg=gpkg)
-    gen_catchment_table(gpkg=gpkg)
-    extend_catchments(tables.CATCHTEMP, gpkg=gpkg)
-    deduplicate_table(tables.CATCHTEMP, tables.CATCHMENT, buffer=-EPS, gpkg=gpkg)
-    refine_catchments(tables.CATCHMENT, gpkg=gpkg)
-    gen_coast_catchments(gpkg=gpkg)
-    gen_grid_table(gpkg=gpkg)
+    if refresh and from_stage is None:
+        from_stage = "fetch"
+    engine = utils.get_database()
+    if tables.is_table_exist(engine, tables.CATCHMENT):
+        df_old = tables.get_geometry_hash(engine, tables.CATCHMENT)
+    else:
+        df_old = pd.DataFrame(
+            {"catch_id": pd.Series(dtype=int), "hash": pd.Series(dtype=str)}
+        )
+    list_run = run_stages(
+        get_stages(
+            gpkg=gpkg, refresh=refresh, incremental=incremental, tiled=tiled
+        ),
+        from_stage=from_stage,
+        to_stage=to_stage,
+        force=force,
+    )
+    # keep the changes of the previous run if nothing is run
+    if list_run and tables.is_table_exist(engine, tables.CATCHMENT):
+        df_new = tables.get_geometry_hash(engine, tables.CATCHMENT)
+        save_catchment_change(engine, diff_geometry_hash(df_old, df_new))
+    engine.dispose()
     logger.info(f"\n-------------- Catchment Process Finished! ----------------")
 
 
 if __name__ == "__main__":
-    run(gpkg=True)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate catchment and grid tables.")
+    parser.add_argument("--from-stage", choices=STAGE_NAMES, help="first stage to run")
+    parser.add_argument("--to-stage", choices=STAGE_NAMES, help="last stage to run")
+    parser.add_argument(
+        "--force", action="store_true", help="run stages even if they are unchanged"
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="fetch data from MFE instead of cache"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="process all catchments instead of reusing the results of unchanged ones",
+    )
+    parser.add_argument(
+        "--untiled",
+        action="store_true",
+        help="find gaps over the union of all catchments instead of tile by tile",
+    )
+    args = parser.parse_args()
+    run(
+        gpkg=True,
+        from_stage=args.from_stage,
+        to_stage=args.to_stage,
+        force=args.force,
+        refresh=args.refresh,
+        incremental=not args.full,
+        tiled=not args.untiled,
+    )
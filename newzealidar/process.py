@@ -8,21 +8,27 @@ Prerequisites:
 * dataset table is ready: run datasets module to download dataset metadata and extent files to local storage.
 * lidar and tile files and tables is ready: run lidar module to download lidar data and save to local database.
 """
+import copy
 import gc
 import json
 import logging
 import math
+import multiprocessing
 import os
 from pathlib import Path, PurePosixPath
 from datetime import datetime, timedelta
-from typing import Union, Type
+from functools import partial
+from typing import Callable, Iterable, Union, Type
 import shutil
+import threading
 
 import geopandas as gpd
 import pandas as pd
+import shapely
 from geofabrics.runner import from_instructions_dict
 from sqlalchemy.engine import Engine
 
+from newzealidar import logs
 from newzealidar import rivers
 from newzealidar import utils
 from newzealidar.tables import (
@@ -33,7 +39,6 @@ from newzealidar.tables import (
     DEM,
     DEMATTR,
     USERDEM,
-    DATASET,
     RIVER,
     GRID,
     GRIDDEM,
@@ -43,10 +48,33 @@ from newzealidar.tables import (
     get_split_catchment_by_id,
     get_id_under_area,
     get_catchment_by_geometry,
+    get_split_mapping,
+    is_table_exist,
+    insert_rows,
+    upsert_rows,
+    migrate_table,
+    enqueue_jobs,
+    requeue_jobs,
+    heartbeat_jobs,
+    claim_jobs,
+    finish_job,
+    get_job_summary,
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_HEARTBEAT,
+    JOB_STALE,
 )
 
 logger = logging.getLogger(__name__)
 
+# status of each catchment processed by worker
+DONE = JOB_DONE
+SKIPPED = "skipped"
+FAILED = JOB_FAILED
+
+# state of the worker process, initialised once for each worker by `_init_worker`
+_worker = {}
+
 
 def save_instructions(instructions: dict, instructions_path: str) -> None:
     """save instructions to json file."""
@@ -75,8 +103,12 @@ def gen_instructions(
     geometry: gpd.GeoDataFrame = None,
     grid: bool = False,
     buffer: Union[int, float] = 0,
+    river: pd.DataFrame = None,
 ) -> Union[dict, None]:
-    """Read basic instruction file and adds keys and uses geojson as catchment_boundary"""
+    """
+    Read basic instruction file and adds keys and uses geojson as catchment_boundary.
+    The river row of the catchment is read from database if it is not prefetched as `river`.
+    """
     # prep
     if isinstance(geometry, gpd.GeoDataFrame):
         area = math.ceil(geometry.unary_union.area)
@@ -111,7 +143,7 @@ def gen_instructions(
     if grid:  # grid dem does not need river data
         instructions.pop("rivers")
     if instructions.get("rivers"):
-        gdf_river = get_data_by_id(engine, RIVER, index, geom_col="osm_geometry")
+        gdf_river = get_data_by_id(engine, RIVER, index, geom_col="osm_geometry") if river is None else river
         if not gdf_river.empty:
             if not instructions["rivers"].get("data_paths"):
                 instructions["rivers"]["data_paths"] = {}
@@ -221,11 +253,12 @@ def single_process(
     geometry: gpd.GeoDataFrame = None,
     grid: bool = False,
     buffer: Union[int, float] = 0,
+    river: pd.DataFrame = None,
 ) -> Union[dict, None]:
     """the gen_dem process in a single row of geodataframe"""
     logger.info(f"\n\n******* Processing {index} in {mode} mode with geometry buffer {buffer} *******")
     single_instructions = gen_instructions(
-        engine, instructions, index, mode=mode, grid=grid, geometry=geometry, buffer=buffer
+        engine, instructions, index, mode=mode, grid=grid, geometry=geometry, buffer=buffer, river=river
     )
     result_path = Path(single_instructions["default"]["data_paths"]["local_cache"]) / Path(
         single_instructions["dem"]["data_paths"]["subfolder"]
@@ -289,103 +322,65 @@ def store_hydro_to_db(engine: Engine, instructions: dict, user_dem: bool = False
             f"Do not store hydrological conditioned dem to database."
         )
         return False
-    timestamp = pd.Timestamp.now().strftime("%Y-%m-%d %X")
+    timestamp = pd.Timestamp.now()
+    resolution = instructions["default"]["output"]["grid_params"]["resolution"]
+    raw_geometry = (gpd.read_file(raw_extent_path, driver="GeoJSON")).unary_union
+    dem_geometry = (gpd.read_file(dem_extent_path, driver="GeoJSON")).unary_union
 
     # save to hydrologically conditioned DEM table
     if user_dem:  # for user define catchment
         create_table(engine, USERDEM)
-        resolution = instructions["default"]["output"]["grid_params"]["resolution"]
-        raw_geometry = (gpd.read_file(raw_extent_path, driver="GeoJSON")).unary_union
-        dem_geometry = (gpd.read_file(dem_extent_path, driver="GeoJSON")).unary_union
-        query = f"""INSERT INTO {USERDEM.__tablename__} (
-                    catch_id,
-                    resolution,
-                    raw_dem_path,
-                    hydro_dem_path,
-                    extent_path,
-                    raw_geometry,
-                    geometry,
-                    created_at
-                    ) VALUES (
-                    {index},
-                    '{resolution}',
-                    '{raw_dem_path}',
-                    '{result_dem_path}',
-                    '{dem_extent_path}',
-                    '{raw_geometry}',
-                    '{dem_geometry}',
-                    '{timestamp}'
-                    ) ;"""
-        engine.execute(query)
+        row = {
+            "catch_id": int(index),
+            "resolution": resolution,
+            "raw_dem_path": raw_dem_path,
+            "hydro_dem_path": result_dem_path,
+            "extent_path": dem_extent_path,
+            "raw_geometry": raw_geometry,
+            "geometry": dem_geometry,
+            "created_at": timestamp,
+        }
+        insert_rows(engine, USERDEM, row)
         logger.info(f"Add new {index} in {USERDEM.__tablename__} at {timestamp}.")
     else:  # for catchment table
-        query = f"SELECT * FROM {DEM.__tablename__} WHERE catch_id = '{index}' ;"
-        df_from_db = pd.read_sql(query, engine)
-        if not df_from_db.empty:
-            query = f"""UPDATE {DEM.__tablename__}
-                        SET raw_dem_path = '{raw_dem_path}',
-                            hydro_dem_path = '{result_dem_path}',
-                            extent_path = '{dem_extent_path}',
-                            updated_at = '{timestamp}'
-                        WHERE catch_id = '{index}' ;"""
-            engine.execute(query)
-            logger.info(f"Updated {index} in {DEM.__tablename__} at {timestamp}.")
-        else:
-            query = f"""INSERT INTO {DEM.__tablename__} (
-                        catch_id,
-                        raw_dem_path,
-                        hydro_dem_path,
-                        extent_path,
-                        created_at,
-                        updated_at
-                        ) VALUES (
-                        {index},
-                        '{raw_dem_path}',
-                        '{result_dem_path}',
-                        '{dem_extent_path}',
-                        '{timestamp}',
-                        '{timestamp}'
-                        ) ;"""
-            engine.execute(query)
+        row = {
+            "catch_id": int(index),
+            "raw_dem_path": raw_dem_path,
+            "hydro_dem_path": result_dem_path,
+            "extent_path": dem_extent_path,
+            "created_at": timestamp,
+            "updated_at": timestamp,
+        }
+        upsert_rows(engine, DEM, row)
 
         # hydrologically conditioned DEM geometry table, to faster query
         create_table(engine, DEMATTR)
-        resolution = instructions["default"]["output"]["grid_params"]["resolution"]
-        raw_geometry = (gpd.read_file(raw_extent_path, driver="GeoJSON")).unary_union
-        dem_geometry = (gpd.read_file(dem_extent_path, driver="GeoJSON")).unary_union
-        query = f"SELECT catch_id FROM {DEMATTR.__tablename__} WHERE catch_id = '{index}' ;"
-        df_from_db = pd.read_sql(query, engine)
-        if not df_from_db.empty:
-            query = f"""UPDATE {DEMATTR.__tablename__}
-                        SET raw_geometry = '{raw_geometry}',
-                            resolution = '{resolution}',
-                            geometry = '{dem_geometry}',
-                            updated_at = '{timestamp}'
-                        WHERE catch_id = '{index}' ;"""
-            engine.execute(query)
-            logger.info(f"Updated {index} in {DEMATTR.__tablename__} at {timestamp}.")
-        else:
-            query = f"""INSERT INTO {DEMATTR.__tablename__} (
-                        catch_id,
-                        resolution,
-                        raw_geometry,
-                        geometry,
-                        created_at,
-                        updated_at
-                        ) VALUES (
-                        {index},
-                        '{resolution}',
-                        '{raw_geometry}',
-                        '{dem_geometry}',
-                        '{timestamp}',
-                        '{timestamp}'
-                        ) ;"""
-            engine.execute(query)
-        logger.info(f"Add new {index} in {DEMATTR.__tablename__} at {timestamp}.")
+        row = {
+            "catch_id": int(index),
+            "resolution": resolution,
+            "raw_geometry": raw_geometry,
+            "geometry": dem_geometry,
+            "created_at": timestamp,
+            "updated_at": timestamp,
+        }
+        upsert_rows(engine, DEMATTR, row)
+        logger.info(f"Upsert {index} in {DEM.__tablename__} and {DEMATTR.__tablename__} at {timestamp}.")
     # check_table_duplication(engine, table, 'catch_id')
     return True
 
 
+def store_result_to_db(store: Callable, engine: Engine, instructions: dict, name: str) -> bool:
+    """
+    Save the result of a finished job to database by the store function, return False if it fails,
+    the database error is caught so that the job is marked as failed rather than left running in queue mode.
+    """
+    try:
+        return store(engine, instructions) is not False
+    except Exception as e:
+        logger.exception(f"{name} failed to store to database. Error message:\n{e}")
+        return False
+
+
 def store_grid_to_db(engine: Engine, instructions: dict) -> None:
     """save hydrological conditioned dem to database in hydro table."""
     assert len(instructions) > 0, "instructions is empty dictionary."
@@ -407,69 +402,33 @@ def store_grid_to_db(engine: Engine, instructions: dict) -> None:
     assert os.path.exists(raw_extent_path), f"File {raw_extent_path} not exist."
     assert os.path.exists(dem_extent_path), f"File {dem_extent_path} not exist."
 
-    timestamp = pd.Timestamp.now().strftime("%Y-%m-%d %X")
+    timestamp = pd.Timestamp.now()
 
     create_table(engine, GRIDDEM)
-    query = f"SELECT * FROM {GRIDDEM.__tablename__} WHERE grid_id = '{index}' ;"
-    df_from_db = pd.read_sql(query, engine)
-    if not df_from_db.empty:
-        query = f"""UPDATE {GRIDDEM.__tablename__}
-                    SET raw_dem_path = '{raw_dem_path}',
-                        extent_path = '{dem_extent_path}',
-                        updated_at = '{timestamp}'
-                    WHERE grid_id = '{index}' ;"""
-        engine.execute(query)
-        logger.info(f"Updated {index} in {GRIDDEM.__tablename__} at {timestamp}.")
-    else:
-        query = f"""INSERT INTO {GRIDDEM.__tablename__} (
-                    grid_id,
-                    raw_dem_path,
-                    extent_path,
-                    created_at,
-                    updated_at
-                    ) VALUES (
-                    {index},
-                    '{raw_dem_path}',
-                    '{dem_extent_path}',
-                    '{timestamp}',
-                    '{timestamp}'
-                    ) ;"""
-        engine.execute(query)
+    row = {
+        "grid_id": int(index),
+        "raw_dem_path": raw_dem_path,
+        "extent_path": dem_extent_path,
+        "created_at": timestamp,
+        "updated_at": timestamp,
+    }
+    upsert_rows(engine, GRIDDEM, row, index_column="grid_id")
 
     # Grid DEM geometry table, to faster query
     create_table(engine, GRIDDEMATTR)
     resolution = instructions["default"]["output"]["grid_params"]["resolution"]
     raw_geometry = gpd.read_file(raw_extent_path, driver="GeoJSON").geometry[0]
     dem_geometry = gpd.read_file(dem_extent_path, driver="GeoJSON").geometry[0]
-    query = f"SELECT grid_id FROM {GRIDDEMATTR.__tablename__} WHERE grid_id = '{index}' ;"
-    df_from_db = pd.read_sql(query, engine)
-    if not df_from_db.empty:
-        query = f"""UPDATE {GRIDDEMATTR.__tablename__}
-                    SET raw_geometry = '{raw_geometry}',
-                        resolution = '{resolution}',
-                        geometry = '{dem_geometry}',
-                        updated_at = '{timestamp}'
-                    WHERE grid_id = '{index}' ;"""
-        engine.execute(query)
-        logger.info(f"Updated {index} in {GRIDDEMATTR.__tablename__} at {timestamp}.")
-    else:
-        query = f"""INSERT INTO {GRIDDEMATTR.__tablename__} (
-                    grid_id,
-                    resolution,
-                    raw_geometry,
-                    geometry,
-                    created_at,
-                    updated_at
-                    ) VALUES (
-                    {index},
-                    '{resolution}',
-                    '{raw_geometry}',
-                    '{dem_geometry}',
-                    '{timestamp}',
-                    '{timestamp}'
-                    ) ;"""
-        engine.execute(query)
-    logger.info(f"Add new {index} in {GRIDDEMATTR.__tablename__} at {timestamp}.")
+    row = {
+        "grid_id": int(index),
+        "resolution": resolution,
+        "raw_geometry": raw_geometry,
+        "geometry": dem_geometry,
+        "created_at": timestamp,
+        "updated_at": timestamp,
+    }
+    upsert_rows(engine, GRIDDEMATTR, row, index_column="grid_id")
+    logger.info(f"Upsert {index} in {GRIDDEM.__tablename__} and {GRIDDEMATTR.__tablename__} at {timestamp}.")
     # check_table_duplication(engine, table, 'catch_id')
 
 
@@ -525,15 +484,9 @@ def main(
             )
             return
 
-    lidar_extent_file = Path(utils.get_env_variable("DATA_DIR")) / Path("gpkg") / Path("lidar_extent.gpkg")
-    if lidar_extent_file.exists():
-        lidar_extent = gpd.read_file(lidar_extent_file, driver="GPKG")
-    else:
-        # generate lidar extent of all lidar datasets, to filter out catchments without lidar data
-        lidar_extent = utils.gen_table_extent(engine, DATASET)
-        # save lidar extent to check on QGIS
-        utils.save_gpkg(lidar_extent, "lidar_extent")
-    if lidar_extent.buffer(buffer).intersects(catchment_boundary).any():
+    # index lidar coverage of all lidar datasets, to filter out catchments without lidar data
+    coverage = utils.CoverageIndex.from_database(engine, buffer=buffer)
+    if coverage.covers(catchment_boundary):
         geojson_file = Path(result_dir) / Path(f"{index}") / Path(f"{index}.geojson")
         geojson_file.parent.mkdir(parents=True, exist_ok=True)
         if not Path(geojson_file).exists():
@@ -562,6 +515,322 @@ def main(
         gc.collect()
 
 
+def set_number_of_cores(instructions: dict, workers: int = 1, cores: int = None) -> dict:
+    """
+    Set number of cores of each GeoFabrics job.
+    By default, share the cpu cores of the machine equally between workers if there are multiple workers.
+    """
+    if cores is None and workers > 1:
+        cores = max(1, os.cpu_count() // workers)
+    if cores is not None:
+        instructions["default"]["processing"]["number_of_cores"] = cores
+    return instructions
+
+
+def _init_worker(**kwargs) -> None:
+    """Initialise the state of a worker, which is shared by all the catchments processed in the worker process."""
+    if multiprocessing.parent_process() is not None and os.getenv("LOG_CFG"):
+        logs.setup_logging()  # spawned worker process does not inherit logging configuration
+    _worker.clear()
+    _worker.update(kwargs)
+    _worker["engine"] = utils.get_database(null_pool=True)
+
+
+def _init_hydro_worker(**kwargs) -> None:
+    """Initialise the state of a hydro worker, index REC1 and flow data once per worker process."""
+    _init_worker(**kwargs)
+    if _worker["flow_path"].is_file():
+        gdf_flow = pd.read_csv(_worker["flow_path"])
+    else:
+        gdf_flow = None
+        logger.warning(f"Flow path {_worker['flow_path']} is not exist.")
+    if _worker["rec_path"].is_file():
+        columns = ["NZREACH", "CATCHAREA", "to_node", "from_node"]
+        # the GeoParquet cache is prepared by the main process, see run_hydro
+        gdf_rec = rivers.prep_rec(_worker["rec_path"], save=False, columns=columns)
+    else:
+        gdf_rec = None
+        logger.warning(f"REC1 path {_worker['rec_path']} is not exist.")
+    # join REC1 and flow data and index the reaches once per worker process
+    _worker["river_network"] = None
+    if gdf_rec is not None and gdf_flow is not None:
+        _worker["river_network"] = rivers.RiverNetworkIndex(gdf_rec, gdf_flow)
+
+
+def _run_single_process(index: int, name: str, **kwargs) -> tuple:
+    """Run single_process in a worker with a copy of the base instructions, catch the error of the catchment."""
+    instructions = copy.deepcopy(_worker["instructions"])
+    t_start = datetime.now()
+    try:
+        single_instructions = single_process(_worker["engine"], instructions, index, mode=_worker["mode"], **kwargs)
+    except Exception as e:
+        logger.exception(f"{name} {index} failed. Error message:\n{e}")
+        logger.error(
+            f"{name} {index} failed. Running instructions:" f"\n{json.dumps(instructions, indent=2, default=str)}"
+        )
+        return index, FAILED, None, None
+    if not single_instructions:
+        logger.error(f"{name} {index} failed. No instructions generated. Please check.")
+        return index, FAILED, None, None
+    return index, DONE, single_instructions, datetime.now() - t_start
+
+
+def _raw_task(item: tuple) -> tuple:
+    """Generate raw DEM of a catchment in catchment table, return (index, status, instructions, runtime)."""
+    index, payload = item
+    catch_path = _worker["catch_path"]
+    buffer = _worker["buffer"]
+    if _worker["update"]:
+        logger.warning(f"Update mode is on, will delete exist {index} directory and update existing info in database.")
+        shutil.rmtree(catch_path / Path(str(index)), ignore_errors=True)
+
+    # the catchments without lidar data are already filtered out by `filter_by_coverage`
+    catchment_boundary = payload["boundary"]
+    # to check if already exist in hydro_dem table, if exist_ok, run and update, else pass
+    # the job queue already excludes the finished catchments
+    exist_ok = _worker["update"] or _worker["queue"] or payload["dem"].empty
+
+    if not exist_ok:
+        logger.info(f"Catchment {index} already exist in hydro_dem table, ignor it.")
+        return index, SKIPPED, None, None
+
+    # generate catchment boundary file for each catchment
+    utils.gen_boundary_file(catch_path, catchment_boundary, index, buffer=buffer)
+    # generate hydrological conditioned dem for each catchment
+    return _run_single_process(index, "Catchment", buffer=buffer)
+
+
+def _grid_task(item: tuple) -> tuple:
+    """Generate raw DEM of a grid, return (index, status, instructions, runtime)."""
+    index, payload = item
+    buffer = _worker["buffer"]
+    if _worker["update"]:
+        logger.warning(f"Update mode is on, will delete exist {index} directory and update existing info in database.")
+        shutil.rmtree(Path(_worker["data_dir"]) / Path(str(index)), ignore_errors=True)
+    # the grids without lidar data or out of land are already filtered out by `filter_by_coverage`
+    grid_boundary = payload["boundary"]
+    # to check if already exist in grid table, if exist_ok is ture, run and update, else pass
+    exist_ok = _worker["update"] or _worker["queue"] or payload["dem"].empty
+
+    if not exist_ok:
+        logger.info(f"Grid {index} already exist in grid_dem table, ignor it.")
+        return index, SKIPPED, None, None
+
+    # generate grid boundary file for each grid
+    utils.gen_boundary_file(_worker["grid_path"], grid_boundary, index, buffer=buffer)
+    # generate raw dem for each grid
+    return _run_single_process(index, "Grid", grid=True, buffer=buffer)
+
+
+def _hydro_task(item: tuple) -> tuple:
+    """Generate hydrologically conditioned DEM of a catchment, return (index, status, instructions, runtime)."""
+    index, payload = item
+    engine = _worker["engine"]
+    buffer = _worker["buffer"]
+    catch_path = _worker["catch_path"]
+    catch_i_path = catch_path / str(index)
+    if _worker["update"]:
+        logger.warning(f"Update mode is on, will delete exist {index} directory and update existing info in database.")
+        shutil.rmtree(catch_i_path, ignore_errors=True)
+
+    # the catchments without lidar data are already filtered out by `filter_by_coverage`
+    catchment_boundary = payload["boundary"]
+    # to check if already exist in hydro_dem table, if exist_ok, run process and update result, else pass
+    gdf_dem = payload["dem"]
+    exist_ok = False
+    if gdf_dem.empty or _worker["update"] or not (Path(catch_i_path) / "river").is_dir():
+        exist_ok = True
+
+    if not exist_ok:
+        logger.info(f"Catchment {index} already exist in hydro_dem table, ignor it.")
+        return index, SKIPPED, None, None
+
+    # generate catchment boundary file for each catchment
+    utils.gen_boundary_file(catch_path, catchment_boundary, index, buffer=buffer)
+
+    if gdf_dem.empty or not Path(gdf_dem["raw_dem_path"].values[0]).is_file():
+        sub_list = payload["sub"]
+        logger.debug(f"Retrieved catchment {index} subordinates {sub_list}.")
+        sub_dem = payload["sub_dem"].set_index("catch_id")["raw_dem_path"].to_dict()
+        mis_id = []
+        for sub_id in sub_list:
+            if sub_id not in sub_dem or not Path(sub_dem[sub_id]).is_file():
+                logger.warning(f"Subordinate {sub_id} of catchment {index} is not exist, please check.")
+                mis_id.append(sub_id)
+                continue
+        if len(mis_id) == 0:
+            utils.get_dem_by_geometry(engine, catchment_boundary, index=index)
+        else:
+            logger.warning(f"Subordinate {mis_id} of catchment {index} is not exist, please check.")
+            return index, FAILED, None, None
+
+    # generate river network for the catchment
+    if not (Path(catch_i_path) / "river" / rivers.RIVER_NETWORK_FILE).is_file():
+        if _worker["river_network"] is not None:
+            _worker["river_network"].gen(catchment_boundary, Path(catch_i_path))
+        else:
+            logger.warning(f"Skip river network generation because REC1 and/or flow data do not exist")
+
+    # generate hydrological conditioned dem for each catchment
+    return _run_single_process(index, "Catchment", geometry=catchment_boundary, buffer=buffer, river=payload["river"])
+
+
+def filter_by_coverage(
+    boundaries: gpd.GeoDataFrame,
+    index: list,
+    coverage: utils.CoverageIndex,
+    index_column: str = "catch_id",
+    land: shapely.Geometry = None,
+) -> list:
+    """
+    Filter out the catchments without lidar data (or out of land) before processing,
+    the prefetched boundaries are checked in one vectorised call.
+    """
+    if not len(index):
+        return index
+    covered = set(coverage.filter(boundaries, index_column=index_column))
+    if land is not None:
+        covered &= set(boundaries.loc[boundaries.intersects(land), index_column])
+    ignored = [i for i in index if i not in covered]
+    if len(ignored):
+        logger.info(f"{len(ignored)} of {len(index)} catchments are not within lidar extent, ignor them.")
+        logger.debug(f"Not within lidar extent: {ignored}")
+    return [i for i in index if i in covered]
+
+
+def prefetch_catchments(
+    engine: Engine,
+    boundaries: gpd.GeoDataFrame,
+    index: list,
+    index_column: str = "catch_id",
+    dem_table: Type[Ttable] = DEM,
+    sub: bool = False,
+    river: bool = False,
+) -> dict:
+    """
+    Prefetch the data of all catchments in a handful of set-based queries, so the worker does no database read
+    for them. Return {index: payload}, where payload has the catchment boundary and the existing DEM rows,
+    and optionally the split subordinate ids with their DEM rows and the river rows.
+    """
+    def _split(df: pd.DataFrame, column: str) -> dict:
+        groups = {k: v for k, v in df.groupby(column)} if not df.empty else {}
+        return {i: groups.get(i, df.iloc[0:0]) for i in index}
+
+    if not len(index):
+        return {}
+    boundaries = _split(boundaries[boundaries[index_column].isin(index)], index_column)
+    dem = _split(get_data_by_id(engine, dem_table, index, index_column=index_column, geom_col=""), index_column)
+    payload = {i: {"boundary": boundaries[i], "dem": dem[i]} for i in index}
+    if sub:
+        split = get_split_mapping(engine, index)
+        sub_id = sorted(set(j for v in split.values() for j in v))
+        if len(sub_id):
+            sub_dem = get_data_by_id(engine, DEM, sub_id, geom_col="", columns="catch_id, raw_dem_path")
+        else:
+            sub_dem = pd.DataFrame(columns=["catch_id", "raw_dem_path"])
+        for i in index:
+            payload[i]["sub"] = split.get(i, [])
+            payload[i]["sub_dem"] = sub_dem[sub_dem["catch_id"].isin(payload[i]["sub"])]
+    if river:
+        if is_table_exist(engine, RIVER):
+            df_river = get_data_by_id(engine, RIVER, index, geom_col="", columns="catch_id, rec_id, osm_id")
+        else:
+            df_river = pd.DataFrame(columns=["catch_id", "rec_id", "osm_id"])
+        df_river = _split(df_river, "catch_id")
+        for i in index:
+            payload[i]["river"] = df_river[i]
+    return payload
+
+
+def claim_jobs_with_heartbeat(engine: Engine, job: str, index: list = None) -> Iterable:
+    """
+    Claim jobs one by one as `claim_jobs`, refresh the heartbeat of the running jobs of this process
+    in a background thread, see `heartbeat_jobs`.
+    The heartbeat goes on after the queue is drained until the claimed jobs are finished,
+    it stops if the iteration is closed early, e.g. by an error of the runner, or the process exits.
+    """
+    stop = threading.Event()
+    drained = threading.Event()
+
+    def beat():
+        while not stop.wait(JOB_HEARTBEAT.total_seconds()):
+            try:
+                running = heartbeat_jobs(engine, job)
+            except Exception as e:
+                logger.warning(f"Failed to refresh heartbeat of {job} jobs: {e}")
+                continue
+            if drained.is_set() and not running:
+                return
+
+    threading.Thread(target=beat, name=f"{job}-heartbeat", daemon=True).start()
+    try:
+        yield from claim_jobs(engine, job, index=index)
+        drained.set()
+    finally:
+        if not drained.is_set():
+            stop.set()
+
+
+def get_job_iterable(
+    engine: Engine,
+    job: str,
+    index: list,
+    queue: bool = False,
+    update: bool = False,
+    done_table: Type[Ttable] = None,
+    max_attempts: int = 3,
+    stale: timedelta = JOB_STALE,
+) -> Iterable:
+    """
+    Get the catchment ids to process.
+    In queue mode, the ids are enqueued in runtime table and claimed lazily one by one, so that a killed run
+    resumes from the unfinished jobs and multiple hosts can drain the same queue.
+    The running jobs of other alive runners are kept, see `requeue_jobs`.
+    """
+    if not queue:
+        return index
+    enqueue_jobs(engine, job, index, reset=update, done_table=None if update else done_table)
+    requeued = requeue_jobs(engine, job, max_attempts=max_attempts, stale=stale)
+    logger.info(f"Requeued {requeued} interrupted or failed {job} jobs. Queue status: {get_job_summary(engine, job)}")
+    return claim_jobs_with_heartbeat(engine, job, index=index)
+
+
+def save_extent_gpkg(
+    engine: Engine, instructions: dict, index: int, table: Type[Ttable], file: str, index_column: str = "catch_id"
+) -> None:
+    """
+    Append the DEM extent of the finished catchment as a row of `{file}_parts.gpkg`, to check on QGIS.
+    The dissolved extent `{file}.gpkg` is generated once at the end of the run by `utils.dissolve_gpkg`.
+    """
+    parts_file = Path(utils.get_env_variable("DATA_DIR")) / Path("gpkg") / Path(f"{file}_parts.gpkg")
+    if not parts_file.exists():
+        # seed the rows by all the DEM extents in the table, which includes the current one
+        utils.append_gpkg(utils.gen_table_extent(engine, table, filter_it=False), f"{file}_parts")
+        return
+    current_extent = gpd.read_file(
+        Path(instructions["default"]["data_paths"]["local_cache"])
+        / Path(instructions["dem"]["data_paths"]["subfolder"])
+        / Path(f"{index}_extents.geojson"),
+        driver="GeoJSON",
+    )
+    current_extent = gpd.GeoDataFrame({index_column: [int(index)]}, geometry=[current_extent.unary_union], crs=2193)
+    utils.append_gpkg(current_extent, f"{file}_parts")
+
+
+def log_throughput(name: str, finished: list, failed: list, runtime: list, t_start: datetime) -> None:
+    """Log the aggregate throughput of a run instead of the runtime of each catchment."""
+    if len(failed):
+        logger.info(f"Failed {len(failed)} {name}s: \n{failed}")
+    elapsed = datetime.now() - t_start
+    hours = elapsed.total_seconds() / 3600
+    throughput = len(finished) / hours if hours > 0 else 0
+    mean_runtime = sum(runtime, timedelta(0, 0)) / len(runtime) if len(runtime) else timedelta(0, 0)
+    logger.info(
+        f"Total runtime: {elapsed}, finished {len(finished)} {name}s, failed {len(failed)} {name}s.\n"
+        f"Throughput: {throughput:.2f} {name}s/hour, mean runtime of each {name}: {mean_runtime}."
+    )
+
+
 def run_raw(
     catch_id: Union[int, str, list] = None,
     area: Union[int, float] = None,
@@ -570,6 +839,11 @@ def run_raw(
     start: Union[int, str] = None,
     update: bool = False,
     gpkg: bool = True,
+    workers: int = 1,
+    cores: int = None,
+    queue: bool = False,
+    max_attempts: int = 3,
+    stale: timedelta = JOB_STALE,
 ) -> None:
     """
     Main function for generate hydrological conditioned dem of catchments.
@@ -584,6 +858,14 @@ def run_raw(
     :param start: the start index of catchment in catchment table, for regression use.
     :param update: if True, run and update the existing dem in `hydro_dem` table, else pass if dem exist.
     :param gpkg: if True, save the hydrological conditioned dem as geopackage.
+    :param workers: the number of worker processes to generate DEMs in parallel, default is 1 (serial).
+    :param cores: the number of cores of each GeoFabrics job,
+        default is all cores in serial mode and cpu_count // workers in parallel mode.
+    :param queue: if True, claim catchments from the job queue in `runtime` table, to resume an interrupted run
+        or to share the run between multiple hosts.
+    :param max_attempts: the max number of attempts of a failed catchment in queue mode.
+    :param stale: in queue mode, the running catchments without heartbeat for this timespan are requeued,
+        e.g. left by a runner crashed on another host, default is 30 minutes.
     """
     engine = utils.get_database()
     data_dir = Path(utils.get_env_variable("DATA_DIR"))
@@ -592,6 +874,7 @@ def run_raw(
     instructions_file = Path(utils.get_env_variable("INSTRUCTIONS_FILE"))
     with open(instructions_file, "r") as f:
         instructions = json.loads(f.read())
+    instructions = set_number_of_cores(instructions, workers=workers, cores=cores)
 
     if catch_id is not None:
         if isinstance(catch_id, str):
@@ -628,10 +911,8 @@ def run_raw(
         catch_id = sorted(_gdf["catch_id"].to_list())
         logger.info(f"******* FULL CATCHMENTS MODE ********* {len(catch_id)} Catchments DEM in total.")
 
-    # generate lidar extent of all lidar datasets, to filter out catchments without lidar data
-    lidar_extent = utils.gen_table_extent(engine, DATASET)
-    # save lidar extent to check on QGIS
-    utils.save_gpkg(lidar_extent, "lidar_extent")
+    # index lidar coverage of all lidar datasets, to filter out catchments without lidar data
+    coverage = utils.CoverageIndex.from_database(engine, buffer=buffer)
 
     if start is not None:
         if int(start) in catch_id:
@@ -641,78 +922,66 @@ def run_raw(
             logger.info(f"Input start index {start} is not in catch_id list.")
             catch_id = sorted([x for x in catch_id if x > int(start)])
 
+    # prefetch catchment boundaries and existing DEM rows of the whole work list
+    boundaries = get_data_by_id(engine, CATCHMENT, catch_id)
+    catch_id = filter_by_coverage(boundaries, catch_id, coverage)
+    if not len(catch_id):
+        logger.info("No catchment to process.")
+        return
+
     runtime = []
+    finished = []
     failed = []
-    create_table(engine, DEM)
-
-    logger.info(f"******* Start process from catch_id {sorted(catch_id)[0]} to {sorted(catch_id)[-1]} *********")
-    for i in catch_id:
-        if update:
-            logger.warning(f"Update mode is on, will delete exist {i} directory and update existing info in database.")
-            shutil.rmtree(catch_path / Path(str(i)), ignore_errors=True)
-
-        # to check if catchment boundary of RoI within lidar extent
-        catchment_boundary = get_data_by_id(engine, CATCHMENT, i)
-        # to check if already exist in hydro_dem table, if exist_ok, run and update, else pass
-        exist_ok = (get_data_by_id(engine, DEM, i, geom_col="")).empty or update
-
-        if lidar_extent.buffer(buffer).intersects(catchment_boundary).any() and exist_ok:
-            # generate catchment boundary file for each catchment
-            utils.gen_boundary_file(catch_path, catchment_boundary, i, buffer=buffer)
-            # generate hydrological conditioned dem for each catchment
-            t_start = datetime.now()
-            try:
-                single_instructions = single_process(engine, instructions, i, mode=mode, buffer=buffer)
-            except Exception as e:
-                logger.exception(f"Catchment {i} failed. Error message:\n{e}")
-                logger.error(
-                    f"Catchment {i} failed. Running instructions:"
-                    f"\n{json.dumps(instructions, indent=2, default=str)}"
-                )
-                failed.append(i)
-                continue
-            t_end = datetime.now()
-            if single_instructions:
-                if not store_hydro_to_db(engine, single_instructions):
-                    logger.warning(f"Catchment {i} failed. Jump to generate next catchment.")
-                    continue
-            else:
-                logger.error(f"Catchment {i} failed. No instructions generated. Please check.")
-                failed.append(i)
-                continue
-            logger.info(f"Catchment {i} finished. Runtime: {t_end - t_start}")
-            runtime.append(t_end - t_start)
-
-            # save lidar extent to check on QGIS
-            if gpkg:
-                gpkg_file = Path(utils.get_env_variable("DATA_DIR")) / Path("gpkg") / Path("dem_extent.gpkg")
-                if gpkg_file.exists():
-                    exist_extent = gpd.read_file(gpkg_file, driver="GPKG")
-                    current_extent = gpd.read_file(
-                        Path(single_instructions["default"]["data_paths"]["local_cache"])
-                        / Path(single_instructions["dem"]["data_paths"]["subfolder"])
-                        / Path(f"{i}_extents.geojson"),
-                        driver="GeoJSON",
-                    )
-                    dem_extent = pd.concat([exist_extent, current_extent], ignore_index=True)
-                    dem_geom = utils.filter_geometry(dem_extent.unary_union)
-                    dem_extent = gpd.GeoDataFrame(index=[0], geometry=[dem_geom], crs=2193)
-                else:
-                    dem_extent = utils.gen_table_extent(engine, DEM)
-                utils.save_gpkg(dem_extent, "dem_extent")
-        else:
-            if exist_ok:
-                logger.info(f"Catchment {i} is not within lidar extent, ignor it.")
-            else:
-                logger.info(f"Catchment {i} already exist in hydro_dem table, ignor it.")
-
-    if len(failed):
-        logger.info(f"Failed {len(failed)} catchments: \n{failed}")
+    migrate_table(engine, DEM)
+    migrate_table(engine, DEMATTR)
 
     logger.info(
-        f"Total runtime: {sum(runtime, timedelta(0, 0))}\n"
-        f"Runtime for each catch_id:{json.dumps(runtime, indent=2, default=str)}"
+        f"******* Start process from catch_id {sorted(catch_id)[0]} to {sorted(catch_id)[-1]} "
+        f"with {workers} workers *********"
+    )
+    t_start = datetime.now()
+    worker_state = dict(
+        instructions=instructions,
+        mode=mode,
+        buffer=buffer,
+        update=update,
+        queue=queue,
+        catch_path=catch_path,
     )
+    jobs = get_job_iterable(
+        engine, "raw", catch_id, queue=queue, update=update, done_table=DEM, max_attempts=max_attempts, stale=stale
+    )
+    payload = prefetch_catchments(engine, boundaries, catch_id, dem_table=DEM)
+    for i, status, single_instructions, span in utils.parallel_imap(
+        _raw_task, ((j, payload[j]) for j in jobs), workers=workers, initializer=partial(_init_worker, **worker_state)
+    ):
+        if status == FAILED:
+            failed.append(i)
+        if status != DONE:
+            if queue:
+                finish_job(engine, "raw", i, status=FAILED if status == FAILED else DONE, message=status)
+            continue
+        # only the database writes are serialised in the main process
+        if not store_result_to_db(store_hydro_to_db, engine, single_instructions, f"Catchment {i}"):
+            logger.warning(f"Catchment {i} failed. Jump to generate next catchment.")
+            failed.append(i)
+            if queue:
+                finish_job(engine, "raw", i, status=FAILED, message="failed to store DEM to database")
+            continue
+        logger.info(f"Catchment {i} finished. Runtime: {span}")
+        runtime.append(span)
+        finished.append(i)
+        if queue:
+            finish_job(engine, "raw", i, runtime=span)
+
+        # save lidar extent to check on QGIS
+        if gpkg:
+            save_extent_gpkg(engine, single_instructions, i, DEM, "dem_extent")
+
+    # dissolve the extent rows once at the end of the run
+    if gpkg and len(finished):
+        utils.dissolve_gpkg("dem_extent", engine=engine, table=DEM)
+    log_throughput("catchment", finished, failed, runtime, t_start)
     engine.dispose()
     gc.collect()
 
@@ -725,6 +994,11 @@ def run_grid(
     start: Union[int, str] = None,
     update: bool = False,
     gpkg: bool = True,
+    workers: int = 1,
+    cores: int = None,
+    queue: bool = False,
+    max_attempts: int = 3,
+    stale: timedelta = JOB_STALE,
 ) -> None:
     """
     Function for generate raw dem by grids.
@@ -739,6 +1013,14 @@ def run_grid(
     :param start: the start index of catchment in catchment table, for regression use.
     :param update: if True, run and update the existing dem in `hydro_dem` table, else pass if dem exist.
     :param gpkg: if True, save the raw dem extent as geopackage.
+    :param workers: the number of worker processes to generate DEMs in parallel, default is 1 (serial).
+    :param cores: the number of cores of each GeoFabrics job,
+        default is all cores in serial mode and cpu_count // workers in parallel mode.
+    :param queue: if True, claim catchments from the job queue in `runtime` table, to resume an interrupted run
+        or to share the run between multiple hosts.
+    :param max_attempts: the max number of attempts of a failed catchment in queue mode.
+    :param stale: in queue mode, the running catchments without heartbeat for this timespan are requeued,
+        e.g. left by a runner crashed on another host, default is 30 minutes.
     """
     engine = utils.get_database()
     data_dir = Path(utils.get_env_variable("DATA_DIR"))
@@ -747,6 +1029,7 @@ def run_grid(
     instructions_file = Path(utils.get_env_variable("INSTRUCTIONS_FILE"))
     with open(instructions_file, "r") as f:
         instructions = json.loads(f.read())
+    instructions = set_number_of_cores(instructions, workers=workers, cores=cores)
 
     if boundary_path is not None:
         gdf_boundary = gpd.read_file(boundary_path, driver="GeoJSON")
@@ -764,14 +1047,8 @@ def run_grid(
         grid_id = sorted(_gdf["grid_id"].to_list())
         logger.info(f"******* FULL GRID MODE ********* {len(grid_id)} GRID in total.")
 
-    lidar_extent_path = Path(utils.get_env_variable("DATA_DIR")) / Path("gpkg") / Path("lidar_extent.gpkg")
-    if lidar_extent_path.is_file():
-        lidar_extent = gpd.read_file(lidar_extent_path)
-    else:
-        # generate lidar extent of all lidar datasets, to filter out catchments without lidar data
-        lidar_extent = utils.gen_table_extent(engine, DATASET)
-        # save lidar extent to check on QGIS
-        utils.save_gpkg(lidar_extent, "lidar_extent")
+    # index lidar coverage of all lidar datasets, to filter out grids without lidar data
+    coverage = utils.CoverageIndex.from_database(engine, buffer=buffer)
 
     if start is not None:
         if int(start) in grid_id:
@@ -782,83 +1059,72 @@ def run_grid(
             grid_id = sorted([x for x in grid_id if x > int(start)])
 
     runtime = []
+    finished = []
     failed = []
-    create_table(engine, GRIDDEM)
+    migrate_table(engine, GRIDDEM, "grid_id")
+    migrate_table(engine, GRIDDEMATTR, "grid_id")
 
     # to check if catchment boundary of RoI within land extent
     gdf_land = gpd.read_file((Path(data_dir) / Path(utils.get_env_variable("LAND_FILE"))), driver="GeoJSON")
     if gdf_land.crs.to_epsg() != 2193:
         gdf_land.to_crs(2193, inplace=True)
     gdf_land = gpd.GeoDataFrame(index=[0], geometry=[gdf_land.unary_union], crs=2193)
-
-    logger.info(f"******* Start process from grid_id {sorted(grid_id)[0]} to {sorted(grid_id)[-1]} *********")
-    for i in grid_id:
-        if update:
-            logger.warning(f"Update mode is on, will delete exist {i} directory and update existing info in database.")
-            shutil.rmtree(Path(data_dir) / Path(str(i)), ignore_errors=True)
-        # to check if catchment boundary of RoI within lidar extent
-        grid_boundary = get_data_by_id(engine, GRID, i, index_column="grid_id")
-        # to check if already exist in grid table and within land extent, if exist_ok is ture, run and update, else pass
-        intersect_ok = (
-            lidar_extent.buffer(buffer).intersects(grid_boundary).any()
-            and gdf_land.buffer(buffer).intersects(grid_boundary).any()
-        )
-        exist_ok = update or (get_data_by_id(engine, GRIDDEM, i, geom_col="", index_column="grid_id")).empty
-
-        if intersect_ok and exist_ok:
-            # generate grid boundary file for each grid
-            utils.gen_boundary_file(grid_path, grid_boundary, i, buffer=buffer)
-            # generate raw dem for each grid
-            t_start = datetime.now()
-            try:
-                single_instructions = single_process(engine, instructions, i, mode=mode, grid=True, buffer=buffer)
-            except Exception as e:
-                logger.exception(f"Grid {i} failed. Error message:\n{e}")
-                logger.error(
-                    f"Grid {i} failed. Running instructions:" f"\n{json.dumps(instructions, indent=2, default=str)}"
-                )
-                failed.append(i)
-                continue
-            t_end = datetime.now()
-            if single_instructions:
-                store_grid_to_db(engine, single_instructions)
-            else:
-                logger.error(f"Grid {i} failed. No instructions generated. Please check.")
-                failed.append(i)
-                continue
-            logger.info(f"Grid {i} finished. Runtime: {t_end - t_start}")
-            runtime.append(t_end - t_start)
-
-            # save lidar extent to check on QGIS
-            if gpkg:
-                gpkg_file = Path(utils.get_env_variable("DATA_DIR")) / Path("gpkg") / Path("grid_extent.gpkg")
-                if gpkg_file.exists():
-                    exist_extent = gpd.read_file(gpkg_file, driver="GPKG")
-                    current_extent = gpd.read_file(
-                        Path(single_instructions["default"]["data_paths"]["local_cache"])
-                        / Path(single_instructions["dem"]["data_paths"]["subfolder"])
-                        / Path(f"{i}_extents.geojson"),
-                        driver="GeoJSON",
-                    )
-                    dem_extent = pd.concat([exist_extent, current_extent], ignore_index=True)
-                    dem_geom = utils.filter_geometry(dem_extent.unary_union)
-                    dem_extent = gpd.GeoDataFrame(index=[0], geometry=[dem_geom], crs=2193)
-                else:
-                    dem_extent = utils.gen_table_extent(engine, GRIDDEM)
-                utils.save_gpkg(dem_extent, "grid_extent")
-        else:
-            if exist_ok:
-                logger.info(f"Grid {i} is not within lidar extent, ignor it.")
-            else:
-                logger.info(f"Grid {i} already exist in grid_dem table, ignor it.")
-
-    if len(failed):
-        logger.info(f"Failed {len(failed)} grads: \n{failed}")
+    land = gdf_land.buffer(buffer).values[0]
+    # prefetch grid boundaries and existing DEM rows of the whole work list
+    boundaries = get_data_by_id(engine, GRID, grid_id, index_column="grid_id")
+    grid_id = filter_by_coverage(boundaries, grid_id, coverage, index_column="grid_id", land=land)
+    if not len(grid_id):
+        logger.info("No grid to process.")
+        return
 
     logger.info(
-        f"Total runtime: {sum(runtime, timedelta(0, 0))}\n"
-        f"Runtime for each grid_id:{json.dumps(runtime, indent=2, default=str)}"
+        f"******* Start process from grid_id {sorted(grid_id)[0]} to {sorted(grid_id)[-1]} "
+        f"with {workers} workers *********"
     )
+    t_start = datetime.now()
+    worker_state = dict(
+        instructions=instructions,
+        mode=mode,
+        buffer=buffer,
+        update=update,
+        queue=queue,
+        data_dir=data_dir,
+        grid_path=grid_path,
+    )
+    jobs = get_job_iterable(
+        engine, "grid", grid_id, queue=queue, update=update, done_table=GRIDDEM, max_attempts=max_attempts, stale=stale
+    )
+    payload = prefetch_catchments(engine, boundaries, grid_id, index_column="grid_id", dem_table=GRIDDEM)
+    for i, status, single_instructions, span in utils.parallel_imap(
+        _grid_task, ((j, payload[j]) for j in jobs), workers=workers, initializer=partial(_init_worker, **worker_state)
+    ):
+        if status == FAILED:
+            failed.append(i)
+        if status != DONE:
+            if queue:
+                finish_job(engine, "grid", i, status=FAILED if status == FAILED else DONE, message=status)
+            continue
+        # only the database writes are serialised in the main process
+        if not store_result_to_db(store_grid_to_db, engine, single_instructions, f"Grid {i}"):
+            logger.warning(f"Grid {i} failed. Jump to generate next grid.")
+            failed.append(i)
+            if queue:
+                finish_job(engine, "grid", i, status=FAILED, message="failed to store DEM to database")
+            continue
+        logger.info(f"Grid {i} finished. Runtime: {span}")
+        runtime.append(span)
+        finished.append(i)
+        if queue:
+            finish_job(engine, "grid", i, runtime=span)
+
+        # save lidar extent to check on QGIS
+        if gpkg:
+            save_extent_gpkg(engine, single_instructions, i, GRIDDEM, "grid_extent", index_column="grid_id")
+
+    # dissolve the extent rows once at the end of the run
+    if gpkg and len(finished):
+        utils.dissolve_gpkg("grid_extent", index_column="grid_id", engine=engine, table=GRIDDEM)
+    log_throughput("grid", finished, failed, runtime, t_start)
     engine.dispose()
     gc.collect()
 
@@ -872,6 +1138,11 @@ def run_hydro(
     start: Union[int, str] = None,
     update: bool = False,
     gpkg: bool = True,
+    workers: int = 1,
+    cores: int = None,
+    queue: bool = False,
+    max_attempts: int = 3,
+    stale: timedelta = JOB_STALE,
 ) -> None:
     """
     Main function for generate hydrological conditioned dem of catchments.
@@ -887,6 +1158,14 @@ def run_hydro(
     :param start: the start index of catchment in catchment table, for regression use.
     :param update: if True, run and update the existing dem in `hydro_dem` table, else pass if dem exist.
     :param gpkg: if True, save the hydrological conditioned dem as geopackage.
+    :param workers: the number of worker processes to generate DEMs in parallel, default is 1 (serial).
+    :param cores: the number of cores of each GeoFabrics job,
+        default is all cores in serial mode and cpu_count // workers in parallel mode.
+    :param queue: if True, claim catchments from the job queue in `runtime` table, to resume an interrupted run
+        or to share the run between multiple hosts.
+    :param max_attempts: the max number of attempts of a failed catchment in queue mode.
+    :param stale: in queue mode, the running catchments without heartbeat for this timespan are requeued,
+        e.g. left by a runner crashed on another host, default is 30 minutes.
     """
     engine = utils.get_database()
     data_dir = Path(utils.get_env_variable("DATA_DIR"))
@@ -901,6 +1180,7 @@ def run_hydro(
         utils.map_dataset_name(engine, instructions_file)
         with open(instructions_file, "r") as f:
             instructions = json.loads(f.read())
+    instructions = set_number_of_cores(instructions, workers=workers, cores=cores)
 
     if catch_id is not None:
         if isinstance(catch_id, str):
@@ -941,10 +1221,8 @@ def run_hydro(
         catch_id = sorted(_gdf["catch_id"].to_list())
         logger.info(f"******* FULL CATCHMENTS MODE ********* {len(catch_id)} Catchments DEM in total.")
 
-    # generate lidar extent of all lidar datasets, to filter out catchments without lidar data
-    lidar_extent = utils.gen_table_extent(engine, DATASET)
-    # save lidar extent to check on QGIS
-    utils.save_gpkg(lidar_extent, "lidar_extent")
+    # index lidar coverage of all lidar datasets, to filter out catchments without lidar data
+    coverage = utils.CoverageIndex.from_database(engine, buffer=buffer)
 
     if start is not None:
         if int(start) in catch_id:
@@ -954,125 +1232,73 @@ def run_hydro(
             logger.info(f"Input start index {start} is not in catch_id list.")
             catch_id = sorted([x for x in catch_id if x > int(start)])
 
-    if flow_path.is_file():
-        gdf_flow = pd.read_csv(flow_path)
-    else:
-        gdf_flow = None
-        logger.warning(f"Flow path {flow_path} is not exist.")
-    if rec_path.is_file():
-        gdf_rec = rivers.prep_rec(rec_path, save=True)
-    else:
-        gdf_rec = None
-        logger.warning(f"REC1 path {rec_path} is not exist.")
+    table = SDCP if table is None else table
+    # prefetch catchment boundaries, existing DEM rows, split subordinates and river rows of the whole work list
+    boundaries = get_data_by_id(engine, table, catch_id)
+    catch_id = filter_by_coverage(boundaries, catch_id, coverage)
+    if not len(catch_id):
+        logger.info("No catchment to process.")
+        return
 
     runtime = []
+    finished = []
     failed = []
-    create_table(engine, DEM)
-
-    logger.info(f"******* Start process from catch_id {sorted(catch_id)[0]} to {sorted(catch_id)[-1]} *********")
-    for i in catch_id:
-        catch_i_path = catch_path / str(i)
-        if update:
-            logger.warning(f"Update mode is on, will delete exist {i} directory and update existing info in database.")
-            shutil.rmtree(catch_i_path, ignore_errors=True)
-
-        # to check if catchment boundary of RoI within lidar extent
-        catchment_boundary = get_data_by_id(engine, table, i)
-        # to check if already exist in hydro_dem table, if exist_ok, run process and update result, else pass
-        gdf_dem = get_data_by_id(engine, DEM, i, geom_col="")
-        exist_ok = False
-        if gdf_dem.empty or update or not (Path(catch_i_path) / "river").is_dir():
-            exist_ok = True
-
-        if lidar_extent.buffer(buffer).intersects(catchment_boundary).any() and exist_ok:
-            # generate catchment boundary file for each catchment
-            utils.gen_boundary_file(catch_path, catchment_boundary, i, buffer=buffer)
-
-            # generate hydrological conditioned dem for each catchment
-            t_start = datetime.now()
-
-            if gdf_dem.empty or not Path(gdf_dem["raw_dem_path"].values[0]).is_file():
-                sub_list = get_split_catchment_by_id(engine, i, sub=True)
-                logger.debug(f"Retrieved catchment {i} subordinates {sub_list}.")
-                mis_id = []
-                for sub_id in sub_list:
-                    sub_catchment = get_data_by_id(engine, SDCP, sub_id)
-                    if not Path(sub_catchment["raw_dem_path"].values[0]).is_file():
-                        logger.warning(f"Subordinate {sub_id} of catchment {i} is not exist, please check.")
-                        mis_id.append(sub_id)
-                        continue
-                if len(mis_id) == 0:
-                    utils.get_dem_by_geometry(engine, catchment_boundary, index=i)
-                else:
-                    logger.warning(f"Subordinate {mis_id} of catchment {i} is not exist, please check.")
-                    failed.append(i)
-                    continue
-
-            # generate river network for the catchment
-            if not (Path(catch_i_path) / "river" / rivers.RIVER_NETWORK_FILE).is_file():
-                if gdf_rec is not None and gdf_flow is not None:
-                    rivers.gen_river_network(
-                        catchment_boundary,
-                        gdf_rec,
-                        gdf_flow,
-                        Path(catch_i_path),
-                    )
-                else:
-                    logger.warning(f"Skip river network generation because REC1 and/or flow data do not exist")
-
-            try:
-                single_instructions = single_process(
-                    engine, instructions, i, mode=mode, geometry=catchment_boundary, buffer=buffer
-                )
-            except Exception as e:
-                logger.exception(f"Catchment {i} failed. Error message:\n{e}")
-                logger.error(
-                    f"Catchment {i} failed. Running instructions:"
-                    f"\n{json.dumps(instructions, indent=2, default=str)}"
-                )
-                failed.append(i)
-                continue
-            t_end = datetime.now()
-            if single_instructions:
-                if not store_hydro_to_db(engine, single_instructions):
-                    logger.warning(f"Catchment {i} failed. Jump to generate next catchment.")
-                    continue
-            else:
-                logger.error(f"Catchment {i} failed. No instructions generated. Please check.")
-                failed.append(i)
-                continue
-            logger.info(f"Catchment {i} finished. Runtime: {t_end - t_start}")
-            runtime.append(t_end - t_start)
-
-            # save lidar extent to check on QGIS
-            if gpkg:
-                gpkg_file = Path(utils.get_env_variable("DATA_DIR")) / Path("gpkg") / Path("dem_extent.gpkg")
-                if gpkg_file.exists():
-                    exist_extent = gpd.read_file(gpkg_file, driver="GPKG")
-                    current_extent = gpd.read_file(
-                        Path(single_instructions["default"]["data_paths"]["local_cache"])
-                        / Path(single_instructions["dem"]["data_paths"]["subfolder"])
-                        / Path(f"{i}_extents.geojson"),
-                        driver="GeoJSON",
-                    )
-                    dem_extent = pd.concat([exist_extent, current_extent], ignore_index=True)
-                    dem_geom = utils.filter_geometry(dem_extent.unary_union)
-                    dem_extent = gpd.GeoDataFrame(index=[0], geometry=[dem_geom], crs=2193)
-                else:
-                    dem_extent = utils.gen_table_extent(engine, DEM)
-                utils.save_gpkg(dem_extent, "dem_extent")
-        else:
-            if exist_ok:
-                logger.info(f"Catchment {i} is not within lidar extent, ignor it.")
-            else:
-                logger.info(f"Catchment {i} already exist in hydro_dem table, ignor it.")
-
-    if len(failed):
-        logger.info(f"Failed {len(failed)} catchments: \n{failed}")
+    migrate_table(engine, DEM)
+    migrate_table(engine, DEMATTR)
 
     logger.info(
-        f"Total runtime: {sum(runtime, timedelta(0, 0))}\n"
-        f"Runtime for each catch_id:{json.dumps(runtime, indent=2, default=str)}"
+        f"******* Start process from catch_id {sorted(catch_id)[0]} to {sorted(catch_id)[-1]} "
+        f"with {workers} workers *********"
+    )
+    # prepare the REC1 cache once here, the workers load the saved one
+    if rec_path.is_file() and not rec_path.with_suffix(".parquet").is_file():
+        rivers.prep_rec(rec_path, save=True)
+    t_start = datetime.now()
+    worker_state = dict(
+        instructions=instructions,
+        mode=mode,
+        buffer=buffer,
+        update=update,
+        catch_path=catch_path,
+        flow_path=flow_path,
+        rec_path=rec_path,
+    )
+    jobs = get_job_iterable(
+        engine, "hydro", catch_id, queue=queue, update=update, done_table=DEM, max_attempts=max_attempts, stale=stale
     )
+    payload = prefetch_catchments(engine, boundaries, catch_id, dem_table=DEM, sub=True, river=True)
+    for i, status, single_instructions, span in utils.parallel_imap(
+        _hydro_task,
+        ((j, payload[j]) for j in jobs),
+        workers=workers,
+        initializer=partial(_init_hydro_worker, **worker_state),
+    ):
+        if status == FAILED:
+            failed.append(i)
+        if status != DONE:
+            if queue:
+                finish_job(engine, "hydro", i, status=FAILED if status == FAILED else DONE, message=status)
+            continue
+        # only the database writes are serialised in the main process
+        if not store_result_to_db(store_hydro_to_db, engine, single_instructions, f"Catchment {i}"):
+            logger.warning(f"Catchment {i} failed. Jump to generate next catchment.")
+            failed.append(i)
+            if queue:
+                finish_job(engine, "hydro", i, status=FAILED, message="failed to store DEM to database")
+            continue
+        logger.info(f"Catchment {i} finished. Runtime: {span}")
+        runtime.append(span)
+        finished.append(i)
+        if queue:
+            finish_job(engine, "hydro", i, runtime=span)
+
+        # save lidar extent to check on QGIS
+        if gpkg:
+            save_extent_gpkg(engine, single_instructions, i, DEM, "dem_extent")
+
+    # dissolve the extent rows once at the end of the run
+    if gpkg and len(finished):
+        utils.dissolve_gpkg("dem_extent", engine=engine, table=DEM)
+    log_throughput("catchment", finished, failed, runtime, t_start)
     engine.dispose()
     gc.collect()
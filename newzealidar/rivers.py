@@ -4,9 +4,9 @@ import math
 from typing import Type, Union
 import numpy as np
 import pandas as pd
-import dask.dataframe as dd
 import geopandas as gpd
-from shapely import box, unary_union, wkt
+import shapely
+from shapely import STRtree, box, from_wkt, unary_union
 from shapely.ops import nearest_points, polygonize
 from pathlib import Path
 import osmnx as ox
@@ -15,9 +15,7 @@ import osmnx.features
 import leafmap
 from sqlalchemy.engine import Engine
 
-import multiprocessing
 from itertools import repeat
-from multiprocessing.pool import ThreadPool as Pool
 
 from newzealidar import tables, utils
 
@@ -38,6 +36,14 @@ MAX_ENDPOINT_NZREACH_DIST = 500
 MAX_SEA_DIST = 10_000
 CATCHMENT_RESOLUTION = 30
 RIVER_NETWORK_FILE = "river_network.geojson"
+OSM_TAGS = ["waterway", "water"]
+REC_COLUMNS = ["NZREACH", "DISTSEA", "LENGTH", "CATCHAREA", "to_node", "from_node", "geometry"]
+REC_ROW_GROUP_SIZE = 10_000
+RIVER_BATCH_SIZE = 50
+COAST_TILE_SIZE = 10_000
+
+# state of a worker process, shared by all the catchments processed in the worker
+_worker = {}
 
 
 def plt_gdf(*gdfs):
@@ -135,53 +141,218 @@ def prep_coast_osm(file_path, save=False):
     return gdf_coast
 
 
-def prep_rec(file_path, save=False):
-    save_path = Path(file_path).with_suffix(".csv")
-    if not Path(file_path).is_file() and not Path(save_path).is_file():
+def _filter_rec(gdf_rec: gpd.GeoDataFrame, columns: list = None, bbox: tuple = None) -> gpd.GeoDataFrame:
+    """Filter REC1 rows by the bounding box and keep the columns, the same as loading from GeoParquet."""
+    if bbox is not None:
+        gdf_rec = gdf_rec[gdf_rec.intersects(box(*bbox))]
+    if columns is not None:
+        gdf_rec = gdf_rec[list(dict.fromkeys(columns + ["geometry"]))]
+    return gdf_rec.reset_index(drop=True)
+
+
+def prep_rec(file_path, save=False, columns: list = None, bbox: tuple = None):
+    """
+    Prepare REC1 river network in epsg:2193 within MAX_SEA_DIST of the sea, cached as GeoParquet.
+
+    :param file_path: REC1 shapefile, or a CSV file with WKT geometry saved by the former version.
+    :param save: if True, save the GeoParquet cache next to file_path.
+    :param columns: the columns to load besides geometry, default all REC_COLUMNS.
+    :param bbox: (minx, miny, maxx, maxy) in epsg:2193, only load the reaches intersecting the bounding box.
+    """
+    save_path = Path(file_path).with_suffix(".parquet")
+    csv_path = Path(file_path).with_suffix(".csv")
+    if not Path(file_path).is_file() and not save_path.is_file() and not csv_path.is_file():
         logger.error(f"File not exist {file_path}")
         return None
 
-    if Path(save_path).is_file():
-        logger.info(f"Load existing coastline {save_path}")
-        dd_rec = dd.read_csv(save_path)
-        df_rec = dd_rec.compute()
-        df_rec["geometry"] = df_rec["geometry"].apply(wkt.loads)
-        return gpd.GeoDataFrame(df_rec, crs="epsg:2193", geometry="geometry")
-
-    gdf_rec = gpd.read_file(file_path)
-    logger.debug(f"Original REC1 shape: {gdf_rec.shape}")
-    gdf_rec.to_crs(2193, inplace=True)
+    if save_path.is_file():
+        logger.info(f"Load existing REC1 {save_path}")
+        filters = None
+        if bbox is not None:
+            # the rows are sorted by hilbert distance, so the row groups out of the bounding box are skipped
+            minx, miny, maxx, maxy = bbox
+            filters = [("xmin", "<=", maxx), ("xmax", ">=", minx), ("ymin", "<=", maxy), ("ymax", ">=", miny)]
+        columns = REC_COLUMNS if columns is None else list(dict.fromkeys(columns + ["geometry"]))
+        gdf_rec = gpd.read_parquet(save_path, columns=columns, filters=filters)
+        return _filter_rec(gdf_rec, bbox=bbox)
+
+    if csv_path.is_file():
+        logger.info(f"Load existing REC1 {csv_path}")
+        df_rec = pd.read_csv(csv_path)
+        gdf_rec = gpd.GeoDataFrame(
+            df_rec.assign(geometry=from_wkt(df_rec["geometry"].values)), geometry="geometry", crs=2193
+        )
+    else:
+        gdf_rec = gpd.read_file(file_path)
+        logger.debug(f"Original REC1 shape: {gdf_rec.shape}")
+        gdf_rec.to_crs(2193, inplace=True)
     # reduce the size of the dataframe
-    gdf_rec = gdf_rec[["NZREACH", "DISTSEA", "LENGTH", "CATCHAREA", "to_node", "from_node", "geometry"]]
+    gdf_rec = gdf_rec[REC_COLUMNS]
     gdf_rec = gdf_rec[gdf_rec["DISTSEA"] < MAX_SEA_DIST]
     logger.debug(f"Converted REC1 shape: {gdf_rec.shape}")
 
     if save:
         logger.info(f"Save REC1 to {save_path}")
-        with open(save_path, "w") as f:
-            pd.DataFrame(gdf_rec.assign(geometry=gdf_rec["geometry"].apply(lambda p: p.wkt))).to_csv(f, index=False)
+        bounds = gdf_rec.bounds
+        gdf_save = gdf_rec.assign(
+            xmin=bounds["minx"], ymin=bounds["miny"], xmax=bounds["maxx"], ymax=bounds["maxy"]
+        ).iloc[np.argsort(gdf_rec.hilbert_distance().values)]
+        # write to a temporary file first, so a reader never sees a partly written cache
+        temp_path = save_path.with_name(f"{save_path.name}.{os.getpid()}.tmp")
+        gdf_save.to_parquet(temp_path, index=False, row_group_size=REC_ROW_GROUP_SIZE)
+        os.replace(temp_path, save_path)
+
+    return _filter_rec(gdf_rec, columns, bbox)
+
+
+def _get_osm_tag(gdf: gpd.GeoDataFrame, key: str) -> pd.Series:
+    """Get an OSM tag of the features, from its own column or from the 'other_tags' column of GDAL OSM driver."""
+    if key in gdf.columns:
+        return gdf[key]
+    if "other_tags" in gdf.columns:
+        return gdf["other_tags"].str.extract(f'"{key}"=>"([^"]*)"', expand=False)
+    return pd.Series(None, index=gdf.index, dtype=object)
 
-    return gdf_rec
 
+# download data first - https://download.geofabrik.de/australia-oceania/new-zealand.html
+def prep_osm_waterway(file_path, save=False):
+    """
+    Prepare waterway ways and water polygons from a New Zealand OSM extract, PBF or GeoPackage converted by ogr2ogr.
+    The result has the columns of osmnx features, 'element_type', 'osmid', 'name', 'waterway', 'water', 'geometry'.
+    """
+    save_path = Path(file_path).with_suffix(".parquet")
+    if not Path(file_path).is_file() and not Path(save_path).is_file():
+        logger.error(f"File not exist {file_path}")
+        return None
 
-def get_osmid(catch_id, gdf_sdc, gdf_coast, by="dist"):
+    if Path(save_path).is_file():
+        logger.info(f"Load existing OSM waterway {save_path}")
+        return gpd.read_parquet(save_path)
+
+    list_gdf = []
+    # the lines layer is the ways, the multipolygons layer has ways with osm_way_id and relations with osm_id
+    for layer in ["lines", "multipolygons"]:
+        gdf = gpd.read_file(file_path, layer=layer)
+        for key in OSM_TAGS:
+            gdf[key] = _get_osm_tag(gdf, key)
+        gdf = gdf[gdf["waterway"].notnull() | (gdf["water"] == "river")]
+        if layer == "lines":
+            gdf = gdf.assign(element_type="way", osmid=gdf["osm_id"])
+        else:
+            is_way = gdf["osm_way_id"].notnull()
+            # a closed way is a polygon in osmnx, rather than a multipolygon of one part
+            geoms = gdf.geometry.values
+            is_single = is_way.values & (shapely.get_num_geometries(geoms) == 1)
+            gdf = gdf.assign(
+                element_type=np.where(is_way, "way", "relation"),
+                osmid=gdf["osm_way_id"].where(is_way, gdf["osm_id"]),
+                geometry=gpd.GeoSeries(np.where(is_single, shapely.get_geometry(geoms, 0), geoms), crs=gdf.crs,
+                                       index=gdf.index),
+            )
+        list_gdf.append(gdf[["element_type", "osmid", "name"] + OSM_TAGS + ["geometry"]])
+    gdf_osm = gpd.GeoDataFrame(pd.concat(list_gdf, ignore_index=True), crs=list_gdf[0].crs).to_crs(4326)
+    gdf_osm = gdf_osm.astype({"osmid": "int64"})
+    logger.debug(f"OSM waterway shape: {gdf_osm.shape}")
+
+    if save:
+        logger.info(f"Save OSM waterway to {save_path}")
+        gdf_osm.to_parquet(save_path, index=False)
+
+    return gdf_osm
+
+
+class WaterwaySource:
+    """Source of OSM features in a polygon, queried from Overpass API and cached by osmnx."""
+
+    def get_features(self, polygon, tags: dict) -> gpd.GeoDataFrame:
+        """Get the features in the polygon (epsg:4326) matching the tags, in epsg:4326."""
+        return ox.features.features_from_polygon(polygon, tags=tags)
+
+
+class LocalWaterwaySource(WaterwaySource):
+    """Source of OSM features in a polygon, served from a local OSM waterway extract with a spatial index."""
+
+    def __init__(self, gdf_osm: gpd.GeoDataFrame):
+        gdf_osm = gdf_osm.reset_index(drop=True)
+        # keep missing names and tags as NaN, the same as osmnx
+        for key in ["name"] + OSM_TAGS:
+            gdf_osm[key] = gdf_osm[key].astype(object).where(gdf_osm[key].notnull(), np.nan)
+        self.gdf = gdf_osm
+        self.tree = STRtree(gdf_osm.geometry.values)
+
+    def get_features(self, polygon, tags: dict) -> gpd.GeoDataFrame:
+        """Get the features in the polygon (epsg:4326) matching the tags, in epsg:4326."""
+        gdf = self.gdf.iloc[np.sort(self.tree.query(polygon, predicate="intersects"))]
+        for key, value in tags.items():
+            gdf = gdf[gdf[key].notnull()] if value is True else gdf[gdf[key] == value]
+        if gdf.empty:
+            raise ValueError(f"No OSM features of {tags} in the polygon of the local extract.")
+        return gdf.set_index(["element_type", "osmid"])
+
+
+def get_waterway_source(file_path=None, save=False) -> WaterwaySource:
+    """
+    Get the OSM waterway source, the local extract if file_path (or OSM_WATERWAY_FILE) is set, otherwise Overpass API.
+    """
+    if file_path is None and os.getenv("OSM_WATERWAY_FILE"):
+        file_path = Path(utils.get_env_variable("DATA_DIR")) / utils.get_env_variable("OSM_WATERWAY_FILE")
+    if file_path is not None:
+        gdf_osm = prep_osm_waterway(file_path, save=save)
+        if gdf_osm is not None:
+            return LocalWaterwaySource(gdf_osm)
+        logger.warning("Fall back to Overpass API for OSM waterway.")
+    return WaterwaySource()
+
+
+class CoastIndex:
+    """Coastline cut into tiles, indexed by an STRtree to get the local coastline of a catchment."""
+
+    def __init__(self, gdf_coast: gpd.GeoDataFrame, tile_size: int = COAST_TILE_SIZE):
+        assert gdf_coast.crs.to_epsg() == 2193, f"Input data CRS is not 2193 but {gdf_coast.crs.to_epsg()}"
+        tiles = utils.fishnet(gdf_coast.geometry.values[0].boundary, tile_size)
+        parts = shapely.get_parts(tiles.values)
+        self.parts = parts[shapely.get_type_id(parts) == shapely.GeometryType.LINESTRING]
+        self.tree = STRtree(self.parts)
+
+    def get_local(self, geometry) -> shapely.MultiLineString:
+        """
+        Get the coastline around the geometry, which has the nearest coastline of every point of the geometry,
+        as the nearest coastline of a point is not further than the nearest coastline of the geometry plus its diameter.
+        """
+        _, dist = self.tree.query_nearest(geometry, return_distance=True)
+        minx, miny, maxx, maxy = geometry.bounds
+        distance = dist.min() + math.hypot(maxx - minx, maxy - miny)
+        index = np.sort(self.tree.query(geometry, predicate="dwithin", distance=distance))
+        return shapely.multilinestrings(self.parts[index])
+
+
+def get_osmid(
+    catch_id,
+    gdf_sdc,
+    gdf_coast,
+    by="dist",
+    source: WaterwaySource = None,
+    coast_index: CoastIndex = None,
+    coast: shapely.Geometry = None,
+):
     assert gdf_sdc.crs.to_epsg() == 2193, f"{catch_id} Input data CRS is not 2193 but {gdf_sdc.crs.to_epsg()}"
     assert gdf_coast.crs.to_epsg() == 2193, f"{catch_id} Input data CRS is not 2193 but {gdf_coast.crs.to_epsg()}"
 
     if not catch_id:
         return None, None, None, None, None
 
+    source = WaterwaySource() if source is None else source
     endpoint = None
     gdf_catch = gdf_sdc[gdf_sdc.catch_id == catch_id].copy()
     assert not gdf_catch.empty, f"{catch_id} not exist in catchment dataframe "
     # clip the catchment to keep it inside the coastline
-    gdf_catch = gdf_catch.clip(gdf_coast.unary_union)
+    gdf_catch = gdf_catch.clip(gdf_coast.unary_union if coast is None else coast)
     gdf_catch_4326 = gdf_catch.to_crs(4326)
     if not gdf_catch_4326.geometry.is_valid.all():
         gdf_catch_4326.geometry = gdf_catch_4326.geometry.buffer(0)
         logger.debug(f"Fixed invalid geometry {catch_id}")
     try:
-        gdf_waterway = ox.features.features_from_polygon(gdf_catch_4326.unary_union, tags={"waterway": True})
+        gdf_waterway = source.get_features(gdf_catch_4326.unary_union, tags={"waterway": True})
     except Exception as e:
         logger.debug(f"{catch_id} No waterway in the catchment.\n{e}")
         return None, None, None, gdf_catch, None
@@ -205,16 +376,21 @@ def get_osmid(catch_id, gdf_sdc, gdf_coast, by="dist"):
         return None, None, None, gdf_catch, gdf_waterway
     # clip the river to keep it inside the coastline to calculate length and distance to the coast
     # buffer it to make the catchment edge smoother to avoid the unappropriated endpoint
-    gdf_waterway_clipped = gdf_waterway_natural.clip(gdf_catch.buffer(CATCHMENT_RESOLUTION / 2).unary_union)
+    catch_buffer = gdf_catch.buffer(CATCHMENT_RESOLUTION / 2).unary_union
+    gdf_waterway_clipped = gdf_waterway_natural.clip(catch_buffer)
     gdf_waterway_clipped["len"] = gdf_waterway_clipped.geometry.length
-    gdf_waterway_clipped["dist_sea"] = gdf_waterway_clipped.geometry.apply(
-        lambda x: x.distance(gdf_coast.geometry.values[0].boundary)
-    )
+    # the distances are calculated against the local coastline of coast_index instead of the whole coastline,
+    # without coast_index, against the whole coastline rather than building the index for one catchment
+    if coast_index is None:
+        coast_geom = gdf_coast.geometry.values[0].boundary
+    else:
+        coast_geom = coast_index.get_local(catch_buffer)
+    gdf_waterway_clipped["dist_sea"] = shapely.distance(gdf_waterway_clipped.geometry.values, coast_geom)
     if by == "len":
         gdf_sorted = gdf_waterway_clipped.sort_values(by="len", ascending=False).reset_index(drop=True)
     elif by == "dist":
         try:
-            gdf_water = ox.features.features_from_polygon(gdf_catch_4326.unary_union, tags={"water": "river"})
+            gdf_water = source.get_features(gdf_catch_4326.unary_union, tags={"water": "river"})
         except Exception as e:
             gdf_water = None
             logger.debug(f"{catch_id} No water:river in the catchment.\n{e}")
@@ -224,8 +400,8 @@ def get_osmid(catch_id, gdf_sdc, gdf_coast, by="dist"):
             gdf_water = gdf_water.reset_index()
             gdf_water["area"] = gdf_water.geometry.area
             gdf_water = gdf_water.sort_values(by="area", ascending=False).reset_index(drop=True)
-            gdf_waterway_clipped["dist_water"] = gdf_waterway_clipped.geometry.apply(
-                lambda x: x.distance(gdf_water.geometry.values[0])
+            gdf_waterway_clipped["dist_water"] = shapely.distance(
+                gdf_waterway_clipped.geometry.values, gdf_water.geometry.values[0]
             )
             gdf_sorted = gdf_waterway_clipped.sort_values(
                 by=["dist_water", "dist_sea", "len"], ascending=[True, True, False]
@@ -235,7 +411,6 @@ def get_osmid(catch_id, gdf_sdc, gdf_coast, by="dist"):
                 drop=True
             )
         river_geom = gdf_sorted[gdf_sorted.index == 0].geometry.values[0]
-        coast_geom = gdf_coast.geometry.values[0].boundary
         catch_geom = gdf_catch.geometry.values[0]
         dist_catch_coast = catch_geom.distance(coast_geom)
         endpoint = nearest_points(river_geom, coast_geom)[0]
@@ -277,7 +452,8 @@ def get_recid(catch_id, gdf_sdc, gdf_rec, endpoint=None, by="dist"):
     if not gdf_catch.geometry.values[0].is_valid:
         gdf_catch = gdf_catch.buffer(0)
         logger.debug(f"{catch_id} Fixed invalid geometry.")
-    gdf_rec_catch = gdf_rec[gdf_rec.intersects(gdf_catch.unary_union)].copy()
+    # the spatial index of gdf_rec is built once and reused by all the catchments
+    gdf_rec_catch = gdf_rec.iloc[np.sort(gdf_rec.sindex.query(gdf_catch.unary_union, predicate="intersects"))].copy()
     if gdf_rec_catch.empty:
         logger.debug(f"{catch_id} No REC1 in the catchment")
         return None, None, gdf_catch, gdf_rec_catch
@@ -286,7 +462,7 @@ def get_recid(catch_id, gdf_sdc, gdf_rec, endpoint=None, by="dist"):
     elif by == "dist":
         if endpoint:
             # print(endpoint)
-            gdf_rec_catch["dist"] = gdf_rec_catch.geometry.apply(lambda x: x.distance(endpoint))
+            gdf_rec_catch["dist"] = shapely.distance(gdf_rec_catch.geometry.values, endpoint)
             # constain distance between endpoint and NZREACH
             gdf_sorted = gdf_rec_catch[gdf_rec_catch.dist < MAX_ENDPOINT_NZREACH_DIST].copy()
             if not gdf_sorted.empty:
@@ -317,28 +493,138 @@ def get_recid(catch_id, gdf_sdc, gdf_rec, endpoint=None, by="dist"):
     return net_id, gdf_sorted, gdf_catch, gdf_rec_catch
 
 
+class RiverNetworkIndex:
+    """REC1 river network joined with the flow data once, indexed by an STRtree of the reaches."""
+
+    def __init__(self, gdf_rec: gpd.GeoDataFrame, gdf_flow: pd.DataFrame):
+        if gdf_rec.crs.to_epsg() != 2193:
+            gdf_rec = gdf_rec.to_crs(2193)
+        gdf_rec = gdf_rec[gdf_rec["NZREACH"].isin(gdf_flow["nzreach"])]
+        gdf_rec = gdf_rec[["NZREACH", "CATCHAREA", "to_node", "from_node", "geometry"]]
+        gdf_rec = gdf_rec.astype({"NZREACH": "int64"})
+        gdf_rec = gdf_rec.sort_values(by=["NZREACH"]).reset_index(drop=True)
+        gdf_rec = gdf_rec.rename(columns=str.lower)
+        gdf_flow = gdf_flow.sort_values(by=["nzreach"]).reset_index(drop=True)
+        self.gdf = gpd.GeoDataFrame(pd.merge(gdf_rec, gdf_flow, on="nzreach", how="left"))
+        self.tree = STRtree(self.gdf.geometry.values)
+
+    @staticmethod
+    def get_extent(gdf_roi: gpd.GeoDataFrame):
+        """Get the extent of the river network of a region of interest."""
+        if gdf_roi.crs.to_epsg() != 2193:
+            gdf_roi = gdf_roi.to_crs(2193)
+        return box(*gdf_roi.buffer(10, join_style="mitre").total_bounds)
+
+    def clip(self, geom) -> gpd.GeoDataFrame:
+        """Clip the river network with flow data to the extent, the reaches are sorted by nzreach."""
+        return self.clip_reaches(self.gdf.iloc[self.tree.query(geom)], geom)
+
+    @staticmethod
+    def clip_reaches(gdf: gpd.GeoDataFrame, geom) -> gpd.GeoDataFrame:
+        """Clip the reaches to the extent, sorted by nzreach as the index, since clip does not keep the row order."""
+        return gdf.clip(geom).sort_index().reset_index(drop=True)
+
+    @staticmethod
+    def save(gdf: gpd.GeoDataFrame, path):
+        """Save the river network of a region of interest to its directory."""
+        save_path = Path(path) / "river" / RIVER_NETWORK_FILE
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        gdf.to_file(save_path.as_posix())
+        logger.info(f"Save river network to {path}")
+
+    def gen(self, gdf_roi: gpd.GeoDataFrame, path):
+        """Generate the river network file of a region of interest."""
+        self.save(self.clip(self.get_extent(gdf_roi)), path)
+
+    def gen_batch(self, gdf_roi: gpd.GeoDataFrame, list_path: list):
+        """Generate the river network files of the regions of interest, one row of gdf_roi for each path."""
+        if gdf_roi.crs.to_epsg() != 2193:
+            gdf_roi = gdf_roi.to_crs(2193)
+        extents = box(*gdf_roi.buffer(10, join_style="mitre").bounds.values.T)
+        # query the reaches of all the extents at once, then group them by extent
+        index_roi, index_rec = self.tree.query(extents)
+        order = np.lexsort((index_rec, index_roi))
+        index_roi, index_rec = index_roi[order], index_rec[order]
+        split = np.searchsorted(index_roi, np.arange(len(extents) + 1))
+        for i, path in enumerate(list_path):
+            gdf = self.gdf.iloc[index_rec[split[i] : split[i + 1]]]
+            self.save(self.clip_reaches(gdf, extents[i]), path)
+
+
 def gen_river_network(gdf_roi, gdf_rec, gdf_flow, path):
-    if gdf_rec.crs.to_epsg() != 2193:
-        gdf_rec.to_crs(2193, inplace=True)
-    if gdf_roi.crs.to_epsg() != 2193:
-        gdf_roi.to_crs(2193, inplace=True)
+    """Generate the river network file of a region of interest, use RiverNetworkIndex for many regions."""
+    RiverNetworkIndex(gdf_rec, gdf_flow).gen(gdf_roi, path)
 
-    geom = box(*gdf_roi.buffer(10, join_style="mitre").total_bounds)
-    gdf_rec = gdf_rec.clip(geom)
-    gdf_rec = gdf_rec[gdf_rec["NZREACH"].isin(gdf_flow["nzreach"])]
-    gdf_rec = gdf_rec[["NZREACH", "CATCHAREA", "to_node", "from_node", "geometry"]]
-    gdf_rec = gdf_rec.astype({"NZREACH": "int64"})
-    gdf_rec = gdf_rec.sort_values(by=["NZREACH"]).reset_index(drop=True)
-    gdf_rec.rename(columns=str.lower, inplace=True)
-    gdf_flow = gdf_flow.sort_values(by=["nzreach"]).reset_index(drop=True)
 
-    gdf_rec_with_flow = gpd.GeoDataFrame(pd.merge(gdf_rec, gdf_flow, on="nzreach", how="left"))
+def get_river_row(
+    catch_id: int,
+    gdf_sdc: gpd.GeoDataFrame,
+    gdf_rec: gpd.GeoDataFrame,
+    gdf_coast: gpd.GeoDataFrame,
+    source: WaterwaySource = None,
+    coast_index: CoastIndex = None,
+    coast: shapely.Geometry = None,
+) -> Union[dict, None]:
+    """Find the OSM river and REC1 reach of a catchment, return the row of RIVER table, or None if not found."""
+    osm_id, endpoint, gdf_river, _, _ = get_osmid(
+        catch_id, gdf_sdc, gdf_coast, by="dist", source=source, coast_index=coast_index, coast=coast
+    )
+    if not osm_id:
+        logger.debug(f"No river found in catchment {catch_id}")
+        return None
+    nzreach, gdf_net, _, _ = get_recid(catch_id, gdf_sdc, gdf_rec, endpoint, by="dist")
+    if nzreach is None:
+        logger.debug(f"No REC1 found in catchment {catch_id}")
+        return None
+    return dict(
+        catch_id=int(catch_id),
+        rec_id=int(nzreach),
+        osm_id=int(osm_id),
+        rec_geometry=gdf_net.geometry.values[0],
+        osm_geometry=gdf_river.geometry.values[0],
+        created_at=pd.Timestamp.now(),
+        updated_at=pd.Timestamp.now(),
+    )
 
-    save_path = Path(path) / "river" / RIVER_NETWORK_FILE
-    save_path.parent.mkdir(parents=True, exist_ok=True)
 
-    gdf_rec_with_flow.to_file(save_path.as_posix())
-    logger.info(f"Save river network to {path}")
+class RiverContext:
+    """State of a worker shared by all its catchments, the catchments are indexed by catch_id."""
+
+    def __init__(
+        self,
+        gdf_sdc: gpd.GeoDataFrame,
+        gdf_rec: gpd.GeoDataFrame,
+        gdf_coast: gpd.GeoDataFrame,
+        osm_path: Path = None,
+        coast_index: CoastIndex = None,
+    ):
+        self.gdf_sdc = gdf_sdc.set_index(gdf_sdc["catch_id"].values)
+        self.gdf_rec = gdf_rec
+        self.gdf_rec.sindex  # build the spatial index once
+        self.gdf_coast = gdf_coast
+        self.coast = gdf_coast.unary_union
+        shapely.prepare(self.coast)
+        self.coast_index = CoastIndex(gdf_coast) if coast_index is None else coast_index
+        self.source = get_waterway_source(osm_path)
+        # no connection is kept open between batches, the context lives until the worker process exits
+        self.engine = utils.get_database(null_pool=True)
+
+    def get_catchment(self, catch_id: int) -> gpd.GeoDataFrame:
+        """Get the catchment row by catch_id."""
+        return self.gdf_sdc.loc[[catch_id]]
+
+    def get_row(self, catch_id: int) -> Union[dict, None]:
+        """Get the row of RIVER table of a catchment, see `get_river_row`."""
+        logger.info(f"*** Processing catchment {catch_id} ***")
+        return get_river_row(
+            catch_id,
+            self.get_catchment(catch_id),
+            self.gdf_rec,
+            self.gdf_coast,
+            source=self.source,
+            coast_index=self.coast_index,
+            coast=self.coast,
+        )
 
 
 def loop_proc(
@@ -349,62 +635,47 @@ def loop_proc(
     gdf_coast: gpd.GeoDataFrame,
     update: bool = False,
 ):
+    """
+    Find the OSM river and REC1 reach of a catchment and save it to table, skip the existing record unless update.
+    `run` processes the catchments by batch with a shared RiverContext instead.
+    """
     logger.info(f"*** Processing catchment {catch_id} ***")
     engine = utils.get_database(null_pool=True)
     query = f"SELECT catch_id FROM {table.__tablename__} WHERE catch_id = '{catch_id}' ;"
     df_from_db = pd.read_sql(query, engine)
+    if not df_from_db.empty and not update:
+        logger.debug(f"Skip {catch_id} due to existing record in {table.__tablename__} and update is {update}.")
+    else:
+        row = get_river_row(catch_id, gdf_sdc, gdf_rec, gdf_coast)
+        if row is not None:
+            tables.upsert_rows(engine, table, row)
+            logger.info(
+                f"{'Updated' if not df_from_db.empty else 'Add new'} {catch_id} "
+                f"in {table.__tablename__} at {pd.Timestamp.now()}."
+            )
     engine.dispose()
     gc.collect()
 
-    if df_from_db.empty or update:
-        osm_id, endpoint, gdf_river, _, gdf_waterway = get_osmid(catch_id, gdf_sdc, gdf_coast, by="dist")
-        if osm_id:
-            nzreach, gdf_net, _, gdf_rec_catch = get_recid(catch_id, gdf_sdc, gdf_rec, endpoint, by="dist")
-        else:
-            logger.debug(f"No river found in catchment {catch_id}")
-            return
-    else:
-        logger.debug(f"Skip {catch_id} due to existing record in {table.__tablename__} and update is {update}.")
-        return
 
-    if not df_from_db.empty and update:
-        query = f"""UPDATE {table.__tablename__}
-                    SET rec_id = {nzreach},
-                        osm_id = {osm_id},
-                        rec_geometry = '{gdf_net.geometry.values[0]}',
-                        osm_geometry = '{gdf_river.geometry.values[0]}',
-                        updated_at = '{pd.Timestamp.now()}'
-                    WHERE catch_id = '{catch_id}' ;"""
-        engine = utils.get_database(null_pool=True)
-        engine.execute(query)
-        engine.dispose()
-        gc.collect()
-        logger.info(f"Updated {catch_id} in {table.__tablename__} at {pd.Timestamp.now()}.")
-    elif df_from_db.empty:
-        query = f"""INSERT INTO {table.__tablename__} (
-                    catch_id,
-                    rec_id,
-                    osm_id,
-                    rec_geometry,
-                    osm_geometry,
-                    created_at,
-                    updated_at
-                    ) VALUES (
-                    {catch_id},
-                    {nzreach},
-                    {osm_id},
-                    '{gdf_net.geometry.values[0]}',
-                    '{gdf_river.geometry.values[0]}',
-                    '{pd.Timestamp.now()}',
-                    '{pd.Timestamp.now()}'
-                    ) ;"""
-        engine = utils.get_database(null_pool=True)
-        engine.execute(query)
-        engine.dispose()
-        gc.collect()
-        logger.info(f"Add new {catch_id} in {table.__tablename__} at {pd.Timestamp.now()}.")
-    else:
-        logger.debug(f"Skip {catch_id} due to existing record in {table.__tablename__} and update is {update}.")
+def _init_worker(
+    gdf_sdc: gpd.GeoDataFrame,
+    gdf_rec: gpd.GeoDataFrame,
+    gdf_coast: gpd.GeoDataFrame,
+    osm_path: Path = None,
+    coast_index: CoastIndex = None,
+) -> None:
+    """Initialise the context of a worker, which is shared by all the catchments processed in the worker."""
+    _worker.clear()
+    _worker["context"] = RiverContext(gdf_sdc, gdf_rec, gdf_coast, osm_path, coast_index=coast_index)
+
+
+def _loop_proc_worker(list_catch_id: list, table: Type[tables.Ttable]) -> int:
+    """Get the rows of a batch of catchments in a worker, write the rows of the batch at once."""
+    context = _worker["context"]
+    rows = [row for row in (context.get_row(i) for i in list_catch_id) if row is not None]
+    tables.upsert_rows(context.engine, table, rows)
+    logger.info(f"Saved {len(rows)} of {len(list_catch_id)} catchments in {table.__tablename__}.")
+    return len(rows)
 
 
 def run(
@@ -423,13 +694,15 @@ def run(
     table = tables.SDCP if catch_table is None else catch_table
 
     gdf_sdc = tables.read_postgis_table(engine, table)
-    tables.create_table(engine, tables.RIVER)
+    tables.migrate_table(engine, tables.RIVER)
+    # the existing records are skipped unless update, the others are inserted or updated by batch
+    df_exist = pd.read_sql(f"SELECT catch_id FROM {tables.RIVER.__tablename__} ;", engine)
     engine.dispose()
     gc.collect()
 
     if Path(rec_path).is_file():
         if Path(rec_path).suffix == ".shp" or Path(rec_path).suffix == ".csv":
-            gdf_rec = prep_rec(rec_path, save=True)
+            gdf_rec = prep_rec(rec_path, save=True, columns=["NZREACH", "CATCHAREA"])
         else:
             logger.error(f"File not supported {rec_path}")
             return
@@ -453,25 +726,36 @@ def run(
         logger.error(f"File not exist {coast_path}")
         return
 
+    osm_path = None
+    if os.getenv("OSM_WATERWAY_FILE"):
+        osm_path = Path(data_dir) / utils.get_env_variable("OSM_WATERWAY_FILE")
+        # prepare the local OSM waterway extract once here, the workers load the saved one
+        if not Path(osm_path).with_suffix(".parquet").is_file():
+            prep_osm_waterway(osm_path, save=True)
+
     catch_id = sorted(gdf_sdc.catch_id.to_list())
     logger.info(
         f"******* Start process from {table.__tablename__} "
         f"catch_id {sorted(catch_id)[0]} to {sorted(catch_id)[-1]} *********"
     )
-
-    if parallel:
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            pool.starmap(
-                loop_proc,
-                zip(
-                    catch_id, repeat(tables.RIVER), repeat(gdf_sdc), repeat(gdf_rec), repeat(gdf_coast), repeat(update)
-                ),
-            )
-            pool.close()
-            pool.join()
-    else:
-        for i in catch_id:
-            loop_proc(i, tables.RIVER, gdf_sdc, gdf_rec, gdf_coast, update)
+    if not update:
+        exist_id = set(df_exist["catch_id"].to_list())
+        logger.debug(f"Skip {len(exist_id)} existing records in {tables.RIVER.__tablename__} as update is {update}.")
+        catch_id = [i for i in catch_id if i not in exist_id]
+    batches = [catch_id[i : i + RIVER_BATCH_SIZE] for i in range(0, len(catch_id), RIVER_BATCH_SIZE)]
+
+    # the dataframes and the coast index built here are sent once to each worker process,
+    # not with each batch of catchments
+    coast_index = CoastIndex(gdf_coast)
+    utils.parallel_map(
+        _loop_proc_worker,
+        zip(batches, repeat(tables.RIVER)),
+        workers=None if parallel else 1,
+        chunksize=1,
+        initializer=_init_worker,
+        initargs=(gdf_sdc, gdf_rec, gdf_coast, osm_path, coast_index),
+        star=True,
+    )
 
     logger.info(f"Finished process {tables.RIVER.__tablename__} at {pd.Timestamp.now()}.")
 
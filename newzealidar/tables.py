@@ -3,15 +3,29 @@
 This module is used to define the database tables and utility functions for the tables.
 """
 import logging
-from typing import Type, TypeVar, Union
+from datetime import timedelta
+from typing import Iterator, Type, TypeVar, Union
 import gc
+import os
+import socket
 
 import geopandas as gpd
 import pandas as pd
 import shapely
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, Integer, Float, String, Interval, Date, DateTime, inspect
-from sqlalchemy.dialects.postgresql import UUID
+from geoalchemy2.shape import from_shape
+from sqlalchemy import (
+    Column,
+    Integer,
+    Float,
+    String,
+    Interval,
+    Date,
+    DateTime,
+    inspect,
+    text,
+)
+from sqlalchemy.dialects.postgresql import UUID, insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine import Engine
 
@@ -25,6 +39,21 @@ Ttable = TypeVar("Ttable", bound=Base)
 EPS = 0.1  # epsilons for small float number convenience.
 CATCHMENT_RESOLUTION = 30  # resolution of catchment geometry
 
+# tables and geometry columns already checked by `check_spatial_index`
+_spatial_index_checked = set()
+# tables and index columns already checked by `migrate_table`
+_unique_index_checked = set()
+
+# status of jobs in runtime table
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+# a running job without heartbeat for this timespan is treated as interrupted, see `requeue_jobs`
+JOB_STALE = timedelta(minutes=30)
+# interval to refresh `updated_at` of the running jobs of a runner, see `heartbeat_jobs`
+JOB_HEARTBEAT = timedelta(minutes=1)
+
 
 # define dataset table
 class DATASET(Base):
@@ -293,15 +322,50 @@ class COAST(Base):
 # record the process status for each catchment
 class RUNTIME(Base):
     __tablename__: str = "runtime"
+    job = Column(
+        String, primary_key=True, comment="job name, e.g. raw, hydro or grid"
+    )
     catch_id = Column(
-        Integer, primary_key=True, comment="catchment index"
+        Integer, primary_key=True, comment="catchment or grid index"
     )  # catchment region id
-
+    status = Column(
+        String, index=True, comment="job status: queued, running, done or failed"
+    )
+    attempts = Column(Integer, default=0, comment="number of times the job claimed")
+    worker = Column(String, comment="host:pid of the process claimed the job")
     runtime = Column(Interval, comment="timespan for the catchment processing")
+    message = Column(String, comment="status message, e.g. reason of failure")
+    started_at = Column(DateTime, comment="the latest time the job claimed")
+    finished_at = Column(DateTime, comment="the latest time the job finished")
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
 
 
+# record the completion of each stage of a pipeline, e.g. catchments module
+class STAGE(Base):
+    __tablename__: str = "stage"
+    stage = Column(
+        String, primary_key=True, comment="stage name, e.g. catchments.extend_sdcp"
+    )
+    input_fingerprint = Column(String, comment="fingerprint of the stage inputs")
+    output_fingerprint = Column(String, comment="fingerprint of the stage outputs")
+    runtime = Column(Interval, comment="timespan for the stage processing")
+    started_at = Column(DateTime, comment="the latest time the stage started")
+    finished_at = Column(DateTime, comment="the latest time the stage finished")
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+
+
+# record the changed catchments of the latest catchments pipeline run, to rebuild their DEMs only
+class CHANGE(Base):
+    __tablename__: str = "catchment_change"
+    catch_id = Column(
+        Integer, primary_key=True, comment="catchment index"
+    )  # catchment region id
+    change = Column(String, comment="change type: added, modified or removed")
+    created_at = Column(DateTime)
+
+
 # define grid table
 class GRID(Base):
     __tablename__: str = "grid"
@@ -342,6 +406,17 @@ class GRIDDEMATTR(Base):
     updated_at = Column(DateTime)
 
 
+# tables written by `upsert_rows` and their index columns, see `migrate_tables`
+UPSERT_TABLES = {
+    DEM: "catch_id",
+    DEMATTR: "catch_id",
+    RIVER: "catch_id",
+    GRIDDEM: "grid_id",
+    GRIDDEMATTR: "grid_id",
+    STAGE: "stage",
+}
+
+
 def create_table(engine: Engine, table: Type[Ttable]) -> None:
     """Create table if it doesn't exist."""
     table.__table__.create(bind=engine, checkfirst=True)
@@ -367,6 +442,61 @@ def delete_table(
     engine.execute(query)
 
 
+def _bind_geometry(rows: list) -> list:
+    """Bind the shapely geometries of rows as WKB in EPSG:2193."""
+    return [
+        {
+            k: from_shape(v, srid=2193) if isinstance(v, shapely.Geometry) else v
+            for k, v in row.items()
+        }
+        for row in rows
+    ]
+
+
+def insert_rows(engine: Engine, table: Type[Ttable], rows: Union[dict, list]) -> None:
+    """
+    Insert rows into table in one executemany statement, the shapely geometries are bound as WKB.
+
+    :param engine: database engine
+    :param table: table class
+    :param rows: a row or a list of rows as {column: value}, all rows must have the same columns
+    """
+    rows = rows if isinstance(rows, list) else [rows]
+    if not len(rows):
+        return
+    engine.execute(insert(table.__table__), _bind_geometry(rows))
+
+
+def upsert_rows(
+    engine: Engine,
+    table: Type[Ttable],
+    rows: Union[dict, list],
+    index_column: str = "catch_id",
+) -> None:
+    """
+    Insert rows into table, or update the existing rows on conflict of the index column,
+    all rows are sent in one executemany statement and the shapely geometries are bound as WKB.
+    `created_at` of the existing rows is kept.
+    `ON CONFLICT` needs a primary key or unique index on the index column, the tables created without it,
+    e.g. by `to_postgis`, are migrated by `migrate_table` before the run.
+
+    :param engine: database engine
+    :param table: table class
+    :param rows: a row or a list of rows as {column: value}, all rows must have the same columns
+    :param index_column: the unique index column of the table
+    """
+    rows = rows if isinstance(rows, list) else [rows]
+    if not len(rows):
+        return
+    rows = _bind_geometry(rows)
+    stmt = insert(table.__table__)
+    columns = [c for c in rows[0] if c not in (index_column, "created_at")]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[index_column], set_={c: stmt.excluded[c] for c in columns}
+    )
+    engine.execute(stmt, rows)
+
+
 def prepare_to_db(
     gdf_in: gpd.GeoDataFrame, check_empty: bool = True
 ) -> gpd.GeoDataFrame:
@@ -588,14 +718,15 @@ def get_data_by_id(
     index: Union[int, str, list],
     index_column: str = "catch_id",
     geom_col: str = "geometry",
+    columns: str = "*",
 ) -> gpd.GeoDataFrame:
-    """retrieve db by id to get catchment boundary geometry"""
+    """retrieve db by id to get catchment boundary geometry, or only the given columns"""
     if not isinstance(index, list):
         index = [index]
     retrieve_index = tuple(index) if len(index) > 1 else str(f"({index[0]})")
     if not isinstance(table, str):
         table = table.__tablename__
-    query = f"SELECT * FROM {table} WHERE {index_column} IN {retrieve_index} ;"
+    query = f"SELECT {columns} FROM {table} WHERE {index_column} IN {retrieve_index} ;"
     if len(geom_col):
         df = gpd.read_postgis(query, engine, geom_col=geom_col)
     else:
@@ -819,3 +950,385 @@ def get_split_catchment_by_id(
         else sorted(list(set(gdf["super_id"].to_list())))
     )
     return result
+
+
+def check_spatial_index(
+    engine: Engine, table: Union[str, Type[Ttable]], column: str = "geometry"
+) -> None:
+    """
+    Check if the geometry column of table has GIST index, create the index if not.
+    Each table is only checked once in a process.
+    """
+    if not isinstance(table, str):
+        table = table.__tablename__
+    if (table, column) in _spatial_index_checked:
+        return
+    query = f"""SELECT indexdef FROM pg_indexes WHERE tablename = '{table}' ;"""
+    indexdef = [row[0].lower() for row in engine.execute(query).fetchall()]
+    if not any("using gist" in i and f"({column})" in i for i in indexdef):
+        logger.info(f"Create GIST index on {table}.{column}.")
+        engine.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} USING GIST ({column}) ;"
+        )
+    _spatial_index_checked.add((table, column))
+
+
+def get_duplicates(
+    engine: Engine, table: Union[str, Type[Ttable]], column: str = "catch_id"
+) -> list:
+    """Get the values of the column appearing more than once in table."""
+    if not isinstance(table, str):
+        table = table.__tablename__
+    query = f"""SELECT {column} FROM {table} GROUP BY {column} HAVING COUNT(*) > 1 ;"""
+    return sorted(row[0] for row in engine.execute(query).fetchall())
+
+
+def migrate_table(
+    engine: Engine, table: Type[Ttable], column: str = "catch_id"
+) -> None:
+    """
+    Create table if it doesn't exist, and the unique index on the column if the existing table has no
+    primary key or unique index on it, e.g. created by `to_postgis`, which `upsert_rows` needs.
+    It raises ValueError with the duplicate values if the column is not unique, they must be cleaned first.
+    Each table is only checked once in a process.
+    """
+    create_table(engine, table)
+    name = table.__tablename__
+    if (name, column) in _unique_index_checked:
+        return
+    query = f"""SELECT indexdef FROM pg_indexes WHERE tablename = '{name}' ;"""
+    indexdef = [row[0].lower() for row in engine.execute(query).fetchall()]
+    if not any("unique index" in i and i.endswith(f"({column})") for i in indexdef):
+        duplicates = get_duplicates(engine, name, column)
+        if len(duplicates):
+            raise ValueError(
+                f"Table {name} has {len(duplicates)} duplicate {column}: {duplicates}, "
+                f"clean them before creating the unique index."
+            )
+        logger.info(f"Create unique index on {name}.{column}.")
+        engine.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS uidx_{name}_{column} ON {name} ({column}) ;"
+        )
+    _unique_index_checked.add((name, column))
+
+
+def migrate_tables(engine: Engine) -> None:
+    """
+    Migrate all tables written by `upsert_rows`, log the duplicates of the tables which can not be migrated.
+    It can be run once by `python -m newzealidar.tables` before the processing.
+    """
+    for table, column in UPSERT_TABLES.items():
+        try:
+            migrate_table(engine, table, column)
+        except ValueError as e:
+            logger.error(e)
+
+
+def get_split_mapping(engine: Engine, index: list) -> dict:
+    """
+    Get split subordinate catchment ids of all superior catchment ids in one query.
+
+    :param engine: database engine
+    :param index: superior catchment ids
+    :return: {super_id: sorted subordinate catchment ids}
+    """
+    if not len(index):
+        return {}
+    retrieve_index = tuple(index) if len(index) > 1 else str(f"({index[0]})")
+    query = f"""SELECT super_id, catch_id FROM {SDCS.__tablename__}
+                WHERE super_id IN {retrieve_index} ;"""
+    df = pd.read_sql(query, engine)
+    return {k: sorted(v.to_list()) for k, v in df.groupby("super_id")["catch_id"]}
+
+
+def get_table_fingerprint(
+    engine: Engine, table: Union[str, Type[Ttable]], column: str = None
+) -> str:
+    """
+    Get the fingerprint of a table, as the row count plus the md5 of all rows regardless of the order.
+    The fingerprint changes if any row of the table is added, deleted or updated.
+
+    :param engine: database engine
+    :param table: table name or table class
+    :param column: only hash this column of the rows, e.g. 'geometry', default is the whole row
+    """
+    if not isinstance(table, str):
+        table = table.__tablename__
+    value = "t" if column is None else f"t.{column}"
+    query = f"""SELECT COUNT(*), md5(string_agg(md5({value}::text), '' ORDER BY md5({value}::text)))
+                FROM {table} AS t ;"""
+    count, digest = engine.execute(query).fetchone()
+    return f"{count}_{digest}"
+
+
+def get_worker_name() -> str:
+    """Get the name of current process to record in runtime table, as host:pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_worker_alive(worker: str) -> bool:
+    """
+    Check if the process of a worker name (host:pid) is alive.
+    Only the processes on this host can be checked, the processes on other hosts are taken as alive.
+    """
+    host, _, pid = str(worker).rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # the process exists but is owned by another user
+        return True
+    return True
+
+
+def create_runtime_table(engine: Engine) -> None:
+    """
+    Create runtime table of the job queue if it doesn't exist.
+    The runtime table of the former schema, keyed by catch_id only, is dropped and recreated,
+    as it was never written and `create_table` leaves an existing table untouched.
+    """
+    if is_table_exist(engine, RUNTIME):
+        columns = [c["name"] for c in inspect(engine).get_columns(RUNTIME.__tablename__)]
+        if "job" not in columns:
+            logger.warning(f"Recreate table {RUNTIME.__tablename__} of the former schema for job queue.")
+            delete_table(engine, RUNTIME, keep_schema=False)
+    create_table(engine, RUNTIME)
+
+
+def enqueue_jobs(
+    engine: Engine,
+    job: str,
+    index: list,
+    reset: bool = False,
+    done_table: Union[Type[Ttable], str] = None,
+    done_column: str = "catch_id",
+) -> None:
+    """
+    Add catchments into runtime table as queued jobs.
+    Existing jobs keep their status, so a killed run resumes from where it stopped.
+
+    :param engine: database engine
+    :param job: job name, e.g. 'raw', 'hydro' or 'grid'
+    :param index: catchment id list
+    :param reset: if True, set the existing jobs back to queued, e.g. in update mode
+    :param done_table: if set, the new jobs which already exist in this table are set as done,
+        to seed the queue from results generated before the queue was used
+    :param done_column: the index column of done_table
+    """
+    create_runtime_table(engine)
+    if not len(index):
+        return
+    if done_table is not None and not isinstance(done_table, str):
+        done_table = done_table.__tablename__
+    if done_table is not None and is_table_exist(engine, done_table):
+        status = f"""CASE WHEN EXISTS (
+                         SELECT 1 FROM {done_table} WHERE {done_column} = :catch_id
+                     ) THEN '{JOB_DONE}' ELSE '{JOB_QUEUED}' END"""
+    else:
+        status = f"'{JOB_QUEUED}'"
+    if reset:
+        conflict = f"""DO UPDATE SET status = '{JOB_QUEUED}', attempts = 0, worker = NULL,
+                       message = NULL, updated_at = now()"""
+    else:
+        conflict = "DO NOTHING"
+    query = text(
+        f"""INSERT INTO {RUNTIME.__tablename__} (job, catch_id, status, attempts, created_at)
+            VALUES (:job, :catch_id, {status}, 0, now())
+            ON CONFLICT (job, catch_id) {conflict} ;"""
+    )
+    engine.execute(query, [{"job": job, "catch_id": int(i)} for i in index])
+
+
+def requeue_jobs(
+    engine: Engine,
+    job: str,
+    max_attempts: int = 3,
+    stale: timedelta = JOB_STALE,
+) -> int:
+    """
+    Set interrupted and failed jobs back to queued.
+
+    A running job is interrupted only if the process claimed it is gone: the process on this host is not alive,
+    or the job has no heartbeat (`updated_at`, see `heartbeat_jobs`) for `stale`, e.g. the runner crashed on
+    another host. So the running jobs of another runner alive on any host are never requeued.
+    The failed jobs are retried if they failed less than `max_attempts` times.
+
+    :param engine: database engine
+    :param job: job name
+    :param max_attempts: the max number of attempts of a failed job
+    :param stale: the timespan without heartbeat after which a running job is treated as interrupted,
+        if None, only the running jobs of the processes gone on this host are requeued
+    :return: the number of requeued jobs
+    """
+    create_runtime_table(engine)
+    query = text(
+        f"""SELECT DISTINCT worker FROM {RUNTIME.__tablename__}
+            WHERE job = :job AND status = '{JOB_RUNNING}' AND worker LIKE :host ;"""
+    )
+    rows = engine.execute(query, job=job, host=f"{socket.gethostname()}:%").fetchall()
+    dead = [row[0] for row in rows if not is_worker_alive(row[0])]
+    condition = "worker = ANY(:dead)"
+    if stale is not None:
+        condition += " OR updated_at < now() - :stale"
+    query = text(
+        f"""UPDATE {RUNTIME.__tablename__}
+            SET status = '{JOB_QUEUED}', updated_at = now()
+            WHERE job = :job AND (
+                (status = '{JOB_RUNNING}' AND ({condition}))
+                OR (status = '{JOB_FAILED}' AND attempts < :max_attempts)
+            ) ;"""
+    )
+    result = engine.execute(
+        query,
+        job=job,
+        dead=dead,
+        stale=stale,
+        max_attempts=max_attempts,
+    )
+    return result.rowcount
+
+
+def heartbeat_jobs(engine: Engine, job: str, worker: str = None) -> int:
+    """
+    Refresh `updated_at` of the running jobs claimed by a worker, so they are not requeued as stale.
+
+    :param engine: database engine
+    :param job: job name
+    :param worker: the name of the claiming process, default is host:pid of current process
+    :return: the number of running jobs of the worker
+    """
+    worker = get_worker_name() if worker is None else worker
+    query = text(
+        f"""UPDATE {RUNTIME.__tablename__} SET updated_at = now()
+            WHERE job = :job AND status = '{JOB_RUNNING}' AND worker = :worker ;"""
+    )
+    return engine.execute(query, job=job, worker=worker).rowcount
+
+
+def claim_job(
+    engine: Engine, job: str, index: list = None, worker: str = None
+) -> Union[int, None]:
+    """
+    Claim the next queued job atomically, return its catchment id or None if the queue is drained.
+    `FOR UPDATE SKIP LOCKED` guarantees concurrent runners never claim the same job.
+
+    :param engine: database engine
+    :param job: job name
+    :param index: if set, only claim the jobs of these catchment ids
+    :param worker: the name of the claiming process, default is host:pid of current process
+    """
+    worker = get_worker_name() if worker is None else worker
+    condition = "" if index is None else "AND catch_id = ANY(:index)"
+    query = text(
+        f"""UPDATE {RUNTIME.__tablename__}
+            SET status = '{JOB_RUNNING}', attempts = attempts + 1, worker = :worker,
+                started_at = now(), finished_at = NULL, updated_at = now()
+            WHERE (job, catch_id) = (
+                SELECT job, catch_id FROM {RUNTIME.__tablename__}
+                WHERE job = :job AND status = '{JOB_QUEUED}' {condition}
+                ORDER BY catch_id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING catch_id ;"""
+    )
+    index = None if index is None else [int(i) for i in index]
+    row = engine.execute(query, job=job, worker=worker, index=index).fetchone()
+    return None if row is None else row[0]
+
+
+def claim_jobs(
+    engine: Engine, job: str, index: list = None, worker: str = None
+) -> Iterator[int]:
+    """Generate catchment ids by claiming queued jobs one by one until the queue is drained."""
+    while True:
+        catch_id = claim_job(engine, job, index=index, worker=worker)
+        if catch_id is None:
+            return
+        yield catch_id
+
+
+def finish_job(
+    engine: Engine,
+    job: str,
+    index: Union[int, str],
+    status: str = JOB_DONE,
+    runtime: timedelta = None,
+    message: str = None,
+) -> None:
+    """Record the final status of a job in runtime table."""
+    query = text(
+        f"""UPDATE {RUNTIME.__tablename__}
+            SET status = :status, runtime = :runtime, message = :message,
+                finished_at = now(), updated_at = now()
+            WHERE job = :job AND catch_id = :catch_id ;"""
+    )
+    engine.execute(
+        query,
+        job=job,
+        catch_id=int(index),
+        status=status,
+        runtime=runtime,
+        message=message,
+    )
+
+
+def get_job_summary(engine: Engine, job: str) -> dict:
+    """Get the number of jobs of each status."""
+    query = text(
+        f"""SELECT status, COUNT(*) FROM {RUNTIME.__tablename__}
+            WHERE job = :job GROUP BY status ;"""
+    )
+    return {row[0]: row[1] for row in engine.execute(query, job=job).fetchall()}
+
+
+def get_stage(engine: Engine, stage: str) -> Union[dict, None]:
+    """Get the record of a stage from stage table, None if the stage has not finished."""
+    if not is_table_exist(engine, STAGE):
+        return None
+    query = f"SELECT * FROM {STAGE.__tablename__} WHERE stage = :stage ;"
+    row = engine.execute(text(query), stage=stage).fetchone()
+    return dict(row) if row is not None else None
+
+
+def finish_stage(
+    engine: Engine,
+    stage: str,
+    input_fingerprint: str,
+    output_fingerprint: str,
+    started_at: pd.Timestamp,
+) -> None:
+    """Record the completion of a stage with its input and output fingerprints and runtime in stage table."""
+    migrate_table(engine, STAGE, "stage")
+    finished_at = pd.Timestamp.now()
+    row = {
+        "stage": stage,
+        "input_fingerprint": input_fingerprint,
+        "output_fingerprint": output_fingerprint,
+        "runtime": (finished_at - started_at).to_pytimedelta(),
+        "started_at": started_at.to_pydatetime(),
+        "finished_at": finished_at.to_pydatetime(),
+        "created_at": finished_at.to_pydatetime(),
+        "updated_at": finished_at.to_pydatetime(),
+    }
+    upsert_rows(engine, STAGE, row, index_column="stage")
+
+
+def get_geometry_hash(
+    engine: Engine, table: Union[str, Type[Ttable]], index_column: str = "catch_id"
+) -> pd.DataFrame:
+    """Get md5 of WKB geometry of each row in table, as columns [index_column, 'hash']."""
+    if not isinstance(table, str):
+        table = table.__tablename__
+    query = f"SELECT {index_column}, md5(ST_AsBinary(geometry)) AS hash FROM {table} ;"
+    return pd.read_sql(query, engine)
+
+
+if __name__ == "__main__":
+    from newzealidar import logs
+
+    logs.setup_logging()
+
+    migrate_tables(utils.get_database())
@@ -2,32 +2,39 @@
 """
 This module contains utility functions for the package.
 """
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 from pathlib import Path, PurePosixPath
 import shutil
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from fnmatch import fnmatch
-from typing import Type, TypeVar, Union
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Type, TypeVar, Union
 
 import geojson
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 
 import rasterio as rio
-from rasterio.features import dataset_features
+from rasterio.features import shapes
 import rioxarray as rxr
 from rioxarray import merge
+from rioxarray.exceptions import NoDataInBounds
 
 # import xarray as xr
 from dotenv import load_dotenv
 import shapely
 import shapely.wkt
 from shapely import unary_union, to_geojson
-from shapely.geometry import MultiPolygon, Polygon, GeometryCollection, box
-from sqlalchemy import create_engine
+from shapely.geometry import MultiPolygon, Polygon, GeometryCollection, box, shape
+from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.pool import NullPool
@@ -182,6 +189,170 @@ def timeit(f):
     return wrapper
 
 
+class BrokenWorkerError(BrokenProcessPool):
+    """A worker process terminated abruptly, e.g. segfault or out of memory, the unfinished items are in `failed`."""
+
+    def __init__(self, message: str, failed: list, results: list = None):
+        super().__init__(message)
+        self.failed = failed
+        self.results = results
+
+
+def _get_item_name(item) -> str:
+    """Get the name of an item of a worker pool for logging, the first element of a tuple item is its id."""
+    return str(item[0] if isinstance(item, tuple) and len(item) else item)[:100]
+
+
+def _log_failed_items(failed: list, total: int) -> str:
+    """Log the unfinished items of a broken worker pool, return the message."""
+    message = (
+        f"A worker process terminated abruptly, {len(failed)} of {total} items are not finished: "
+        f"{[_get_item_name(item) for item in failed]}"
+    )
+    logger.error(message)
+    return message
+
+
+def parallel_imap(
+    func: Callable,
+    iterable: Iterable,
+    workers: int = 1,
+    initializer: Callable = None,
+    initargs: tuple = (),
+) -> Iterator:
+    """
+    Apply func to each item of iterable in a pool of worker processes, yield the results as they are completed.
+    Items are pulled from the iterable only when a worker is free, so the iterable can be a lazy generator.
+    Worker processes are spawned rather than forked, to not inherit database connections and threads of the parent.
+    If a worker process terminates abruptly, the results already completed are still yielded,
+    then BrokenWorkerError is raised with the submitted but unfinished items, the other items are left in iterable.
+
+    :param func: module level function to apply, must not raise for expected failures of an item.
+    :param iterable: input items of func.
+    :param workers: number of worker processes, run in the current process if it is 1.
+    :param initializer: function to set up the state of each worker process, also called once in serial mode.
+    :param initargs: arguments of the initializer.
+    """
+    items = iter(iterable)
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield func(item)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    failed = []
+    total = 0
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=initializer, initargs=initargs
+    ) as executor:
+        pending = {executor.submit(func, item): item for item in islice(items, workers)}
+        total += len(pending)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    failed.append(item)
+                    continue
+                if not failed:
+                    for next_item in islice(items, 1):
+                        total += 1
+                        try:
+                            pending[executor.submit(func, next_item)] = next_item
+                        except BrokenProcessPool:
+                            failed.append(next_item)
+                yield result
+    if failed:
+        raise BrokenWorkerError(_log_failed_items(failed, total), failed)
+
+
+def get_number_of_workers(workers: int = None) -> int:
+    """Get number of worker processes, from the NUM_WORKERS environment variable if not given, default is cpu count."""
+    if workers is None:
+        workers = int(os.getenv("NUM_WORKERS") or multiprocessing.cpu_count())
+    return max(1, workers)
+
+
+def _init_pool_worker(initializer: Callable = None, initargs: tuple = ()) -> None:
+    """Set up logging of a spawned worker process, then call the initializer of the pool."""
+    if os.getenv("LOG_CFG"):
+        from newzealidar import logs  # logs imports utils
+
+        logs.setup_logging()  # spawned worker process does not inherit logging configuration
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _apply_chunk(func: Callable, chunk: list, star: bool = False) -> list:
+    """Apply func to each item of a chunk in a worker process."""
+    return [func(*item) if star else func(item) for item in chunk]
+
+
+def parallel_map(
+    func: Callable,
+    iterable: Iterable,
+    workers: int = None,
+    chunksize: int = None,
+    initializer: Callable = None,
+    initargs: tuple = (),
+    star: bool = False,
+) -> list:
+    """
+    Apply func to each item of iterable in a pool of worker processes, return the results in the order of items.
+    Worker processes are spawned rather than forked, to not inherit database connections and threads of the parent.
+    Items and results are pickled to and from the workers, shapely geometries are transferred as WKB,
+    large data shared by all items should be passed once per worker by the initializer instead of with each item.
+    If a worker process terminates abruptly, BrokenWorkerError is raised after all chunks are finished or failed,
+    with the unfinished items in `failed` and the results in `results`, None for the unfinished items.
+
+    :param func: module level function to apply.
+    :param iterable: input items of func.
+    :param workers: number of worker processes, default is NUM_WORKERS environment variable or cpu count,
+        run in the current process if it is 1.
+    :param chunksize: number of items sent to a worker at a time, default is to split items into 4 chunks per worker.
+    :param initializer: module level function to set up the state of each worker process,
+        also called once in serial mode.
+    :param initargs: arguments of the initializer.
+    :param star: unpack each item as the arguments of func, as `starmap`.
+    """
+    items = list(iterable)
+    workers = min(get_number_of_workers(workers), len(items))
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return _apply_chunk(func, items, star)
+
+    if chunksize is None:
+        chunksize = max(1, -(-len(items) // (workers * 4)))
+    chunks = [items[i : i + chunksize] for i in range(0, len(items), chunksize)]
+    list_result = []
+    failed = []
+    context = multiprocessing.get_context("spawn")
+    # the executor detects a worker process terminated abruptly, while multiprocessing.Pool waits for it forever
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=_init_pool_worker, initargs=(initializer, initargs)
+    ) as executor:
+        futures = [executor.submit(_apply_chunk, func, chunk, star) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                list_result.extend(future.result())
+            except BrokenProcessPool:
+                list_result.extend([None] * len(chunk))
+                failed.extend(chunk)
+    if failed:
+        raise BrokenWorkerError(_log_failed_items(failed, len(items)), failed, list_result)
+    return list_result
+
+
+def get_geometry_hash(geometry: Union[gpd.GeoSeries, np.ndarray, list]) -> list:
+    """Get md5 hex digest of WKB of each geometry, to identify the geometry changes."""
+    return [hashlib.md5(wkb).hexdigest() for wkb in shapely.to_wkb(np.asarray(geometry))]
+
+
 def cast_geodataframe(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
     cast data type of geodataframe to correct type to avoid error when saving to database.
@@ -313,23 +484,42 @@ def get_geometry_from_db(
     return geom.buffer(buffer, join_style="mitre") if buffer != 0 else geom
 
 
-def get_extent_from_dem(dem_file: Union[str, Path], extent_file: Union[str, Path] = None):
+def get_extent_from_dem(
+    dem_file: Union[str, Path],
+    extent_file: Union[str, Path] = None,
+    coarsen: int = 1,
+    tolerance: Union[int, float] = 0,
+    bbox: bool = False,
+):
     """
-    get the extent of the dem netcdf file.
+    get the extent of the dem netcdf file, by polygonising the valid data mask of `z` band in memory.
+
+    :param dem_file: dem netcdf file
+    :param extent_file: output extent geojson file
+    :param coarsen: polygonise the mask at coarsen times of the dem resolution,
+        a coarse pixel is valid if any of its dem pixels is valid. default is 1, the dem resolution.
+    :param tolerance: simplify tolerance of the extent in meters, default is 0, no simplification.
+    :param bbox: if True, only get the bbox of the dem, same as `get_boundary_from_dem`.
     """
+    if bbox:
+        get_boundary_from_dem(dem_file, extent_file)
+        return
     with rxr.open_rasterio(dem_file) as rds:
-        rds.z.rio.to_raster(Path(dem_file).parent / Path("_tmp.tif"))
-    with rio.open(Path(dem_file).parent / Path("_tmp.tif")) as src:
-        gdf = gpd.GeoDataFrame.from_features(
-            dataset_features(
-                src,
-                bidx=1,
-                as_mask=True,
-                geographic=False,
-                band=False,
-                with_nodata=False,
-            )
-        )
+        z = rds.z.squeeze(drop=True)
+        transform = z.rio.transform()
+        crs = rds.rio.crs
+        nodata = z.rio.nodata
+        mask = z.notnull().values
+        if nodata is not None and not np.isnan(nodata):
+            mask &= z.values != nodata
+    if coarsen > 1:
+        mask = np.pad(mask, ((0, -mask.shape[0] % coarsen), (0, -mask.shape[1] % coarsen)), constant_values=False)
+        mask = mask.reshape(mask.shape[0] // coarsen, coarsen, mask.shape[1] // coarsen, coarsen).any(axis=(1, 3))
+        transform = transform * rio.Affine.scale(coarsen)
+    geoms = [shape(geom) for geom, _ in shapes(mask.astype("uint8"), mask=mask, connectivity=4, transform=transform)]
+    gdf = gpd.GeoDataFrame(geometry=geoms, crs=crs)
+    if tolerance > 0:
+        gdf["geometry"] = gdf.simplify(tolerance)
     try:
         if gdf.crs is None:
             gdf.crs = "epsg:2193"
@@ -337,7 +527,6 @@ def get_extent_from_dem(dem_file: Union[str, Path], extent_file: Union[str, Path
             logger.info(f"DEM crs is {gdf.crs}, not epsg:2193.")
             gdf.to_crs(epsg=2193, inplace=True)
         gdf.to_file(extent_file, driver="GeoJSON")
-        Path(Path(dem_file).parent / Path("_tmp.tif")).unlink()
     except Exception as e:
         logger.error(f"Cannot get extent from {dem_file}.\n{e}")
 
@@ -404,37 +593,42 @@ def retrieve_lidar(
 ) -> OrderedDict:
     """
     Read catchment geometry from boundary_file,
-    query dataset to get dataset name which intersect with the input geometry,
-    sort the dataset name by 'sort_by',
-    then retrieve the .laz file path, tile index file from tile table and lidar table,
+    query dataset, tile and lidar tables in one joined query to get the .laz file paths of the datasets
+    which intersect with the input geometry, sort the dataset name by 'sort_by',
     in the end return a dictionary of dataset name, crs, .laz file path and tile index file.
     """
-    datasets_dict, geometry, tile_path_list, _ = retrieve_dataset(engine, boundary_file, sort_by, buffer=buffer)
-    list_pop_dataset = []
-    for dataset_name in datasets_dict.keys():
-        query = f"""SELECT uuid, geometry FROM tile
-                    WHERE ST_Intersects(geometry, ST_SetSRID('{geometry}'::geometry, 2193))
-                    AND dataset = '{dataset_name}' ;"""
-        gdf = gpd.read_postgis(query, engine, geom_col="geometry")
-        if gdf.empty:
+    geometry = get_geometry_from_file(boundary_file, buffer=buffer)
+    for table in (tables.DATASET, tables.TILE):
+        tables.check_spatial_index(engine, table)
+    query = f"""WITH roi AS (SELECT ST_SetSRID(ST_GeomFromWKB(:wkb), 2193) AS geometry)
+                SELECT d.name, d.{sort_by}, d.tile_path, t.uuid, l.file_path
+                FROM roi
+                JOIN {tables.DATASET.__tablename__} AS d ON ST_Intersects(d.geometry, roi.geometry)
+                LEFT JOIN {tables.TILE.__tablename__} AS t
+                    ON t.dataset = d.name AND ST_Intersects(t.geometry, roi.geometry)
+                LEFT JOIN {tables.LIDAR.__tablename__} AS l ON l.uuid = t.uuid ;"""
+    df = pd.read_sql(text(query), engine, params={"wkb": shapely.to_wkb(geometry)})
+    df = df.sort_values(sort_by, ascending=False, kind="stable")  # latest/largest first
+    tile_path_list = df.drop_duplicates("name")["tile_path"].to_list()
+    datasets_dict = OrderedDict()
+    for dataset_name, df_dataset in df.groupby("name", sort=False):
+        if df_dataset["uuid"].isna().all():
             logger.warning(
                 f"{dataset_name} does not have any tile in the ROI geometry, will pop the dataset. "
                 f"The reason may be the dataset extent in .kml file is larger than "
                 f"the tile extent in tile.zip file."
             )
-            list_pop_dataset.append(dataset_name)
             continue
-        uuid = tuple(gdf["uuid"].to_list()) if len(gdf) > 1 else str(f"""('{gdf["uuid"].values[0]}')""")
-        query = f"SELECT file_path FROM lidar WHERE uuid IN {uuid} ;"
-        df = pd.read_sql(query, engine)
-        if df.empty:
+        if df_dataset["file_path"].isna().all():
             logger.warning(
                 f"{dataset_name} does not have any .laz file in the ROI geometry, will pop the dataset. "
                 f"The reason may be the dataset lidar files are not downloaded completely."
             )
-            list_pop_dataset.append(dataset_name)
             continue
-        datasets_dict[dataset_name]["file_paths"] = [PurePosixPath(p) for p in sorted(df["file_path"].to_list())]
+        datasets_dict[dataset_name] = {"crs": {"horizontal": 2193, "vertical": 7839}}
+        datasets_dict[dataset_name]["file_paths"] = [
+            PurePosixPath(p) for p in sorted(df_dataset["file_path"].dropna().unique())
+        ]
         if "LiDAR_" in dataset_name:  # to handle waikato datasets
             _dataset_name = "_".join(dataset_name.split("_")[:2])
             datasets_dict[dataset_name]["tile_index_file"] = [
@@ -449,9 +643,6 @@ def retrieve_lidar(
             f'{len(datasets_dict[dataset_name]["file_paths"])} lidar files in '
             f"ROI with buffer distance {buffer} mitre."
         )
-    if list_pop_dataset:
-        for dataset_name in list_pop_dataset:
-            datasets_dict.pop(dataset_name)
     return datasets_dict
 
 
@@ -565,6 +756,22 @@ def filter_geometry(
         assert geometry.area >= polygon_threshold, "Input geometry is smaller than threshold."
     else:
         geometry = MultiPolygon([p for p in geometry.geoms if p.area > polygon_threshold])
+    geometry = smooth_geometry(geometry, resolution=resolution)
+    # remove holes
+    geometry = remove_holes(geometry, keep_threshold=hole_threshold)
+
+    return geometry
+
+
+def smooth_geometry(
+    geometry: Union[Polygon, MultiPolygon], resolution: Union[int, float] = CATCHMENT_RESOLUTION
+) -> Union[Polygon, MultiPolygon]:
+    """
+    remove spikes and clean boundary of geometry, the geometry within resolution of its boundary may change.
+
+    :param geometry: input geometry
+    :param resolution: resolution of the in put geometry in meters
+    """
     # remove spikes
     geometry = (
         geometry.buffer(-EPS, join_style="mitre").buffer(EPS * 2, join_style="mitre").buffer(-EPS, join_style="mitre")
@@ -574,113 +781,132 @@ def filter_geometry(
     geometry = (
         geometry.buffer(eps, join_style="mitre").buffer(-eps * 2, join_style="mitre").buffer(eps, join_style="mitre")
     )
-    # remove holes
-    geometry = remove_holes(geometry, keep_threshold=hole_threshold)
-
     return geometry
 
 
 # @timeit
-def fishnet(geometry: shapely.Geometry, threshold: Union[int, float], lrbu=False) -> list:
+def fishnet(
+    geometry: shapely.Geometry, threshold: Union[int, float], lrbu: bool = False, crs: Union[int, str] = None
+) -> gpd.GeoSeries:
     """
-    create fishnet grid based on the geometry and threshold
+    create fishnet grid based on the geometry and threshold, the cells are created and clipped by bulk operations.
+
     :param geometry: input geometry
     :param threshold: threshold of the grid
-    :param l2r_b2u: if True, create grid from left to right and bottom to up,
-    otherwise from bottom to top and left to right
+    :param lrbu: if True, create grid from left to right and bottom to up,
+        otherwise from bottom to top and left to right
+    :param crs: crs of the output GeoSeries
+    :return: cells of the grid clipped by the geometry, the empty cells are removed
     """
     logger.info(f"Create fishnet grid with threshold {threshold}...")
     bounds = geometry.bounds
-    xmin = int(bounds[0] // threshold)
-    xmax = int(bounds[2] // threshold)
-    ymin = int(bounds[1] // threshold)
-    ymax = int(bounds[3] // threshold)
-    # ncols = int(xmax - xmin + 1)
-    # nrows = int(ymax - ymin + 1)
-    result = []
+    xs = np.arange(bounds[0] // threshold, bounds[2] // threshold + 1) * threshold
+    ys = np.arange(bounds[1] // threshold, bounds[3] // threshold + 1) * threshold
     if lrbu:
-        for i in range(ymin, ymax + 1):
-            for j in range(xmin, xmax + 1):
-                b = box(
-                    j * threshold,
-                    i * threshold,
-                    (j + 1) * threshold,
-                    (i + 1) * threshold,
-                )
-                g = geometry.intersection(b)
-                if g.is_empty:
-                    continue
-                result.append(g)
+        y, x = [a.ravel() for a in np.meshgrid(ys, xs, indexing="ij")]
     else:  # bulr
-        for i in range(xmin, xmax + 1):
-            for j in range(ymin, ymax + 1):
-                b = box(
-                    i * threshold,
-                    j * threshold,
-                    (i + 1) * threshold,
-                    (j + 1) * threshold,
-                )
-                g = geometry.intersection(b)
-                if g.is_empty:
-                    continue
-                result.append(g)
-    return result
+        x, y = [a.ravel() for a in np.meshgrid(xs, ys, indexing="ij")]
+    cells = shapely.box(x, y, x + threshold, y + threshold)
+    shapely.prepare(geometry)
+    cells = cells[shapely.intersects(geometry, cells)]
+    result = shapely.intersection(geometry, cells)
+    result = result[~shapely.is_empty(result)]
+    return gpd.GeoSeries(result, crs=crs)
 
 
 # @timeit
-def katana(geometry: shapely.Geometry, threshold: Union[int, float], count: int = 0) -> list:
-    """Split a Polygon into two parts across its shortest dimension if area is greater than threshold."""
-    bounds = geometry.bounds
-    width = bounds[2] - bounds[0]
-    height = bounds[3] - bounds[1]
-    if geometry.area <= threshold or count == 250:
-        # either the polygon is smaller than the threshold, or the maximum
-        # number of recursions has been reached
-        return [geometry]
-    if height >= width:
-        # split left to right
-        a = box(bounds[0], bounds[1], bounds[2], bounds[1] + height / 2)
-        b = box(bounds[0], bounds[1] + height / 2, bounds[2], bounds[3])
-    else:
-        # split top to bottom
-        a = box(bounds[0], bounds[1], bounds[0] + width / 2, bounds[3])
-        b = box(bounds[0] + width / 2, bounds[1], bounds[2], bounds[3])
-    result = []
-    for d in (
-        a,
-        b,
-    ):
-        c = geometry.intersection(d)
-        if not isinstance(c, GeometryCollection):
-            c = [c]
-        for e in c:
-            if isinstance(e, (Polygon, MultiPolygon)):
-                result.extend(katana(e, threshold, count + 1))
-    if count > 0:
-        return result
+def katana(
+    geometry: Union[shapely.Geometry, list],
+    threshold: Union[int, float],
+    count: int = 0,
+    crs: Union[int, str] = None,
+) -> gpd.GeoSeries:
+    """
+    Split Polygons into two parts across their shortest dimension repeatedly until area is not greater than threshold.
+    The polygons of each split level are split by bulk operations, the result is in the same order as
+    splitting each polygon recursively, and the multipart polygons are converted into single parts.
+
+    :param geometry: a Polygon or MultiPolygon, or a list of them
+    :param threshold: area threshold
+    :param count: number of splits already made, splitting stops at 250 splits
+    :param crs: crs of the output GeoSeries
+    """
+    geoms = np.asarray([geometry] if isinstance(geometry, shapely.Geometry) else list(geometry), dtype=object)
+    # the key of a part is the path of splits to it, to sort the result in the recursive order
+    keys = [(i,) for i in range(len(geoms))]
+    result_geoms = []
+    result_keys = []
+    while len(geoms):
+        # either the polygon is smaller than the threshold, or the maximum number of splits has been reached
+        done = (shapely.area(geoms) <= threshold) | (count >= 250)
+        result_geoms.extend(geoms[done])
+        result_keys.extend(key for key, d in zip(keys, done) if d)
+        geoms = geoms[~done]
+        keys = [key for key, d in zip(keys, done) if not d]
+        if not len(geoms):
+            break
+        xmin, ymin, xmax, ymax = shapely.bounds(geoms).T
+        width = xmax - xmin
+        height = ymax - ymin
+        # split left to right if height >= width, otherwise split top to bottom
+        by_height = height >= width
+        a = shapely.box(
+            xmin, ymin, np.where(by_height, xmax, xmin + width / 2), np.where(by_height, ymin + height / 2, ymax)
+        )
+        b = shapely.box(
+            np.where(by_height, xmin, xmin + width / 2), np.where(by_height, ymin + height / 2, ymin), xmax, ymax
+        )
+        next_geoms = []
+        next_keys = []
+        for half, boxes in enumerate((a, b)):
+            for key, c in zip(keys, shapely.intersection(geoms, boxes)):
+                parts = shapely.get_parts(c) if isinstance(c, GeometryCollection) else [c]
+                for j, e in enumerate(parts):
+                    if isinstance(e, (Polygon, MultiPolygon)) and not e.is_empty:
+                        next_geoms.append(e)
+                        next_keys.append(key + (half, j))
+        geoms = np.asarray(next_geoms, dtype=object)
+        keys = next_keys
+        count += 1
+    order = sorted(range(len(result_keys)), key=result_keys.__getitem__)
+    result = gpd.GeoSeries([result_geoms[i] for i in order], crs=crs)
     # convert multipart into single part
-    final_result = []
-    for g in result:
-        if isinstance(g, MultiPolygon):
-            final_result.extend(g.geoms)
-        else:
-            final_result.append(g)
-    return final_result
+    return result.explode(index_parts=False).reset_index(drop=True)
 
 
-def gen_table_extent(engine: Engine, table: Union[str, Type[Ttable]], filter_it: bool = True) -> gpd.GeoDataFrame:
+def gen_table_extent(
+    engine: Engine, table: Union[str, Type[Ttable]], filter_it: bool = True, union: bool = False
+) -> gpd.GeoDataFrame:
     """
     Generate catchment extent from catchment table or DEM table.
+    The DEM extents are read from the geometry of DEM attribute table in one query,
+    the extent files are only read for the rows without geometry in database.
+
+    :param engine: database engine
+    :param table: catchment table or DEM table
+    :param filter_it: if True, return the filtered union of all the extents
+    :param union: if True, union the DEM extents in database by ST_Union, instead of returning one row per DEM
     """
     if not isinstance(table, str):
         table = table.__tablename__
     if table == "hydro_dem" or table == "grid_dem":
-        df = pd.read_sql(f"SELECT * FROM {table} ;", engine)
-        df["geometry"] = df["extent_path"].apply(lambda x: gpd.read_file(x).geometry[0])
-        if table == "grid_dem":
-            gdf = gpd.GeoDataFrame(df[["grid_id", "geometry"]], crs="epsg:2193", geometry="geometry")
+        index_column = "grid_id" if table == "grid_dem" else "catch_id"
+        join = f"""FROM {table} AS d LEFT JOIN {table}_attribute AS a ON d.{index_column} = a.{index_column}"""
+        if union:
+            query = f"""SELECT ST_Union(a.geometry) AS geometry {join} WHERE a.geometry IS NOT NULL ;"""
+            gdf = gpd.read_postgis(query, engine, geom_col="geometry", crs=2193).dropna(subset=["geometry"])
+            query = f"""SELECT d.{index_column}, d.extent_path {join} WHERE a.geometry IS NULL ;"""
+            df = pd.read_sql(query, engine)
         else:
-            gdf = gpd.GeoDataFrame(df[["catch_id", "geometry"]], crs="epsg:2193", geometry="geometry")
+            query = f"""SELECT d.{index_column}, d.extent_path, a.geometry {join} ;"""
+            gdf = gpd.read_postgis(query, engine, geom_col="geometry", crs=2193)
+            df = gdf[gdf["geometry"].isna()]
+            gdf = gdf[gdf["geometry"].notna()][[index_column, "geometry"]]
+        if not df.empty:
+            logger.info(f"{len(df)} rows of {table} have no extent geometry in database, read extent files.")
+            df = df.assign(geometry=df["extent_path"].apply(lambda x: gpd.read_file(x).unary_union))
+            df = gpd.GeoDataFrame(df, crs="epsg:2193", geometry="geometry")
+            gdf = pd.concat([gdf, df[gdf.columns]], ignore_index=True)
     else:
         gdf = tables.read_postgis_table(engine, table)
     if filter_it:
@@ -689,6 +915,58 @@ def gen_table_extent(engine: Engine, table: Union[str, Type[Ttable]], filter_it:
     return gdf
 
 
+class CoverageIndex:
+    """
+    In memory index of lidar coverage, to check if catchments are covered by lidar datasets.
+
+    The filtered coverage of all datasets (same as `gen_table_extent(engine, DATASET)`) is buffered and
+    prepared once. The datasets of a catchment are still queried by `retrieve_dataset` or `retrieve_lidar`,
+    which also need their survey date, tile and lidar file paths from database.
+    """
+
+    def __init__(self, coverage: shapely.Geometry, buffer: Union[int, float] = 0):
+        self.extent = gpd.GeoDataFrame(index=[0], geometry=[coverage], crs=2193)
+        self.coverage = coverage.buffer(buffer)
+        shapely.prepare(self.coverage)
+
+    @classmethod
+    def from_database(cls, engine: Engine, buffer: Union[int, float] = 0) -> "CoverageIndex":
+        """
+        Build coverage index from dataset table, the filtered coverage is cached in
+        `DATA_DIR/gpkg/lidar_coverage_{fingerprint}.gpkg`, and regenerated when dataset table changes.
+        """
+        gpkg_path = Path(get_env_variable("DATA_DIR")) / Path("gpkg")
+        fingerprint = tables.get_table_fingerprint(engine, tables.DATASET)
+        cache_file = gpkg_path / Path(f"lidar_coverage_{fingerprint}.gpkg")
+        if cache_file.exists():
+            coverage = gpd.read_file(cache_file, layer="coverage")["geometry"].values[0]
+            logger.debug(f"Load lidar coverage from {cache_file}.")
+        else:
+            gdf_dataset = tables.read_postgis_table(engine, tables.DATASET)
+            coverage = filter_geometry(gdf_dataset["geometry"])
+            for old_file in gpkg_path.glob("lidar_coverage_*.gpkg"):
+                old_file.unlink()
+            Path(gpkg_path).mkdir(parents=True, exist_ok=True)
+            gpd.GeoDataFrame(index=[0], geometry=[coverage], crs=2193).to_file(
+                cache_file, layer="coverage", driver="GPKG"
+            )
+            # save lidar extent to check on QGIS
+            save_gpkg(gpd.GeoDataFrame(index=[0], geometry=[coverage], crs=2193), "lidar_extent")
+            logger.info(f"Save lidar coverage to {cache_file}.")
+        return cls(coverage, buffer=buffer)
+
+    def covers(self, geometry: Union[gpd.GeoDataFrame, gpd.GeoSeries, shapely.Geometry]) -> bool:
+        """Check if any part of the geometry intersects with the buffered lidar coverage."""
+        if isinstance(geometry, (gpd.GeoDataFrame, gpd.GeoSeries)):
+            geometry = geometry.geometry.to_numpy()
+        return bool(np.any(shapely.intersects(self.coverage, geometry)))
+
+    def filter(self, gdf: gpd.GeoDataFrame, index_column: str = "catch_id") -> list:
+        """Get the index of the geometries intersect with the buffered lidar coverage, in one vectorised call."""
+        mask = shapely.intersects(self.coverage, gdf.geometry.to_numpy())
+        return gdf.loc[mask, index_column].to_list()
+
+
 def gen_key_extent(
     engine: Engine,
     table: Union[str, Type[Ttable]],
@@ -866,19 +1144,40 @@ def get_dem_band_and_resolution_by_geometry(
             return hydro_dem, res_no
 
 
-def clip_netcdf(file_list: list, save_file: Path, geometry: shapely.Geometry) -> None:
-    """ "
-    Clip netcdf file by geometry
+def clip_netcdf(
+    file_list: list,
+    save_file: Path,
+    geometry: shapely.Geometry,
+    windowed: bool = True,
+    chunks: Union[int, str, dict] = "auto",
+) -> None:
+    """
+    Clip netcdf file by geometry.
+
+    :param file_list: source netcdf files
+    :param save_file: clipped netcdf file
+    :param geometry: clip by this geometry
+    :param windowed: if True, only read the window of each source that covers the geometry bounds,
+        then merge the windows and clip. If False, merge the full sources and clip.
+    :param chunks: dask chunks to read the sources lazily in windowed mode
     """
     list_dem = []
     for file in file_list:
-        if Path(file).exists():
+        if not Path(file).exists():
+            logger.warning(f"Expected DEM File {file} does not exist.")
+        elif windowed:
+            with rxr.open_rasterio(Path(file), chunks=chunks) as f:
+                try:
+                    window = f.sel(band=1).rio.clip_box(*geometry.bounds, auto_expand=True)
+                except NoDataInBounds:
+                    logger.debug(f"DEM File {file} does not intersect with clip geometry bounds.")
+                    continue
+                list_dem.append(window.load())
+        else:
             # ValueError: Resulting object does not have monotonic global indexes along dimension y
             # list_xds.append(xr.open_dataset(file))
             with rxr.open_rasterio(Path(file)) as f:
                 list_dem.append(f.sel(band=1))
-        else:
-            logger.warning(f"Expected DEM File {file} does not exist.")
     # ValueError: Resulting object does not have monotonic global indexes along dimension y
     # xds = xr.combine_by_coords(list_xds, combine_attrs='drop', compat='no_conflicts')
     xds = rxr.merge.merge_datasets(list_dem)
@@ -953,93 +1252,58 @@ def clip_dem(
     df = get_dem_by_id(engine, catch_id)
     assert len(df) == len(gdf), f"Retrieve {len(df)} in DEM table, while retrieve {len(gdf)} in DEMATTR table."
     clipped_dem_geometry = gen_clipped_data(index, df, gdf, clipped_dem_path, geometry)
+    timestamp = datetime.now()
+    resolution = gdf["resolution"].values[0]
+    raw_dem_path = (clipped_dem_path / Path(f"{index}_raw_dem.nc")).as_posix()
+    hydro_dem_path = (clipped_dem_path / Path(f"{index}.nc")).as_posix()
+    extent_path = (clipped_dem_path / Path(f"{index}_extent.geojson")).as_posix()
     if table == tables.USERDEM:
-        gdf_to_db = gpd.GeoDataFrame(
-            {
-                "catch_id": int(index),
-                "resolution": gdf["resolution"].values[0],
-                "raw_dem_path": (clipped_dem_path / Path(f"{index}_raw_dem.nc")).as_posix(),
-                "hydro_dem_path": (clipped_dem_path / Path(f"{index}.nc")).as_posix(),
-                "extent_path": (clipped_dem_path / Path(f"{index}_extent.geojson")).as_posix(),
-                "raw_geometry": geometry,
-                "geometry": clipped_dem_geometry,
-                "created_at": datetime.now(),
-            },
-            index=[0],
-            crs="epsg:2193",
-        )
+        row = {
+            "catch_id": int(index),
+            "resolution": resolution,
+            "raw_dem_path": raw_dem_path,
+            "hydro_dem_path": hydro_dem_path,
+            "extent_path": extent_path,
+            "raw_geometry": geometry,
+            "geometry": clipped_dem_geometry,
+            "created_at": timestamp,
+        }
         tables.create_table(engine, table)
-        gdf_to_db.to_postgis(table.__tablename__, engine, if_exists="append", index=False)
-        logger.info(f"Add new {index} in {tables.USERDEM.__tablename__} at {datetime.now()}.")
+        tables.insert_rows(engine, table, row)
+        logger.info(f"Add new {index} in {tables.USERDEM.__tablename__} at {timestamp}.")
 
     elif table == tables.DEM:
-        query = f"SELECT * FROM {tables.DEM.__tablename__} WHERE catch_id = '{index}' ;"
-        df_from_db = pd.read_sql(query, engine)
-        if not df_from_db.empty:
-            query = f"""UPDATE {tables.DEM.__tablename__}
-                        SET raw_dem_path = '{(clipped_dem_path / (f"{index}_raw_dem.nc")).as_posix()}',
-                            hydro_dem_path = '{(clipped_dem_path / Path(f"{index}.nc")).as_posix()}',
-                            extent_path = '{(clipped_dem_path / Path(f"{index}_extent.geojson")).as_posix()}',
-                            updated_at = '{pd.Timestamp.now()}'
-                        WHERE catch_id = '{index}' ;"""
-            engine.execute(query)
-            logger.info(f"Updated {index} in {tables.DEM.__tablename__} at {datetime.now()}.")
-        else:
-            query = f"""INSERT INTO {tables.DEM.__tablename__} (
-                        catch_id,
-                        raw_dem_path,
-                        hydro_dem_path,
-                        extent_path,
-                        created_at,
-                        updated_at
-                        ) VALUES (
-                        {index},
-                        '{(clipped_dem_path / f"{index}_raw_dem.nc").as_posix()}',
-                        '{(clipped_dem_path / Path(f"{index}.nc")).as_posix()}',
-                        '{(clipped_dem_path / Path(f"{index}_extent.geojson")).as_posix()}',
-                        '{pd.Timestamp.now()}',
-                        '{pd.Timestamp.now()}'
-                        ) ;"""
-            engine.execute(query)
+        tables.migrate_table(engine, tables.DEM)
+        tables.migrate_table(engine, tables.DEMATTR)
+        row = {
+            "catch_id": int(index),
+            "raw_dem_path": raw_dem_path,
+            "hydro_dem_path": hydro_dem_path,
+            "extent_path": extent_path,
+            "created_at": timestamp,
+            "updated_at": timestamp,
+        }
+        tables.upsert_rows(engine, tables.DEM, row)
 
         # hydrologically conditioned DEM geometry table, to faster query
-        query = f"SELECT catch_id FROM {tables.DEMATTR.__tablename__} WHERE catch_id = '{index}' ;"
-        df_from_db = pd.read_sql(query, engine)
-        if not df_from_db.empty:
-            query = f"""UPDATE {tables.DEMATTR.__tablename__}
-                        SET raw_geometry = '{geometry}',
-                            resolution = '{gdf["resolution"].values[0]}',
-                            geometry = '{clipped_dem_geometry}',
-                            updated_at = '{datetime.now()}'
-                        WHERE catch_id = '{index}' ;"""
-            engine.execute(query)
-            logger.info(f"Updated {index} in {tables.DEMATTR.__tablename__} at {datetime.now()}.")
-        else:
-            query = f"""INSERT INTO {tables.DEMATTR.__tablename__} (
-                        catch_id,
-                        resolution,
-                        raw_geometry,
-                        geometry,
-                        created_at,
-                        updated_at
-                        ) VALUES (
-                        {index},
-                        '{gdf["resolution"]}',
-                        '{geometry}',
-                        '{clipped_dem_geometry}',
-                        '{pd.Timestamp.now()}',
-                        '{pd.Timestamp.now()}'
-                        ) ;"""
-            engine.execute(query)
-        logger.info(f"Add new {index} in {tables.DEMATTR.__tablename__} at {datetime.now()}.")
+        row = {
+            "catch_id": int(index),
+            "resolution": resolution,
+            "raw_geometry": geometry,
+            "geometry": clipped_dem_geometry,
+            "created_at": timestamp,
+            "updated_at": timestamp,
+        }
+        tables.upsert_rows(engine, tables.DEMATTR, row)
+        logger.info(f"Upsert {index} in {tables.DEM.__tablename__} and {tables.DEMATTR.__tablename__} at {timestamp}.")
 
     # to return the geometry for calling function
     gdf_result = gpd.GeoDataFrame(
         {
-            "resolution": gdf["resolution"].values[0],
-            "raw_dem_path": (clipped_dem_path / Path(f"{index}_raw_dem.nc")).as_posix(),
-            "hydro_dem_path": (clipped_dem_path / Path(f"{index}.nc")).as_posix(),
-            "extent_path": (clipped_dem_path / Path(f"{index}_extent.geojson")).as_posix(),
+            "resolution": resolution,
+            "raw_dem_path": raw_dem_path,
+            "hydro_dem_path": hydro_dem_path,
+            "extent_path": extent_path,
         },
         index=[0],
         crs="epsg:2193",
@@ -1063,6 +1327,52 @@ def save_gpkg(gdf: gpd.GeoDataFrame, file: Union[Type[Ttable], str]):
     logger.info(f"Save source catchments to {gpkg_path / Path(file_name)}.")
 
 
+def append_gpkg(gdf: gpd.GeoDataFrame, file: Union[Type[Ttable], str]):
+    """
+    Append rows to GPKG, the GPKG driver maintains the spatial index of the rows.
+    """
+    gpkg_path = Path(get_env_variable("DATA_DIR")) / Path("gpkg")
+    if isinstance(file, str):
+        file_name = f"{file}.gpkg"
+    else:
+        file_name = f"{file.__tablename__}.gpkg"
+    Path(gpkg_path).mkdir(parents=True, exist_ok=True)
+    gdf = gdf.set_crs(epsg=2193, allow_override=True)
+    mode = "a" if (gpkg_path / Path(file_name)).exists() else "w"
+    gdf.to_file((gpkg_path / Path(file_name)).as_posix(), driver="GPKG", mode=mode)
+    logger.debug(f"Append {len(gdf)} rows to {gpkg_path / Path(file_name)}.")
+
+
+def dissolve_gpkg(
+    file: str,
+    index_column: str = "catch_id",
+    engine: Engine = None,
+    table: Union[Type[Ttable], str] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Dissolve the extent rows in `{file}_parts.gpkg` into the filtered extent and save it as `{file}.gpkg`.
+    If the rows do not exist, seed them from the table extent if engine and table are given.
+
+    :param file: the name of the extent GPKG
+    :param index_column: the index column of the rows, the latest row of each index is kept
+    :param engine: database engine
+    :param table: the DEM table to seed the rows
+    """
+    parts_file = Path(get_env_variable("DATA_DIR")) / Path("gpkg") / Path(f"{file}_parts.gpkg")
+    if parts_file.exists():
+        gdf = gpd.read_file(parts_file, driver="GPKG")
+    elif engine is not None and table is not None:
+        gdf = gen_table_extent(engine, table, filter_it=False)
+        append_gpkg(gdf, f"{file}_parts")
+    else:
+        raise FileNotFoundError(f"Extent rows {parts_file} not exist.")
+    gdf = gdf.drop_duplicates(subset=index_column, keep="last")
+    geom = filter_geometry(gdf["geometry"])
+    extent = gpd.GeoDataFrame(index=[0], geometry=[geom], crs=2193)
+    save_gpkg(extent, file)
+    return extent
+
+
 def make_valid(data: Union[gpd.GeoDataFrame, shapely.Geometry]) -> Union[gpd.GeoDataFrame, shapely.Geometry]:
     """
     Returns a valid representation of the object.
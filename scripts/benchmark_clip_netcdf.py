@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# usage: in prompt of conda environment of NewZeaLiDAR, compare windowed and full merge-and-clip of DEM NetCDF files.
+#        the ROI is a geojson file in epsg:2193, the sources are DEM NetCDF files, e.g. hydro_dem_path in hydro_dem table:
+#        > conda activate lidar
+#        > python NewZeaLiDAR/scripts/benchmark_clip_netcdf.py roi.geojson 1588.nc 1589.nc --repeat 3
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import rioxarray as rxr
+
+from newzealidar import utils
+
+
+def run_clip(file_list: list, save_file: pathlib.Path, geometry, windowed: bool, repeat: int) -> float:
+    """Run clip_netcdf several times, return the best runtime in seconds."""
+    runtime = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        utils.clip_netcdf(file_list, save_file, geometry, windowed=windowed)
+        runtime.append(time.perf_counter() - t_start)
+    return min(runtime)
+
+
+parser = argparse.ArgumentParser(description="Benchmark windowed and full merge-and-clip of DEM NetCDF files.")
+parser.add_argument("roi", type=pathlib.Path, help="ROI geojson file")
+parser.add_argument("files", type=pathlib.Path, nargs="+", help="source DEM NetCDF files")
+parser.add_argument("--repeat", type=int, default=3, help="number of runs of each mode, the best one is reported")
+args = parser.parse_args()
+
+geometry = gpd.read_file(args.roi).to_crs(2193).unary_union
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    full_file = pathlib.Path(tmp_dir) / "full.nc"
+    windowed_file = pathlib.Path(tmp_dir) / "windowed.nc"
+    full_time = run_clip(args.files, full_file, geometry, windowed=False, repeat=args.repeat)
+    windowed_time = run_clip(args.files, windowed_file, geometry, windowed=True, repeat=args.repeat)
+
+    with rxr.open_rasterio(full_file) as full, rxr.open_rasterio(windowed_file) as windowed:
+        same_shape = full.z.shape == windowed.z.shape
+        max_diff = float(np.nanmax(np.abs(full.z.values - windowed.z.values))) if same_shape else np.nan
+
+print(f"ROI area: {geometry.area / 1e6:.2f} km2, sources: {len(args.files)}")
+print(f"full merge-and-clip:     {full_time:.2f} s")
+print(f"windowed merge-and-clip: {windowed_time:.2f} s ({full_time / windowed_time:.1f}x)")
+print(f"same output shape: {same_shape}, max abs difference of z: {max_diff}")
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# usage: in prompt of conda environment of NewZeaLiDAR, compare the thread pool and the process pool of
+#        utils.parallel_map on the catchments stages, with catchments read from a table of the database in .env:
+#        > conda activate lidar
+#        > python NewZeaLiDAR/scripts/benchmark_parallel_map.py SDC --stage trim deduplicate --limit 2000 --workers 8
+
+import argparse
+import time
+from itertools import repeat
+from multiprocessing.pool import ThreadPool
+
+from newzealidar import catchments, tables, utils
+
+
+def run_thread(func, items: list, workers: int) -> float:
+    """Run func over items in a thread pool, return the runtime in seconds."""
+    t_start = time.perf_counter()
+    with ThreadPool(processes=workers) as pool:
+        pool.starmap(func, items)
+    return time.perf_counter() - t_start
+
+
+def run_process(func, items: list, workers: int) -> float:
+    """Run func over items with utils.parallel_map, return the runtime in seconds."""
+    t_start = time.perf_counter()
+    utils.parallel_map(func, items, workers=workers, star=True)
+    return time.perf_counter() - t_start
+
+
+def main():
+    """Benchmark the stages with a thread pool and a process pool of the same number of workers."""
+    parser = argparse.ArgumentParser(description="Benchmark thread pool and process pool of the catchments stages.")
+    parser.add_argument("table", type=str, help="catchments table class name in tables module, e.g. SDC, ORDER5")
+    parser.add_argument(
+        "--stage", nargs="+", default=["trim", "deduplicate", "extend"], choices=["trim", "deduplicate", "extend"]
+    )
+    parser.add_argument("--limit", type=int, default=0, help="number of catchments to process, 0 is all")
+    parser.add_argument("--workers", type=int, default=None, help="default is NUM_WORKERS or cpu count")
+    args = parser.parse_args()
+
+    table = getattr(tables, args.table)
+    workers = utils.get_number_of_workers(args.workers)
+    engine = utils.get_database()
+    gdf = tables.read_postgis_table(engine, table, limit=args.limit, sort_by="area", desc=True)
+    engine.dispose()
+    list_gds = [gds for _, gds in gdf.iterrows()]
+    list_id = gdf["catch_id"].to_list()
+
+    stages = {
+        "trim": (catchments.trim_single_catchment, list(zip(list_id, gdf["geometry"], gdf["area"]))),
+        "deduplicate": (catchments.check_duplicate_catchments, list(zip(list_gds, repeat(table)))),
+        "extend": (catchments.extend_boundary, list(zip(list_id, repeat(list_id), repeat(table)))),
+    }
+
+    print(f"table: {table.__tablename__}, catchments: {len(gdf)}, workers: {workers}")
+    for stage in args.stage:
+        func, items = stages[stage]
+        thread_time = run_thread(func, items, workers)
+        process_time = run_process(func, items, workers)
+        print(f"{stage:<12} thread pool: {thread_time:8.2f} s, process pool: {process_time:8.2f} s "
+              f"({thread_time / process_time:.1f}x)")
+
+
+# the guard is required, the spawned worker processes import this script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# usage: in prompt of conda environment of NewZeaLiDAR, compare the result assembly of trim_catchments,
+#        growing a dataframe by concatenating each row and collecting a list then concatenating once,
+#        with catchments read from a table of the database in .env, e.g. the full ORDER5 table:
+#        > conda activate lidar
+#        > python NewZeaLiDAR/scripts/benchmark_trim_catchments.py ORDER5
+
+import argparse
+import time
+
+import geopandas as gpd
+import pandas as pd
+
+from newzealidar import catchments, tables, utils
+
+
+def trim_by_row_concat(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Trim catchments row by row from iterrows, grow the result by concatenating each row."""
+    gdf_concat = gpd.GeoDataFrame(geometry=gpd.GeoSeries())
+    for _, gds in gdf.iterrows():
+        catch_id, geometry, area, _ = catchments.trim_single_catchment(gds["catch_id"], gds["geometry"], gds["area"])
+        gdf_row = gpd.GeoDataFrame(index=[0], crs="epsg:2193", geometry=[geometry])
+        gdf_row["area"] = area
+        gdf_row["catch_id"] = catch_id
+        gdf_concat = pd.concat([gdf_concat, gdf_row], ignore_index=True)
+    return gdf_concat
+
+
+def main():
+    """Benchmark the serial trim_catchments against the row concatenation approach."""
+    parser = argparse.ArgumentParser(description="Benchmark result assembly of trim_catchments.")
+    parser.add_argument("table", type=str, help="catchments table class name in tables module, e.g. ORDER5")
+    parser.add_argument("--limit", type=int, default=0, help="number of catchments to process, 0 is all")
+    args = parser.parse_args()
+
+    table = getattr(tables, args.table)
+    engine = utils.get_database()
+    gdf = tables.read_postgis_table(engine, table, limit=args.limit)
+    engine.dispose()
+
+    t_start = time.perf_counter()
+    gdf_row = trim_by_row_concat(gdf)
+    row_time = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    gdf_list, update_sum = catchments.trim_catchments(gdf, parallel=False)
+    list_time = time.perf_counter() - t_start
+
+    gdf_row = gdf_row.sort_values("catch_id").reset_index(drop=True)
+    gdf_list = gdf_list.sort_values("catch_id").reset_index(drop=True)
+    same = gdf_row["geometry"].geom_equals(gdf_list["geometry"]).all()
+    print(f"table: {table.__tablename__}, catchments: {len(gdf)}, trimmed: {update_sum}")
+    print(f"row concatenation:      {row_time:8.2f} s")
+    print(f"list and single concat: {list_time:8.2f} s ({row_time / list_time:.1f}x)")
+    print(f"same geometries: {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,131 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import hashlib
 import os
+import tempfile
 import unittest
+from pathlib import Path
 from unittest import mock, TestCase
 
-from src import catchments, utils
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from newzealidar import catchments, tables, utils
 from . import Base
 
 
+def _merge_catchments_sequential(gdf, lower_area, upper_area):
+    """the former implementation of `catchments.merge_catchments` before gap catch_id processing, as reference."""
+    resolution, eps = catchments.CATCHMENT_RESOLUTION, catchments.EPS
+    gdf_keep = gdf[gdf["area"] > upper_area].reset_index(drop=True)
+    gdf_merge = gdf[gdf["area"] <= upper_area].reset_index(drop=True)
+    for i in range(len(gdf_merge)):
+        if not lower_area < gdf_merge.at[i, "area"] < upper_area:
+            continue
+        buffer = gdf_merge.at[i, "geometry"].buffer(resolution / 2 - eps, join_style="mitre")
+        gdf_adj = gdf_keep[gdf_keep["geometry"].intersects(buffer)]
+        if gdf_adj.empty:
+            gdf_row = gpd.GeoDataFrame(index=[0], crs="epsg:2193", geometry=[gdf_merge.at[i, "geometry"]])
+            gdf_row["area"] = gdf_merge.at[i, "area"]
+            gdf_row["catch_id"] = gdf_merge.at[i, "catch_id"]
+            gdf_keep = pd.concat([gdf_keep, gdf_row], ignore_index=True)
+            continue
+        gdf_largest = gdf_adj[gdf_adj["area"] == gdf_adj["area"].max()]
+        catch_id = gdf_largest["catch_id"].values[0]
+        geometry = gdf_largest["geometry"].values[0]
+        if geometry.buffer(eps, join_style="mitre").contains(gdf_merge.at[i, "geometry"]):
+            continue
+        index = gdf_keep[gdf_keep["catch_id"] == catch_id].index.values[0]
+        geom_update = shapely.unary_union([geometry, gdf_merge.at[i, "geometry"]])
+        geom_update = geom_update.buffer(eps, join_style="mitre").buffer(-eps, join_style="mitre")
+        gdf_keep.at[index, "geometry"] = geom_update
+        gdf_keep.at[index, "area"] = geom_update.area
+    return gdf_keep.sort_values(by="catch_id").reset_index(drop=True)
+
+
+def _trim_catchments_per_row(gdf):
+    """the former implementation of `catchments.trim_catchments` concatenating each row, as reference."""
+    resolution, eps, lower_area = catchments.CATCHMENT_RESOLUTION, catchments.EPS, catchments.LOWER_AREA
+    gdf_concat = gpd.GeoDataFrame(geometry=gpd.GeoSeries())
+    update_sum = 0
+    for _, gds in gdf.iterrows():
+        geom = gds["geometry"]
+        geom_fil = geom.buffer(-(resolution / 2 + eps), join_style="mitre").buffer(
+            resolution / 2 + eps, join_style="mitre")
+        geom_fil = utils.filter_geometry(geom_fil, resolution=resolution, polygon_threshold=lower_area)
+        geom_mask = geom.difference(geom_fil)
+        if isinstance(geom_mask, shapely.geometry.MultiPolygon):
+            geom_mask = max(geom_mask.geoms, key=lambda x: x.area)
+        if geom_mask.area > resolution * resolution * 8:
+            geom = geom.difference(geom_mask)
+            geom = utils.filter_geometry(geom, resolution=resolution, polygon_threshold=lower_area)
+            gdf_trim = gpd.GeoDataFrame(index=[0], crs="epsg:2193", geometry=[geom])
+            gdf_trim["area"] = gdf_trim["geometry"].area
+            update_sum += 1
+        else:
+            gdf_trim = gpd.GeoDataFrame(index=[0], crs="epsg:2193", geometry=[gds["geometry"]])
+            gdf_trim["area"] = gds["area"]
+        gdf_trim["catch_id"] = gds["catch_id"]
+        gdf_concat = pd.concat([gdf_concat, gdf_trim], ignore_index=True)
+    return gdf_concat, update_sum
+
+
+class _FakePipeline:
+    """
+    tables of catchments pipeline held as fingerprints in memory, each stage writes its targets
+    by a hash of its name and sources, so the stages can be run without database.
+    """
+
+    def __init__(self):
+        self.state = {}  # fingerprint of each table or file
+        self.source = {"fetch": "v1", "51153.geojson": "v1"}  # data out of the pipeline
+        self.records = {}  # stage table
+        self.fail = {}  # stage name: True to fail after writing its targets, False to fail before
+        self.state["51153.geojson"] = self.source["51153.geojson"]
+
+    def get_stages(self) -> list:
+        with mock.patch.dict(os.environ, {"DATA_DIR": "data", "LAND_FILE": "51153.geojson"}):
+            stages = catchments.get_stages()
+        return [(name, self.get_func(name, sources, targets), sources, targets)
+                for name, _, sources, targets in stages]
+
+    def get_func(self, name, sources, targets):
+        def func():
+            if self.fail.get(name) is False:
+                raise RuntimeError(f"stage {name} failed")
+            inputs = "".join(self.state.get(catchments._get_item_name(item), "") for item in sources)
+            for item in targets:
+                value = f"{name}|{catchments._get_item_name(item)}|{inputs}|{self.source.get(name, '')}"
+                self.state[catchments._get_item_name(item)] = hashlib.md5(value.encode()).hexdigest()
+            if self.fail.get(name) is True:
+                raise RuntimeError(f"stage {name} failed")
+        return func
+
+    def get_stage_fingerprint(self, engine, items):
+        return ";".join(
+            f"{catchments._get_item_name(item)}:{self.state.get(catchments._get_item_name(item), 'missing')}"
+            for item in items
+        )
+
+    def get_stage(self, engine, stage):
+        return self.records.get(stage)
+
+    def finish_stage(self, engine, stage, input_fingerprint, output_fingerprint, started_at):
+        self.records[stage] = {
+            "input_fingerprint": input_fingerprint,
+            "output_fingerprint": output_fingerprint,
+            "finished_at": started_at,
+        }
+
+    def run(self, **kwargs) -> list:
+        with mock.patch.object(catchments, "get_stage_fingerprint", self.get_stage_fingerprint), \
+                mock.patch.object(catchments.tables, "get_stage", self.get_stage), \
+                mock.patch.object(catchments.tables, "finish_stage", self.finish_stage), \
+                mock.patch.object(catchments.utils, "get_database", mock.MagicMock()):
+            return catchments.run_stages(self.get_stages(), **kwargs)
+
+
 class CatchmentsTests(Base, TestCase):
     """Tests the catchments module."""
 
@@ -23,6 +142,274 @@ class CatchmentsTests(Base, TestCase):
         """
         catchments.run()
 
+    @mock.patch.dict(os.environ, {'DATA_DIR': r'tests/data',
+                                  'POSTGRES_PORT': utils.get_env_variable('POSTGRES_PORT_TEST')})
+    def test_find_duplicate_catchments(self):
+        """
+        parity test of in memory deduplication.
+        it must find the same duplicate catchments as checking each catchment by a database query.
+        """
+        engine = utils.get_database()
+        gdf = tables.read_postgis_table(engine, tables.SDC)
+        engine.dispose()
+        gdf = gdf.sort_values(by=['catch_id']).reset_index(drop=True)
+        list_expected = [catchments.check_duplicate_catchments(gds, tables.SDC) for _, gds in gdf.iterrows()]
+        list_result = catchments.find_duplicate_catchments(gdf)
+        expected = sorted(set(i for list_i in list_expected for i in list_i[1:]))
+        result = sorted(set(i for list_i in list_result for i in list_i[1:]))
+        self.assertEqual(expected, result)
+
+    def test_merge_catchments(self):
+        """
+        parity test of spatially indexed merging.
+        it must give the same catchments as merging each gap by scanning all catchments,
+        including a standalone gap which absorbs a later gap, and a gap between two catchments of the same area.
+        """
+        list_geom = [
+            shapely.box(0, 0, 1000, 1000),  # 1 large catchment
+            shapely.box(1030, 0, 2030, 1000),  # 2 large catchment of the same area as 1
+            shapely.box(1000, 0, 1030, 40),  # 3 gap between 1 and 2, merged into 1 as the first one of tie
+            shapely.box(1000, 500, 1030, 530),  # 4 gap between 1 and 2
+            shapely.box(5000, 0, 5040, 40),  # 5 standalone gap
+            shapely.box(5040, 0, 5080, 40),  # 6 gap merged into standalone gap 5
+            shapely.box(2030, 0, 2060, 30),  # 7 gap merged into 2
+            shapely.box(9000, 0, 9000.1, 0.1),  # 8 tiny gap to abandon
+        ]
+        gdf = gpd.GeoDataFrame(geometry=list_geom, crs="epsg:2193")
+        gdf["area"] = gdf.area
+        gdf["catch_id"] = range(1, len(gdf) + 1)
+        lower_area = catchments.EPS
+        upper_area = catchments.CATCHMENT_RESOLUTION * catchments.CATCHMENT_RESOLUTION * 4
+        expected = _merge_catchments_sequential(gdf, lower_area, upper_area)
+        result = catchments.merge_catchments(gdf, lower_area, upper_area)
+        self.assertEqual(expected["catch_id"].to_list(), result["catch_id"].to_list())
+        self.assertEqual(expected["catch_id"].to_list(), [1, 2, 5])
+        for geom_expected, geom_result in zip(expected.geometry, result.geometry):
+            self.assertAlmostEqual(geom_expected.symmetric_difference(geom_result).area, 0, places=3)
+        self.assertAlmostEqual(result.loc[result["catch_id"] == 5, "area"].values[0], 3200, places=3)
+        for area_expected, area_result in zip(expected["area"], result["area"]):
+            self.assertAlmostEqual(area_expected, area_result, places=3)
+
+    def test_get_mfe_layer(self):
+        """
+        the layer is fetched and cached by the first call, the second call reads the cache without fetching,
+        refresh fetches it again and the latest cached version is used afterwards.
+        """
+        list_gdf = [
+            gpd.GeoDataFrame({"catch_id": [1, 2]}, geometry=[shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1)],
+                             crs="epsg:2193"),
+            gpd.GeoDataFrame({"catch_id": [1, 3]}, geometry=[shapely.box(0, 0, 1, 2), shapely.box(2, 0, 3, 1)],
+                             crs="epsg:2193"),
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.dict(os.environ, {"DATA_DIR": temp_dir, "MFE_DIR": "mfe"}), \
+                mock.patch.object(catchments, "fetch_data_from_mfe", side_effect=list_gdf) as fetch:
+            for refresh, timestamp, n_fetch, expected in [
+                (False, "2024-01-01", 1, list_gdf[0]),
+                (False, "2024-01-02", 1, list_gdf[0]),
+                (True, "2024-01-03", 2, list_gdf[1]),
+                (False, "2024-01-04", 2, list_gdf[1]),
+            ]:
+                with mock.patch.object(catchments.pd.Timestamp, "now", return_value=pd.Timestamp(timestamp)):
+                    result = catchments.get_mfe_layer(99, refresh=refresh, index_column="catch_id")
+                self.assertEqual(fetch.call_count, n_fetch)
+                pd.testing.assert_frame_equal(pd.DataFrame(expected), pd.DataFrame(result))
+                self.assertEqual(result.crs, expected.crs)
+            fetch.assert_called_with(99)
+            list_cache = sorted(p.name for p in (Path(temp_dir) / "mfe").glob("*.parquet"))
+            self.assertEqual(list_cache, ["99_20240101.parquet", "99_20240103.parquet"])
+
+    def test_map_with_cache(self):
+        """
+        the cached extended catchments are reused only if the catchment and its adjacent catchments are unchanged,
+        a change of geometry invalidates the cache of the catchment and its adjacent catchments processed before it.
+        the empty results are cached too, and only the new and stale keys are written to the cache tables.
+        """
+        list_geom = [
+            shapely.box(0, 0, 1000, 1000),  # 1 adjacent to 2
+            shapely.box(1010, 0, 1810, 800),  # 2 adjacent to 1 and 3
+            shapely.box(1820, 0, 2420, 600),  # 3 adjacent to 2, to be changed
+            shapely.box(5000, 0, 5500, 500),  # 4 standalone
+        ]
+        gdf = gpd.GeoDataFrame(geometry=list_geom, crs="epsg:2193")
+        gdf["area"] = gdf.area
+        gdf["catch_id"] = range(1, len(gdf) + 1)
+        gdf_changed = gdf.copy()
+        gdf_changed.loc[2, "geometry"] = shapely.box(1820, 0, 2420, 650)
+        gdf_changed["area"] = gdf_changed.area
+
+        class Engine:
+            """in-memory cache tables, recording the deleted and appended keys."""
+
+            def __init__(self):
+                self.store = {}
+                self.written = []
+
+            @contextlib.contextmanager
+            def begin(self):
+                yield self
+
+            def execute(self, query, keys):
+                name = str(query).split()[2]
+                self.store[name] = self.store[name][~self.store[name]["key"].isin(keys)]
+                self.written.append(("delete", name, sorted(keys)))
+
+        def to_sql(self, name, con, **kwargs):
+            con.store[name] = pd.concat([con.store.get(name), self], ignore_index=True)
+            con.written.append(("append", name, sorted(set(self["key"]))))
+
+        list_todo = []
+
+        def extend_geometry(index, *args):
+            list_todo.append(index)
+            return get_expected(index, *args)
+
+        def get_expected(index, *args):
+            # catchment 4 gives an empty result, which is cached as well
+            result = catchments.extend_geometry(index, *args)
+            return result.iloc[:0] if index == 4 else result
+
+        engine = Engine()
+        list_key_first = None
+        with mock.patch.object(catchments.tables, "is_table_exist", lambda engine, name: name in engine.store), \
+                mock.patch.object(catchments.tables, "read_postgis_table", lambda engine, name: engine.store[name]), \
+                mock.patch.object(catchments.pd, "read_sql", lambda query, engine: engine.store[query.split()[3]]), \
+                mock.patch.object(pd.DataFrame, "to_sql", to_sql), \
+                mock.patch.object(gpd.GeoDataFrame, "to_postgis", to_sql):
+            for gdf_in, todo_expected in [(gdf, [1, 2, 3, 4]), (gdf, []), (gdf_changed, [2, 3])]:
+                list_args, list_key = catchments.get_extend_items(gdf_in, catchments.gen_adjacency_graph(gdf_in))
+                list_key_first = list_key_first or list_key
+                list_todo.clear()
+                engine.written.clear()
+                list_result = catchments.map_with_cache(
+                    engine, "cache", extend_geometry, list_args, list_key, parallel=False)
+                self.assertEqual(list_todo, todo_expected)
+                for args, result in zip(list_args, list_result):
+                    expected = get_expected(*args)
+                    self.assertEqual(expected["catch_id"].to_list(), result["catch_id"].to_list())
+                    if len(expected):
+                        self.assertTrue(expected.geometry.values[0].equals(result.geometry.values[0]))
+                # only the keys of processed catchments are written, the stale keys are deleted
+                new = sorted(list_key[i - 1] for i in todo_expected)
+                stale = sorted(set(list_key_first) - set(list_key))
+                written = [("delete", n, stale) for n in ["cache", "cache_key"] if stale]
+                written += [("append", "cache", [k for k in new if not k.startswith("4:")])] if new else []
+                written += [("append", "cache_key", new)] if new else []
+                self.assertEqual(engine.written, written)
+        self.assertEqual([k1 == k2 for k1, k2 in zip(list_key_first, list_key)], [True, False, False, True])
+        self.assertEqual(sorted(engine.store["cache_key"]["key"]), sorted(list_key))
+        self.assertEqual(sorted(set(engine.store["cache"]["key"])), sorted(list_key[:3]))
+
+    def test_find_gaps_tiled(self):
+        """
+        parity test of finding gaps tile by tile.
+        it must give the same gaps within tolerance as finding gaps over the union of all catchments,
+        including gaps across tile boundaries and enclosed holes.
+        """
+        list_geom = [
+            # gaps of 20 m between four catchments, across the tile boundaries at 500, 1000 and 1500
+            shapely.box(0, 0, 900, 900),
+            shapely.box(920, 0, 1820, 900),
+            shapely.box(0, 920, 900, 1820),
+            shapely.box(920, 920, 1820, 1820),
+            # a hole across the tile boundary at 3500 and a hole within a tile
+            shapely.box(3000, 0, 4000, 1000).difference(shapely.box(3400, 400, 3600, 600)).difference(
+                shapely.box(3100, 100, 3200, 200)),
+        ]
+        gdf = gpd.GeoDataFrame(geometry=list_geom, crs="epsg:2193")
+        gdf["area"] = gdf.area
+        gdf["catch_id"] = range(1, len(gdf) + 1)
+        for hole_threshold, area in [(10_000 * 10_000, 122_400), (20_000, 82_400)]:
+            gdf_expected = catchments.find_gaps(gdf, hole_threshold=hole_threshold, tiled=False)
+            geom_expected = gdf_expected["geometry"].unary_union
+            geom_result = catchments.find_gaps_tiled(gdf, hole_threshold=hole_threshold, tile_size=500)
+            self.assertAlmostEqual(geom_expected.area, area, places=3)
+            self.assertAlmostEqual(geom_expected.symmetric_difference(geom_result).area, 0, places=3)
+
+    def test_trim_catchments(self):
+        """
+        parity test of trimming with one concatenation.
+        it must give the same catchments in the same order as concatenating each trimmed row.
+        """
+        list_geom = [
+            shapely.union(shapely.box(0, 0, 3000, 3000), shapely.box(3000, 1000, 4000, 1020)),  # with a stick
+            shapely.box(5000, 0, 8000, 3000),  # nothing to trim
+            shapely.union(shapely.box(0, 5000, 3000, 8000), shapely.box(3000, 6000, 3100, 6020)),  # short stick
+        ]
+        gdf = gpd.GeoDataFrame(geometry=list_geom, crs="epsg:2193")
+        gdf["area"] = gdf.area
+        gdf["catch_id"] = [3, 1, 2]
+        gdf_expected, update_expected = _trim_catchments_per_row(gdf)
+        for parallel in [False, True]:
+            gdf_result, update_result = catchments.trim_catchments(gdf, parallel=parallel)
+            self.assertEqual(update_expected, update_result)
+            self.assertEqual(update_result, 1)
+            self.assertEqual(gdf_expected["catch_id"].to_list(), gdf_result["catch_id"].to_list())
+            self.assertEqual(gdf_result.crs, gdf.crs)
+            for geom_expected, geom_result in zip(gdf_expected.geometry, gdf_result.geometry):
+                self.assertTrue(geom_expected.equals(geom_result))
+            for area_expected, area_result in zip(gdf_expected["area"], gdf_result["area"]):
+                self.assertAlmostEqual(area_expected, area_result, places=3)
+        self.assertTrue(gdf_result.geometry[1].equals(list_geom[1]))
+        self.assertAlmostEqual(gdf_result["area"][0], 3000 * 3000, places=3)
+
+    def test_align_catchments(self):
+        """
+        parity test of aligning with one concatenation.
+        it must give the same catchments in the same order as concatenating each aligned row.
+        """
+        def align_single_catchment(index, table):
+            gdf_align = gpd.GeoDataFrame(index=[0], crs="epsg:2193", geometry=[shapely.box(index, 0, index + 10, 10)])
+            gdf_align["area"] = gdf_align["geometry"].area
+            gdf_align["catch_id"] = index
+            return gdf_align
+
+        list_id = [30, 10, 20]
+        gdf_expected = gpd.GeoDataFrame(geometry=gpd.GeoSeries())
+        for catch_id in list_id:
+            gdf_expected = pd.concat([gdf_expected, align_single_catchment(catch_id, None)], ignore_index=True)
+        with mock.patch.object(catchments, "align_single_catchment", align_single_catchment):
+            gdf_result = catchments.align_catchments(list_id, tables.SDCP, parallel=False)
+        self.assertEqual(gdf_expected["catch_id"].to_list(), gdf_result["catch_id"].to_list())
+        self.assertEqual(gdf_expected["area"].to_list(), gdf_result["area"].to_list())
+        self.assertTrue(gdf_expected.geometry.geom_equals(gdf_result.geometry).all())
+
+    def test_run_stages(self):
+        """
+        the stages of catchments pipeline with unchanged inputs are skipped, even if their tables are rewritten
+        in place by the later stages, a run after a failed stage resumes from it.
+        """
+        pipeline = _FakePipeline()
+        self.assertEqual([s[0] for s in pipeline.get_stages()], catchments.STAGE_NAMES)
+        self.assertEqual(pipeline.run(), catchments.STAGE_NAMES)
+        # nothing changed
+        self.assertEqual(pipeline.run(), [])
+        # the land file changed
+        pipeline.source["51153.geojson"] = pipeline.state["51153.geojson"] = "v2"
+        self.assertEqual(pipeline.run(), ["grid"])
+        # from stage is run even if unchanged, and the stages reading its rewritten outputs
+        self.assertEqual(pipeline.run(from_stage="refine_sub"), ["refine_sub", "split", "extend_catchtemp",
+                                                                  "deduplicate_catchtemp", "refine_catchment",
+                                                                  "coast"])
+        self.assertEqual(pipeline.run(force=True, to_stage="fetch"), ["fetch"])
+        self.assertEqual(pipeline.run(), [])
+        # the source data changed, a stage failed before writing its outputs
+        pipeline.source["fetch"] = "v2"
+        pipeline.fail["extend_catchtemp"] = False
+        with self.assertRaises(RuntimeError):
+            pipeline.run(from_stage="fetch")
+        pipeline.fail.clear()
+        self.assertEqual(pipeline.run(), ["extend_catchtemp", "deduplicate_catchtemp", "refine_catchment", "coast"])
+        self.assertEqual(pipeline.run(), [])
+        # the source data changed, a stage failed after rewriting its outputs in place
+        pipeline.source["fetch"] = "v3"
+        pipeline.fail["extend_sdcp"] = True
+        with self.assertRaises(RuntimeError):
+            pipeline.run(from_stage="fetch")
+        pipeline.fail.clear()
+        self.assertEqual(pipeline.run(), catchments.STAGE_NAMES[1:-1])
+        self.assertEqual(pipeline.run(), [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+import copy
+import pickle
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock, TestCase
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from newzealidar import rivers, tables
+from . import Base
+
+
+def _gen_river_network_clip(gdf_roi, gdf_rec, gdf_flow, path):
+    """the former implementation of `rivers.gen_river_network` clipping all the reaches, as reference."""
+    geom = shapely.box(*gdf_roi.buffer(10, join_style="mitre").total_bounds)
+    gdf_rec = gdf_rec.clip(geom)
+    gdf_rec = gdf_rec[gdf_rec["NZREACH"].isin(gdf_flow["nzreach"])]
+    gdf_rec = gdf_rec[["NZREACH", "CATCHAREA", "to_node", "from_node", "geometry"]]
+    gdf_rec = gdf_rec.astype({"NZREACH": "int64"})
+    gdf_rec = gdf_rec.sort_values(by=["NZREACH"]).reset_index(drop=True)
+    gdf_rec.rename(columns=str.lower, inplace=True)
+    gdf_flow = gdf_flow.sort_values(by=["nzreach"]).reset_index(drop=True)
+    gdf_rec_with_flow = gpd.GeoDataFrame(pd.merge(gdf_rec, gdf_flow, on="nzreach", how="left"))
+    save_path = Path(path) / "river" / rivers.RIVER_NETWORK_FILE
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    gdf_rec_with_flow.to_file(save_path.as_posix())
+    return gdf_rec_with_flow
+
+
+def _get_river_fixture():
+    """coastline, catchments, REC1 reaches and local OSM waterway source around a coastline along y."""
+    x, y = 1_750_000, 5_900_000  # the coastline along y
+    gdf_coast = gpd.GeoDataFrame(geometry=[shapely.box(x, y, x + 50_000, y + 50_000)], crs=2193)
+    gdf_sdc = gpd.GeoDataFrame(
+        {"catch_id": [1, 2]},
+        geometry=[
+            shapely.box(x + 10_000, y - 100, x + 20_000, y + 10_000),  # across the coastline
+            shapely.box(x, y, x + 10_000, y + 10_000),
+        ],
+        crs=2193,
+    )
+    gdf_osm = gpd.GeoDataFrame(
+        {
+            "element_type": ["way"] * 4,
+            "osmid": [11, 12, 13, 14],
+            "waterway": ["river", "river", "stream", "canal"],
+            "name": ["A", "B", None, None],
+            "water": [np.nan] * 4,
+        },
+        geometry=[
+            shapely.LineString([(x + 15_000, y + 9_000), (x + 15_000, y + 50)]),
+            shapely.LineString([(x + 12_000, y + 8_000), (x + 12_000, y + 5_000)]),
+            shapely.LineString([(x + 18_000, y + 5_000), (x + 17_000, y + 20)]),
+            shapely.LineString([(x + 11_000, y + 9_000), (x + 11_000, y + 10)]),
+        ],
+        crs=2193,
+    ).to_crs(4326)
+    gdf_rec = gpd.GeoDataFrame(
+        {"NZREACH": [101, 102, 103], "CATCHAREA": [10.0, 20.0, 30.0]},
+        geometry=[
+            shapely.LineString([(x + 17_500, y + 3_000), (x + 17_000, y + 100)]),  # near the endpoint of river 13
+            shapely.LineString([(x + 12_000, y + 8_000), (x + 12_000, y + 5_000)]),
+            shapely.LineString([(x + 5_000, y + 8_000), (x + 5_000, y + 100)]),  # in catchment 2
+        ],
+        crs=2193,
+    )
+    return gdf_coast, gdf_sdc, gdf_rec, rivers.LocalWaterwaySource(gdf_osm)
+
+
+def _get_osm_fixture():
+    """OSM nodes and ways of waterways around a polygon (epsg:4326), as Overpass API response and OSM XML."""
+    x, y = 174.0, -41.0
+    nodes = {i: (x + 0.01 * (i % 10), y + 0.01 * (i // 10)) for i in range(100)}
+    ways = [
+        (11, [0, 11, 22], {"waterway": "river", "name": "A"}),
+        (12, [5, 15, 25, 35], {"waterway": "stream"}),
+        (13, [2, 3, 13, 12, 2], {"natural": "water", "water": "river", "name": "B"}),
+        (14, [7, 8, 9], {"highway": "residential"}),  # not a waterway
+        (15, [88, 99], {"waterway": "canal"}),  # out of the polygon
+    ]
+    polygon = shapely.box(x - 0.005, y - 0.005, x + 0.065, y + 0.045)
+    used = sorted({i for _, refs, _ in ways for i in refs})
+    response = {
+        "elements": [{"type": "node", "id": i, "lon": nodes[i][0], "lat": nodes[i][1]} for i in used]
+        + [{"type": "way", "id": i, "nodes": refs, "tags": tags} for i, refs, tags in ways]
+    }
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6" generator="test">']
+    xml += [f'<node id="{i}" lon="{nodes[i][0]}" lat="{nodes[i][1]}"/>' for i in used]
+    for i, refs, tags in ways:
+        xml += [f'<way id="{i}">'] + [f'<nd ref="{j}"/>' for j in refs]
+        xml += [f'<tag k="{k}" v="{v}"/>' for k, v in tags.items()] + ["</way>"]
+    xml += ["</osm>"]
+    return polygon, response, "\n".join(xml)
+
+
+class RiversTests(Base, TestCase):
+    """Tests the rivers module."""
+
+    def test_river_network_index(self):
+        """
+        parity test of indexed river network.
+        it must give the same river network files as clipping all the reaches for each region,
+        including reaches across the region extent, reaches without flow data and a region without reaches.
+        """
+        list_geom = [
+            shapely.LineString([(0, 0), (500, 500)]),  # within region 1
+            shapely.LineString([(500, 500), (1500, 500)]),  # across regions 1 and 2
+            shapely.LineString([(1500, 500), (2500, 600)]),  # within region 2, no flow data
+            shapely.LineString([(1200, 100), (1800, 900)]),  # within region 2
+            shapely.LineString([(0, 900), (2000, 900)]),  # across regions 1 and 2
+        ]
+        gdf_rec = gpd.GeoDataFrame(
+            {
+                "NZREACH": [5, 3, 4, 1, 2],
+                "CATCHAREA": [1.0, 2.0, 3.0, 4.0, 5.0],
+                "to_node": [10, 20, 30, 40, 50],
+                "from_node": [11, 21, 31, 41, 51],
+                "DISTSEA": [0.0] * 5,
+            },
+            geometry=list_geom,
+            crs=2193,
+        )
+        gdf_flow = pd.DataFrame({"nzreach": [2, 1, 5, 3], "flow": [0.2, 0.1, 0.5, 0.3]})
+        gdf_roi = gpd.GeoDataFrame(
+            geometry=[shapely.box(0, 0, 1000, 1000), shapely.box(1100, 0, 2000, 1000), shapely.box(5000, 0, 6000, 900)],
+            crs=2193,
+        )
+        network = rivers.RiverNetworkIndex(gdf_rec, gdf_flow)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            list_path = [Path(temp_dir) / str(i) for i in range(len(gdf_roi))]
+            expected_path = Path(temp_dir) / "expected"
+            network.gen_batch(gdf_roi, list_path)
+            for i, path in enumerate(list_path):
+                gdf_expected = _gen_river_network_clip(gdf_roi.iloc[[i]], gdf_rec, gdf_flow, expected_path)
+                gdf_result = network.clip(network.get_extent(gdf_roi.iloc[[i]]))
+                pd.testing.assert_frame_equal(pd.DataFrame(gdf_expected), pd.DataFrame(gdf_result))
+                file_expected = gpd.read_file(expected_path / "river" / rivers.RIVER_NETWORK_FILE)
+                file_result = gpd.read_file(path / "river" / rivers.RIVER_NETWORK_FILE)
+                pd.testing.assert_frame_equal(pd.DataFrame(file_expected), pd.DataFrame(file_result))
+            self.assertEqual(len(gdf_result), 0)
+            self.assertEqual(gdf_expected.crs, gdf_result.crs)
+
+    def test_prep_rec_parquet(self):
+        """
+        the REC1 reaches loaded from the GeoParquet cache must be the same as from the shapefile or CSV
+        it is saved from, with or without the bounding box and columns,
+        the bounding box is filtered on the bounds columns which are not loaded.
+        """
+        x, y = 1_750_000, 5_900_000
+        gdf_rec = gpd.GeoDataFrame(
+            {
+                "NZREACH": range(1, 41),
+                "DISTSEA": [100.0 * i for i in range(40)],
+                "LENGTH": [10.0] * 40,
+                "CATCHAREA": [1.0 * i for i in range(40)],
+                "to_node": range(100, 140),
+                "from_node": range(200, 240),
+                "OTHER": ["other"] * 40,
+            },
+            geometry=[
+                shapely.LineString([(x + 500 * i, y + 300 * (i % 7)), (x + 500 * i + 400, y)]) for i in range(40)
+            ],
+            crs=2193,
+        )
+        gdf_rec.loc[39, "DISTSEA"] = rivers.MAX_SEA_DIST  # too far from the sea
+        bbox = (x + 2_000, y + 500, x + 6_000, y + 3_000)
+        list_id = sorted(gdf_rec.loc[gdf_rec.intersects(shapely.box(*bbox)), "NZREACH"])
+        self.assertTrue(0 < len(list_id) < 39)
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(rivers, "REC_ROW_GROUP_SIZE", 4):
+            shp_path = Path(temp_dir) / "shp" / "rec1.shp"
+            shp_path.parent.mkdir()
+            gdf_rec.to_crs(4326).to_file(shp_path)
+            csv_path = Path(temp_dir) / "csv" / "rec1.shp"
+            csv_path.parent.mkdir()
+            gdf_rec.to_wkt().to_csv(csv_path.with_suffix(".csv"), index=False)
+            for file_path in [shp_path, csv_path]:
+                list_kwargs = [
+                    dict(bbox=b, columns=c) for b in [None, bbox] for c in [None, ["NZREACH", "CATCHAREA"]]
+                ]
+                list_expected = [rivers.prep_rec(file_path, **kwargs) for kwargs in list_kwargs]
+                self.assertFalse(file_path.with_suffix(".parquet").is_file())
+                rivers.prep_rec(file_path, save=True)
+                for kwargs, expected in zip(list_kwargs, list_expected):
+                    result = rivers.prep_rec(file_path, **kwargs)
+                    columns = rivers.REC_COLUMNS if kwargs["columns"] is None else kwargs["columns"] + ["geometry"]
+                    self.assertEqual(result.columns.to_list(), columns)
+                    self.assertEqual(result.crs, expected.crs)
+                    result = result.sort_values(by="NZREACH").reset_index(drop=True)
+                    expected = expected.sort_values(by="NZREACH").reset_index(drop=True)
+                    pd.testing.assert_frame_equal(
+                        pd.DataFrame(expected).drop(columns="geometry"), pd.DataFrame(result).drop(columns="geometry"),
+                        check_dtype=False)
+                    self.assertTrue(expected.geom_equals_exact(result, 1e-3).all())
+                self.assertEqual(len(list_expected[0]), 39)
+                self.assertEqual(sorted(list_expected[2]["NZREACH"]), list_id)
+
+    def test_get_osmid_coast_index(self):
+        """
+        getting the OSM id of a catchment river with or without the coast index must give the same river and endpoint,
+        the distances to the local coastline of the index are the same as to the whole coastline.
+        """
+        gdf_coast, gdf_sdc, _, source = _get_river_fixture()
+        coast_index = rivers.CoastIndex(gdf_coast)
+        for by in ["dist", "len"]:
+            osm_id, endpoint, gdf_sorted, _, _ = rivers.get_osmid(1, gdf_sdc, gdf_coast, by=by, source=source)
+            result = rivers.get_osmid(1, gdf_sdc, gdf_coast, by=by, source=source, coast_index=coast_index)
+            self.assertEqual(osm_id, result[0])
+            self.assertEqual(osm_id, 13 if by == "dist" else 11)
+            self.assertTrue(endpoint is None and result[1] is None or endpoint.equals_exact(result[1], 1e-6))
+            self.assertEqual(gdf_sorted["osmid"].to_list(), result[2]["osmid"].to_list())
+            np.testing.assert_allclose(gdf_sorted["dist_sea"], result[2]["dist_sea"])
+
+    def test_local_waterway_source(self):
+        """
+        parity test of local OSM waterway source,
+        it must give the same features, tags and geometries of a polygon as Overpass API queried by osmnx.
+        """
+        polygon, response, xml = _get_osm_fixture()
+        columns = ["name"] + rivers.OSM_TAGS + ["geometry"]
+        # osmnx parses a copy of the Overpass API response for each query, rather than downloading it
+        download = lambda *args: iter([copy.deepcopy(response)])
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(rivers.ox._overpass, "_download_overpass_features", download):
+            osm_path = Path(temp_dir) / "waterway.osm"
+            osm_path.write_text(xml)
+            source = rivers.get_waterway_source(osm_path)
+            self.assertIsInstance(source, rivers.LocalWaterwaySource)
+            for tags, osmid in [({"waterway": True}, [11, 12]), ({"water": "river"}, [13])]:
+                expected = rivers.WaterwaySource().get_features(polygon, tags=tags).reindex(columns=columns)
+                # osmnx 2 names the index levels (element, id) instead of (element_type, osmid)
+                expected = expected.rename_axis(["element_type", "osmid"])
+                result = source.get_features(polygon, tags=tags).reindex(columns=columns)
+                self.assertEqual(expected.index.to_list(), [("way", i) for i in osmid])
+                self.assertEqual(expected.index.to_list(), result.index.to_list())
+                pd.testing.assert_frame_equal(
+                    pd.DataFrame(expected[columns[:-1]]), pd.DataFrame(result[columns[:-1]]), check_dtype=False)
+                for geom_expected, geom_result in zip(expected.geometry, result.geometry):
+                    self.assertEqual(geom_expected.geom_type, geom_result.geom_type)
+                    geom_expected, geom_result = shapely.normalize([geom_expected, geom_result])
+                    self.assertTrue(geom_expected.equals_exact(geom_result, 1e-9))
+
+    def test_loop_proc(self):
+        """
+        loop_proc keeps its former signature and saves the same row of a catchment as the batch workers,
+        the existing record is skipped unless update, and nothing is saved if no river is found.
+        """
+        gdf_coast, gdf_sdc, gdf_rec, source = _get_river_fixture()
+        with mock.patch.object(rivers.utils, "get_database", mock.MagicMock()), \
+                mock.patch.object(rivers, "get_waterway_source", lambda osm_path: source), \
+                mock.patch.object(rivers, "WaterwaySource", lambda: source):
+            # the coast index is built once and sent to the workers
+            coast_index = pickle.loads(pickle.dumps(rivers.CoastIndex(gdf_coast)))
+            context = rivers.RiverContext(gdf_sdc, gdf_rec, gdf_coast, coast_index=coast_index)
+            expected = context.get_row(1)
+            self.assertIsNone(context.get_row(2))
+            self.assertEqual((expected["osm_id"], expected["rec_id"]), (13, 101))
+            for exist, update, saved in [(False, False, True), (True, False, False), (True, True, True)]:
+                df_exist = pd.DataFrame({"catch_id": [1] if exist else []})
+                with mock.patch.object(rivers.pd, "read_sql", return_value=df_exist), \
+                        mock.patch.object(rivers.tables, "upsert_rows") as upsert_rows:
+                    self.assertIsNone(rivers.loop_proc(1, tables.RIVER, gdf_sdc, gdf_rec, gdf_coast, update=update))
+                    rivers.loop_proc(2, tables.RIVER, gdf_sdc, gdf_rec, gdf_coast, update=update)
+                self.assertEqual(upsert_rows.call_count, int(saved))
+                if saved:
+                    _, table, row = upsert_rows.call_args.args
+                    self.assertIs(table, tables.RIVER)
+                    self.assertEqual(row.keys(), expected.keys())
+                    for key in ["catch_id", "rec_id", "osm_id"]:
+                        self.assertEqual(row[key], expected[key])
+                    for key in ["rec_geometry", "osm_geometry"]:
+                        self.assertTrue(row[key].equals(expected[key]))
+
+
+if __name__ == '__main__':
+    unittest.main()
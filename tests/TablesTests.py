@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import subprocess
+import sys
+import unittest
+from unittest import mock, TestCase
+
+from newzealidar import tables
+from . import Base
+
+
+class TablesTests(Base, TestCase):
+    """Tests the tables module."""
+
+    def test_is_worker_alive(self):
+        """
+        the running jobs of a process gone on this host are interrupted,
+        the processes alive or on other hosts are taken as alive.
+        """
+        host = socket.gethostname()
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        self.assertTrue(tables.is_worker_alive(tables.get_worker_name()))
+        self.assertTrue(tables.is_worker_alive(f"{host}:{os.getppid()}"))
+        self.assertFalse(tables.is_worker_alive(f"{host}:{process.pid}"))
+        self.assertTrue(tables.is_worker_alive(f"another-{host}:{process.pid}"))
+
+    def test_migrate_table(self):
+        """
+        the unique index is created once on a table without it,
+        the duplicates are reported instead, and the table with the unique index is left as it is.
+        """
+        for indexdef, duplicates, created in [
+            ([], [], True),
+            ([], [3, 1], False),
+            (["CREATE UNIQUE INDEX hydro_dem_pkey ON public.hydro_dem USING btree (catch_id)"], [], False),
+        ]:
+            engine = mock.MagicMock()
+            engine.execute.return_value.fetchall.side_effect = [[(i,) for i in indexdef], [(i,) for i in duplicates]]
+            with mock.patch.object(tables, "create_table"), mock.patch.object(tables, "_unique_index_checked", set()):
+                if len(duplicates):
+                    with self.assertRaisesRegex(ValueError, r"2 duplicate catch_id: \[1, 3\]"):
+                        tables.migrate_table(engine, tables.DEM)
+                    continue
+                tables.migrate_table(engine, tables.DEM)
+                tables.migrate_table(engine, tables.DEM)
+            queries = [c.args[0] for c in engine.execute.call_args_list]
+            self.assertEqual(any("CREATE UNIQUE INDEX" in q for q in queries), created)
+            self.assertEqual(len(queries), 3 if created else 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
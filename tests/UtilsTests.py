@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from unittest import TestCase
+
+import geopandas as gpd
+import shapely
+from shapely.geometry import GeometryCollection, MultiPolygon, Polygon
+
+from newzealidar import utils
+from . import Base
+
+
+def _double_or_exit(item: int) -> int:
+    """double the item, terminate the worker process abruptly at item 3."""
+    if item == 3:
+        os._exit(1)
+    return item * 2
+
+
+def _fishnet_loop(geometry, threshold, lrbu=False):
+    """the former implementation of `utils.fishnet` clipping each cell in loops, as reference."""
+    bounds = geometry.bounds
+    xmin, xmax = int(bounds[0] // threshold), int(bounds[2] // threshold)
+    ymin, ymax = int(bounds[1] // threshold), int(bounds[3] // threshold)
+    result = []
+    for i in range(ymin, ymax + 1) if lrbu else range(xmin, xmax + 1):
+        for j in range(xmin, xmax + 1) if lrbu else range(ymin, ymax + 1):
+            x, y = (j, i) if lrbu else (i, j)
+            cell = shapely.box(x * threshold, y * threshold, (x + 1) * threshold, (y + 1) * threshold)
+            g = geometry.intersection(cell)
+            if not g.is_empty:
+                result.append(g)
+    return result
+
+
+def _katana_recursive(geometry, threshold, count=0):
+    """the former implementation of `utils.katana` splitting each polygon recursively, as reference."""
+    bounds = geometry.bounds
+    width = bounds[2] - bounds[0]
+    height = bounds[3] - bounds[1]
+    if geometry.area <= threshold or count == 250:
+        return [geometry]
+    if height >= width:
+        a = shapely.box(bounds[0], bounds[1], bounds[2], bounds[1] + height / 2)
+        b = shapely.box(bounds[0], bounds[1] + height / 2, bounds[2], bounds[3])
+    else:
+        a = shapely.box(bounds[0], bounds[1], bounds[0] + width / 2, bounds[3])
+        b = shapely.box(bounds[0] + width / 2, bounds[1], bounds[2], bounds[3])
+    result = []
+    for d in (a, b):
+        c = geometry.intersection(d)
+        for e in c.geoms if isinstance(c, GeometryCollection) else [c]:
+            if isinstance(e, (Polygon, MultiPolygon)):
+                result.extend(_katana_recursive(e, threshold, count + 1))
+    if count > 0:
+        return result
+    return [p for g in result for p in (g.geoms if isinstance(g, MultiPolygon) else [g])]
+
+
+class UtilsTests(Base, TestCase):
+    """Tests the utils module."""
+
+    def assertGeometriesEqual(self, list_expected, list_result):
+        """assert two lists of geometries are equal in the same order."""
+        self.assertEqual(len(list_expected), len(list_result))
+        for geom_expected, geom_result in zip(list_expected, list_result):
+            self.assertEqual(geom_expected.geom_type, geom_result.geom_type)
+            self.assertTrue(geom_expected.equals(geom_result))
+
+    def test_fishnet(self):
+        """
+        parity test of bulk fishnet.
+        it must give the same cells in the same order as clipping each cell in loops,
+        including the cells only touching the geometry along the grid lines.
+        """
+        geom = shapely.Polygon(
+            [(-1500, -200), (3700, 300), (2500, 2600), (0, 2000)], holes=[[(500, 500), (1500, 500), (1500, 1500)]]
+        )
+        for geometry in [geom, shapely.box(0, 0, 2000, 3000)]:
+            for lrbu in [False, True]:
+                list_expected = _fishnet_loop(geometry, 1000, lrbu=lrbu)
+                gs_result = utils.fishnet(geometry, 1000, lrbu=lrbu, crs=2193)
+                self.assertEqual(gs_result.crs, 2193)
+                self.assertGeometriesEqual(list_expected, gs_result.to_list())
+
+    def test_katana(self):
+        """
+        parity test of bulk katana.
+        it must give the same single part polygons in the same order as splitting each polygon recursively,
+        including the polygons split into multiple parts, and a list of polygons.
+        """
+        # a U shape split into two parts, a ring with a hole, and a polygon under the threshold
+        list_geom = [
+            shapely.box(0, 0, 3000, 3000).difference(shapely.box(1000, 1000, 2000, 3000)),
+            shapely.box(5000, 0, 9000, 1000).difference(shapely.box(5500, 250, 8500, 750)),
+            shapely.box(10000, 0, 10500, 500),
+        ]
+        threshold = 600_000
+        for geometry in list_geom:
+            list_expected = _katana_recursive(geometry, threshold)
+            self.assertGeometriesEqual(list_expected, utils.katana(geometry, threshold).to_list())
+        list_expected = [g for geometry in list_geom for g in _katana_recursive(geometry, threshold)]
+        gs_result = utils.katana(list_geom, threshold, crs=2193)
+        self.assertEqual(gs_result.crs, 2193)
+        self.assertGeometriesEqual(list_expected, gs_result.to_list())
+        self.assertTrue(all(g.geom_type == "Polygon" and g.area <= threshold for g in gs_result))
+
+    def test_parallel_imap_broken_worker(self):
+        """
+        a terminated worker process must not discard the completed results,
+        the unfinished items are reported by BrokenWorkerError after the completed results are yielded.
+        """
+        list_result = []
+        with self.assertRaises(utils.BrokenWorkerError) as context:
+            for result in utils.parallel_imap(_double_or_exit, range(8), workers=2):
+                list_result.append(result)
+        self.assertIn(3, context.exception.failed)
+        self.assertTrue(all(result // 2 not in context.exception.failed for result in list_result))
+        self.assertTrue(all(result % 2 == 0 and result != 6 for result in list_result))
+
+    def test_parallel_map_broken_worker(self):
+        """
+        a terminated worker process must not hang the pool or discard the completed results,
+        BrokenWorkerError reports the unfinished items and keeps the results in the order of items.
+        """
+        with self.assertRaises(utils.BrokenWorkerError) as context:
+            utils.parallel_map(_double_or_exit, range(8), workers=2, chunksize=1)
+        self.assertIn(3, context.exception.failed)
+        self.assertEqual(len(context.exception.results), 8)
+        for i, result in enumerate(context.exception.results):
+            self.assertEqual(result, None if i in context.exception.failed else i * 2)
+
+    def test_coverage_index(self):
+        """the catchments intersecting the buffered lidar coverage are covered, in one vectorised call."""
+        coverage = utils.CoverageIndex(shapely.box(0, 0, 1000, 1000), buffer=10)
+        gdf = gpd.GeoDataFrame(
+            {"catch_id": [1, 2, 3]},
+            geometry=[
+                shapely.box(500, 500, 1500, 1500),  # across the coverage
+                shapely.box(1005, 0, 1100, 100),  # within the buffer
+                shapely.box(2000, 0, 2100, 100),  # out of the coverage
+            ],
+            crs=2193,
+        )
+        self.assertEqual(coverage.filter(gdf), [1, 2])
+        self.assertTrue(coverage.covers(gdf))
+        self.assertFalse(coverage.covers(gdf.iloc[[2]]))
+        self.assertFalse(coverage.covers(shapely.box(1011, 0, 1100, 100)))
+
+
+if __name__ == '__main__':
+    unittest.main()